@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+# Benchmark: splitting long replies into telegram messages.
+# Compares split_message with the old character-by-character grouper.
+#
+# Usage: python3 benchmarks/bench_chunker.py [size_kb]
+
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import frotzbotchat
+
+
+def grouper(iterable, n):
+    """group ITERABLE by N elements"""
+    args = [iter(iterable)] * n
+    return itertools.zip_longest(*args)
+
+
+def old_split(text, max_len=4096):
+    msgs = map(lambda x: ''.join(filter(lambda y: y is not None, x)),
+               grouper(text, max_len))
+    return [x for x in msgs if not frotzbotchat.is_empty_string(x)]
+
+
+def make_text(size):
+    """Something like a long VERBOSE dump or help screen"""
+    paragraph = ('<b>Kitchen</b>\nYou are in the kitchen of the white house. '
+                 'A table seems to have been used recently for the preparation '
+                 'of food. A passage leads to the <i>west</i> and a dark '
+                 'staircase can be seen leading upward. To the east is a small '
+                 'window which is open. &lt;Score: 10&gt; — \U0001F56F\n\n')
+    return paragraph * (size // len(paragraph) + 1)
+
+
+def run(name, split, text, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        chunks = split(text)
+    elapsed = (time.perf_counter() - start) / rounds
+    broken = sum(1 for x in chunks if frotzbotchat.apply_tags([], x))
+    print('%-14s %8.2f ms  %3d chunks, %d with unclosed tags' % (
+        name, elapsed * 1000, len(chunks), broken))
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 100 * 1024
+    text = make_text(size)
+    print('%d characters' % len(text))
+    run('grouper', old_split, text, 20)
+    run('split_message', frotzbotchat.split_message, text, 20)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# End-to-end benchmark: runs frotzbot.py against a fake telegram server and
+# a fake interpreter, with N chats playing concurrently, and reports
+# throughput and turn latency (user message -> bot reply).
+#
+# Usage: python3 benchmarks/bench_e2e.py [--mode polling|webhook]
+#            [--chats N] [--turns N] [--delay SECONDS]
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_telegram import FakeTelegram
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.join(here, '..')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Player():
+    """One chat, sending next message once reply to previous one arrives.
+    Sends COMMANDS in turn if given, e.g. replayed from a transcript"""
+
+    def __init__(self, fake, chat_id, commands=None):
+        self.fake = fake
+        self.chat_id = chat_id
+        self.commands = commands
+        self.replied = threading.Event()
+        self.latencies = []
+        self.sent_at = None
+
+    def on_message(self, text, arrived):
+        if self.sent_at is not None and not self.replied.is_set():
+            self.latencies.append(arrived - self.sent_at)
+            self.replied.set()
+
+    def say(self, text, timeout=30):
+        self.replied.clear()
+        self.sent_at = time.monotonic()
+        self.fake.push_message(self.chat_id, text)
+        if not self.replied.wait(timeout):
+            raise RuntimeError('chat %d got no reply to %r' % (self.chat_id, text))
+
+    def play(self, turns):
+        self.say('/start')
+        self.say('Bench')
+        # only count game turns
+        self.latencies = []
+        for i in range(turns):
+            if self.commands:
+                self.say(self.commands[i % len(self.commands)])
+            else:
+                self.say('look %d' % i)
+
+
+def write_config(directory, args, fake):
+    config = {
+        'api_key': '123456:benchmark',
+        'api_base_url': fake.base_url,
+        'interpreter': sys.executable,
+        'interpreter_args': [os.path.join(here, 'fake_remglk.py'),
+                             '--delay', str(args.delay)],
+        'worker_threads': args.workers,
+        # fake telegram has no flood limits, measure the bot itself
+        'send_rate_global': 100000,
+        'send_rate_chat': 100000,
+        'send_burst_chat': 100000,
+        'stories': [{'name': 'Bench', 'filename': 'bench.story'}],
+    }
+    if args.mode == 'webhook':
+        port = free_port()
+        config['webhook'] = {
+            'listen': '127.0.0.1',
+            'port': port,
+            'url_path': 'hook',
+            'public_url': 'http://127.0.0.1:%d/hook' % port,
+        }
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.makedirs(os.path.join(directory, 'savedata'))
+    open(os.path.join(directory, 'bench.story'), 'w').close()
+
+
+def wait_until_ready(fake, mode, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if mode == 'webhook' and fake.webhook_url is not None:
+            time.sleep(0.5)
+            return
+        if mode == 'polling' and fake.api_calls.get('getUpdates', 0) > 1:
+            return
+        time.sleep(0.05)
+    raise RuntimeError('bot did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='interpreter thinking time per turn')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    players = dict()
+    fake = FakeTelegram(lambda chat_id, text, arrived:
+                        players[chat_id].on_message(text, arrived)).start()
+    for chat_id in range(1000, 1000 + args.chats):
+        players[chat_id] = Player(fake, chat_id)
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, args, fake)
+        bot = subprocess.Popen([sys.executable, os.path.join(repo, 'frotzbot.py')],
+                               cwd=directory)
+        try:
+            wait_until_ready(fake, args.mode)
+            threads = [threading.Thread(target=p.play, args=(args.turns,))
+                       for p in players.values()]
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+        finally:
+            bot.terminate()
+            bot.wait()
+            fake.stop()
+
+    latencies = [x for p in players.values() for x in p.latencies]
+    print('mode %s, %d chats x %d turns' % (args.mode, args.chats, args.turns))
+    print('throughput   %8.1f turns/s' % (len(latencies) / elapsed))
+    print('latency p50  %8.1f ms' % (percentile(latencies, 0.5) * 1000))
+    print('latency p99  %8.1f ms' % (percentile(latencies, 0.99) * 1000))
+    print('api calls    %r' % fake.api_calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+# Microbenchmark: reading RemGlk output from a pipe.
+# Compares JsonStreamReader with the old splitstream-based reader
+# (byte at a time, then json.loads), if splitstream is installed.
+#
+# Usage: python3 benchmarks/bench_jsonstream.py [updates] [paragraphs]
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import frotzbotterp
+
+
+def make_update(gen, paragraphs):
+    """Fake RemGlk update: status line plus a long room description"""
+    text = [{'content': [{'style': 'normal',
+                          'text': 'You are standing in an open field west '
+                                  'of a white house, with a boarded front '
+                                  'door. There is a small mailbox here. ' * 3}]}
+            for _ in range(paragraphs)]
+    return {'type': 'update',
+            'gen': gen,
+            'windows': [{'id': 1, 'type': 'buffer'}, {'id': 2, 'type': 'grid'}],
+            'content': [{'id': 2, 'lines': [{'line': 0, 'content': [
+                            {'style': 'normal', 'text': 'West of House   Score: 0   Moves: %d' % gen}]}]},
+                        {'id': 1, 'text': text}],
+            'input': [{'id': 1, 'gen': gen, 'type': 'line', 'maxlen': 256}]}
+
+
+def run(name, make_iter, payload_path, size, count):
+    # feed the pipe from another process: splitstream holds the GIL
+    # while blocked on read, so a writer thread would never get to run
+    writer = subprocess.Popen(
+        [sys.executable, '-c',
+         'import shutil, sys; shutil.copyfileobj(open(sys.argv[1], "rb"), sys.stdout.buffer)',
+         payload_path],
+        stdout=subprocess.PIPE, bufsize=0)
+    start = time.perf_counter()
+    received = sum(1 for _ in make_iter(writer.stdout.fileno()))
+    elapsed = time.perf_counter() - start
+    writer.wait()
+    writer.stdout.close()
+    assert received == count, (name, received)
+    print('%-16s %8.1f ms  %8.0f updates/s  %6.1f MB/s' % (
+        name, elapsed * 1000, count / elapsed, size / elapsed / 1e6))
+
+
+def splitstream_iter(fd):
+    import splitstream
+    return map(lambda x: json.loads(x.decode('utf-8')),
+               splitstream.splitfile(os.fdopen(fd, 'rb', buffering=0, closefd=False),
+                                     format='json', bufsize=1))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = '\n'.join(json.dumps(make_update(gen, paragraphs))
+                        for gen in range(count)).encode('utf-8')
+    print('%d updates, %d bytes each' % (count, len(payload) // count))
+
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        f.write(payload)
+        f.flush()
+        run('JsonStreamReader', frotzbotterp.JsonStreamReader,
+            f.name, len(payload), count)
+        try:
+            import splitstream  # noqa: F401
+        except ImportError:
+            print('splitstream is not installed, skipping old reader')
+        else:
+            run('splitstream', splitstream_iter, f.name, len(payload), count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+# Load test: runs frotzbot handlers in this process, with FakeBot in place
+# of telegram and fake_remglk.py in place of the interpreter, N chats
+# playing concurrently. Reports throughput, turn latency (update handed
+# to dispatcher -> first reply), memory per session and time spent in
+# each stage, as recorded by frotzbotmetrics.
+#
+# Usage: python3 benchmarks/bench_load.py [--chats N] [--turns N]
+#            [--delay SECONDS] [--jitter SECONDS] [--paragraphs N]
+#            [--transcript FILE [--scale N]] [--workers N]
+#            [--commands FILE]
+#
+# --commands takes player commands, one per line, e.g. from
+# replay_chat.py --commands, in place of generated ones.
+
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import telegram
+from telegram.ext import Dispatcher, JobQueue
+
+import frotzbot
+import frotzbotmetrics
+from bench_e2e import Player, percentile
+from fake_telegram import FakeBot
+
+stages = [
+    ('handler', frotzbotmetrics.handler_seconds),
+    ('reply', frotzbotmetrics.reply_seconds),
+    ('interpreter turn', frotzbotmetrics.turn_seconds),
+    ('json decode', frotzbotmetrics.decode_seconds),
+    ('render', frotzbotmetrics.render_seconds),
+    ('send message', frotzbotmetrics.send_message_seconds),
+]
+
+
+class Driver():
+    """Turns player messages into updates for DISPATCHER"""
+
+    def __init__(self, bot, dispatcher):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def push_message(self, chat_id, text):
+        with self.lock:
+            update_id = self.next_id
+            self.next_id = self.next_id + 1
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False,
+                     'first_name': 'Player', 'username': 'player%d' % chat_id},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        update = telegram.Update.de_json(
+            {'update_id': update_id, 'message': message}, self.bot)
+        self.dispatcher.process_update(update)
+
+
+def histogram_totals(histogram):
+    """Return (total seconds, count) over all labels"""
+    with histogram.lock:
+        data = list(histogram.values.values())
+    return (sum(x[-2] for x in data), sum(x[-1] for x in data))
+
+
+def write_config(directory, args):
+    interpreter_args = [os.path.join(here, 'fake_remglk.py'),
+                        '--delay', str(args.delay),
+                        '--jitter', str(args.jitter),
+                        '--paragraphs', str(args.paragraphs)]
+    if args.transcript:
+        interpreter_args += ['--transcript', os.path.abspath(args.transcript),
+                             '--scale', str(args.scale)]
+    config = {
+        'api_key': '123456:benchmark',
+        'interpreter': sys.executable,
+        'interpreter_args': interpreter_args,
+        'worker_threads': args.workers,
+        # fake bot has no flood limits, measure the bot itself
+        'send_rate_global': 100000,
+        'send_rate_chat': 100000,
+        'send_burst_chat': 100000,
+        'stories': [{'name': 'Bench', 'filename': 'bench.story'}],
+    }
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    os.makedirs(os.path.join(directory, 'savedata'))
+    open(os.path.join(directory, 'bench.story'), 'w').close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='interpreter thinking time per turn')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--paragraphs', type=int, default=3)
+    parser.add_argument('--transcript')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--commands')
+    args = parser.parse_args()
+
+    commands = None
+    if args.commands:
+        with open(args.commands, 'r') as f:
+            commands = [line.rstrip('\n') for line in f if line.strip()]
+
+    players = dict()
+    bot = FakeBot(lambda chat_id, text, arrived:
+                  players[chat_id].on_message(text, arrived))
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, args)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            frotzbot.load_config(config_path)
+            frotzbot.start_services()
+            job_queue = JobQueue()
+            dispatcher = Dispatcher(bot, queue.Queue(), workers=1,
+                                    job_queue=job_queue, use_context=True)
+            job_queue.set_dispatcher(dispatcher)
+            frotzbot.setup_dispatcher(dispatcher, job_queue, config_path)
+            driver = Driver(bot, dispatcher)
+            for chat_id in range(1000, 1000 + args.chats):
+                players[chat_id] = Player(driver, chat_id, commands)
+
+            rss_before = frotzbotmetrics.get_rss(os.getpid()) or 0
+            threads = [threading.Thread(target=p.play, args=(args.turns,))
+                       for p in players.values()]
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+
+            bot_rss = (frotzbotmetrics.get_rss(os.getpid()) or 0) - rss_before
+            terp_rss = [frotzbotmetrics.get_rss(b.terp_proc.pid) or 0
+                        for b in frotzbot.session_manager.live_backends()
+                        if b.terp_proc is not None]
+            queue_stats = frotzbot.scheduler.stats()
+        finally:
+            frotzbot.child_watcher.stop()
+            frotzbot.scheduler.shutdown()
+            frotzbot.sender.shutdown()
+            frotzbot.story_store.shutdown()
+            if frotzbot.transcript_store is not None:
+                frotzbot.transcript_store.shutdown()
+            for chat in frotzbot.chat_dict.values():
+                if chat.interpreter is not None:
+                    chat.interpreter.close()
+            os.chdir(cwd)
+
+    latencies = [x for p in players.values() for x in p.latencies]
+    turns = len(latencies)
+    print('%d chats x %d turns, %d workers' % (args.chats, args.turns, args.workers))
+    print('throughput        %8.1f turns/s' % (turns / elapsed))
+    print('latency p50       %8.1f ms' % (percentile(latencies, 0.5) * 1000))
+    print('latency p99       %8.1f ms' % (percentile(latencies, 0.99) * 1000))
+    print('bot memory        %8.1f KB per session' % (bot_rss / args.chats / 1024))
+    if terp_rss:
+        print('interpreter RSS   %8.1f KB per session' % (
+            sum(terp_rss) / len(terp_rss) / 1024))
+    print('queue wait        %8.2f ms avg, %.2f ms max' % (
+        queue_stats['wait_time_avg'] * 1000, queue_stats['wait_time_max'] * 1000))
+    print()
+    print('%-22s %10s %8s %10s' % ('stage', 'total ms', 'calls', 'ms/turn'))
+    for (name, histogram) in stages:
+        (total, count) = histogram_totals(histogram)
+        print('%-22s %10.1f %8d %10.3f' % (
+            name, total * 1000, count, total * 1000 / max(turns, 1)))
+    print('api calls  %r' % bot.api_calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+# Benchmark: per-turn cost of applying RemGlk updates to window state
+# and rendering them. Compares the window model in frotzbotterp with the
+# old string concatenating process_update.
+#
+# Usage: python3 benchmarks/bench_render.py [transcript.json]
+# Transcript is a file with RemGlk output objects, one after another,
+# as captured from interpreter stdout. Without it, fake updates are used.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import frotzbotterp
+from bench_jsonstream import make_update
+
+
+def load_transcript(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return list(frotzbotterp.JsonStreamReader(fd))
+    finally:
+        os.close(fd)
+
+
+def old_get_styled_text(content):
+    text = content['text']
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if 'style' in content and content['style'] in frotzbotterp.frotzbot_remglk_styles:
+        style = frotzbotterp.frotzbot_remglk_styles[content['style']]
+        text = '<%s>' % style + text + '</%s>' % style
+    return text
+
+
+class OldRenderer():
+    """process_update as it was before window model, for comparison"""
+
+    def __init__(self):
+        self.windows = []
+
+    def process_update(self, json_update):
+        self.windows = json_update.get('windows', self.windows)
+        update_dict = dict()
+        for content_update in json_update.get('content', []):
+            text = ''
+            if 'lines' in content_update:
+                lines = [x for x in content_update['lines']
+                         if x is not None and 'content' in x]
+                for line in lines:
+                    for line_content in line['content']:
+                        text = text + old_get_styled_text(line_content)
+                    text = text + '\n'
+            elif 'text' in content_update:
+                lines = [x for x in content_update['text']
+                         if (len(x) == 0) or 'content' in x]
+                for line in lines:
+                    if 'content' in line:
+                        for line_content in line['content']:
+                            text = text + old_get_styled_text(line_content)
+                    text = text + '\n'
+            elif 'clear' in content_update:
+                continue
+            update_dict[content_update['id']] = text
+        for window in self.windows:
+            window['content_text'] = update_dict.get(
+                window['id'], window.get('content_text', ''))
+        return [window.get('content_text', '') for window in self.windows]
+
+
+class NewRenderer():
+    def __init__(self):
+        # borrow window handling without starting an interpreter
+        self.backend = frotzbotterp.FrotzbotBackend.__new__(frotzbotterp.FrotzbotBackend)
+        self.backend.windows = dict()
+        self.backend.layout = None
+        self.backend.gen = 0
+        self.backend.prompt = None
+        self.backend.terp_proc = None
+        self.backend.renderer = frotzbotterp.default_renderer
+        self.backend.split_status = False
+        self.backend.status_text = None
+
+    def process_update(self, json_update):
+        self.backend.process_update(json_update)
+        return self.backend.render_changes()
+
+
+def run(name, renderer, updates, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            renderer.process_update(update)
+    elapsed = time.perf_counter() - start
+    turns = rounds * len(updates)
+    print('%-6s %8.1f us/turn' % (name, elapsed / turns * 1e6))
+
+
+def main():
+    if len(sys.argv) > 1:
+        scenarios = [(sys.argv[1], load_transcript(sys.argv[1]), 10)]
+    else:
+        scenarios = [('typical turns', [make_update(gen, 5) for gen in range(100)], 20),
+                     ('long dumps', [make_update(gen, 300) for gen in range(20)], 5)]
+    for (name, updates, rounds) in scenarios:
+        print('%s: %d updates' % (name, len(updates)))
+        run('old', OldRenderer(), updates, rounds)
+        run('new', NewRenderer(), updates, rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Stand-in RemGlk interpreter for benchmarks: answers every line of input
+# with a room description and a status line, or replays a transcript
+# recorded by record_transcript.py, one recorded update per input.
+# With --saves it also prints a '>' prompt and understands save and
+# restore, with --title-key its opening waits for a key press first.
+#
+# Usage: fake_remglk.py [--delay SECONDS] [--jitter SECONDS]
+#            [--paragraphs N] [--saves] [--title-key]
+#            [--transcript FILE [--scale N]] storyfile
+
+import argparse
+import copy
+import json
+import random
+import sys
+import time
+
+
+def read_events(stream):
+    """Yield JSON objects as they arrive on STREAM"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        chunk = stream.read1(65536) if hasattr(stream, 'read1') else stream.read(1)
+        if not chunk:
+            return
+        buffer = buffer + chunk.decode('utf-8')
+        while True:
+            buffer = buffer.lstrip()
+            try:
+                (obj, end) = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+            buffer = buffer[end:]
+            yield obj
+
+
+def make_update(gen, moves, text, paragraphs, first=False):
+    update = {
+        'type': 'update',
+        'gen': gen,
+        'content': [
+            {'id': 2, 'lines': [{'line': 0, 'content': [
+                {'style': 'normal', 'text': 'Benchmark Room    Moves: %d' % moves}]}]},
+            {'id': 1, 'text': [{'content': [{'style': 'normal', 'text': text}]}] +
+                [{'content': [{'style': 'normal',
+                               'text': 'The room is full of <benchmark> & test furniture. ' * 4}]}
+                 for _ in range(paragraphs)]},
+        ],
+        'input': [{'id': 1, 'gen': gen, 'type': 'line', 'maxlen': 256}],
+    }
+    if first:
+        update['windows'] = [
+            {'id': 1, 'type': 'buffer', 'rock': 201},
+            {'id': 2, 'type': 'grid', 'rock': 202, 'gridheight': 1, 'gridwidth': 60},
+        ]
+    return update
+
+
+def with_prompt(update):
+    """UPDATE with '>' command prompt printed at the end"""
+    for content in update.get('content', []):
+        if 'text' in content:
+            content['text'].append({'content': [{'style': 'normal', 'text': '>'}]})
+    return update
+
+
+def fileref_prompt(gen, filemode):
+    return {'type': 'update', 'gen': gen,
+            'specialinput': {'type': 'fileref_prompt', 'filemode': filemode,
+                             'filetype': 'save', 'gen': gen}}
+
+
+def title_screen(gen):
+    update = make_update(gen, 0, 'Press any key.', 0, first=True)
+    update['input'] = [{'id': 1, 'gen': gen, 'type': 'char'}]
+    return update
+
+
+def load_transcript(path, scale=1):
+    """Read updates recorded one per line, repeating buffer window
+    text SCALE times to get bigger output"""
+    updates = []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            for content in update.get('content', []):
+                if 'text' in content:
+                    content['text'] = content['text'] * scale
+            updates.append(update)
+    if not updates:
+        raise ValueError('empty transcript ' + path)
+    return updates
+
+
+def replay_update(transcript, turn, gen):
+    """Recorded update for TURN, renumbered to GEN. Once transcript runs
+    out, it starts over from the first update after the opening screen"""
+    if turn >= len(transcript):
+        turn = 1 + (turn - 1) % (len(transcript) - 1) if len(transcript) > 1 else 0
+    update = copy.deepcopy(transcript[turn])
+    update['gen'] = gen
+    for request in update.get('input', []):
+        request['gen'] = gen
+    return update
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random extra delay, up to this many seconds')
+    parser.add_argument('--paragraphs', type=int, default=3)
+    parser.add_argument('--saves', action='store_true',
+                        help='print prompt, understand save and restore')
+    parser.add_argument('--title-key', action='store_true',
+                        help='wait for a key before opening')
+    parser.add_argument('--transcript',
+                        help='JSON lines file of updates to replay')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='repeat replayed story text this many times')
+    parser.add_argument('story')
+    args = parser.parse_args()
+
+    transcript = None
+    if args.transcript:
+        transcript = load_transcript(args.transcript, args.scale)
+
+    out = sys.stdout
+    gen = 0
+    moves = 0
+    # 'write' or 'read' while save or restore asks for file name
+    filemode = None
+    for event in read_events(sys.stdin.buffer):
+        delay = args.delay + random.uniform(0, args.jitter)
+        if delay:
+            time.sleep(delay)
+        gen = gen + 1
+        value = event.get('value')
+        if transcript is not None:
+            if event.get('type') != 'init':
+                moves = moves + 1
+            update = replay_update(transcript, moves, gen)
+        elif event.get('type') == 'init' and args.title_key:
+            update = title_screen(gen)
+        elif event.get('type') == 'init' or event.get('type') == 'char':
+            update = make_update(gen, moves, 'Welcome to the benchmark.',
+                                 args.paragraphs, first=True)
+        elif args.saves and event.get('type') == 'specialresponse':
+            text = 'Failed.'
+            try:
+                if value and filemode == 'write':
+                    with open(value, 'w') as f:
+                        json.dump({'moves': moves}, f)
+                    text = 'Ok.'
+                elif value:
+                    with open(value, 'r') as f:
+                        moves = json.load(f)['moves']
+                    text = 'Ok.'
+            except (OSError, ValueError):
+                pass
+            filemode = None
+            update = make_update(gen, moves, text, 0)
+        elif args.saves and value in ('save', 'restore'):
+            filemode = 'write' if value == 'save' else 'read'
+            update = fileref_prompt(gen, filemode)
+        else:
+            moves = moves + 1
+            update = make_update(gen, moves, '> %s' % value,
+                                 args.paragraphs)
+        if args.saves and 'input' in update and update['input'][0]['type'] == 'line':
+            with_prompt(update)
+        out.write(json.dumps(update) + '\n')
+        out.flush()
+
+if __name__ == '__main__':
+    main()
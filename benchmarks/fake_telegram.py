@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# Local stand-in for the telegram Bot API, enough to run frotzbot offline:
+# getMe, getUpdates (long polling), setWebhook/deleteWebhook (updates are
+# then POSTed to the webhook), sendMessage, editMessageText, getFile.
+# Messages the bot sends are handed to a callback with their arrival time.
+# FakeBot answers the same calls in process, without any HTTP.
+
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import telegram
+
+bot_user = {'id': 1, 'is_bot': True, 'first_name': 'Frotzbot',
+            'username': 'frotzbot_bench_bot'}
+
+
+class FakeTelegram():
+    def __init__(self, on_message=None, host='127.0.0.1', port=0):
+        self.on_message = on_message
+        self.lock = threading.Condition()
+        self.pending = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.webhook_url = None
+        self.api_calls = dict()
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                fake.handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='fake-telegram', daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/bot' % self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def push_message(self, chat_id, text):
+        """Deliver message from user CHAT_ID to the bot"""
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id = self.next_message_id + 1
+            update = {
+                'update_id': self.next_update_id,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False,
+                             'first_name': 'Player', 'username': 'player%d' % chat_id},
+                    'text': text,
+                },
+            }
+            if text.startswith('/'):
+                update['message']['entities'] = [{
+                    'type': 'bot_command', 'offset': 0,
+                    'length': len(text.split()[0])}]
+            self.next_update_id = self.next_update_id + 1
+            webhook_url = self.webhook_url
+            if webhook_url is None:
+                self.pending.append(update)
+                self.lock.notify_all()
+        if webhook_url is not None:
+            request = urllib.request.Request(
+                webhook_url, data=json.dumps(update).encode('utf-8'),
+                headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request).read()
+
+    def handle(self, request):
+        path = urllib.parse.urlparse(request.path).path
+        method = path.rsplit('/', 1)[-1]
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        params = dict()
+        if body:
+            if request.headers.get('Content-Type', '').startswith('application/json'):
+                params = json.loads(body.decode('utf-8'))
+            else:
+                params = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+
+        with self.lock:
+            self.api_calls[method] = self.api_calls.get(method, 0) + 1
+        handler = getattr(self, 'api_' + method, None)
+        if handler is None:
+            result = True
+        else:
+            result = handler(params)
+
+        data = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def api_getMe(self, params):
+        return bot_user
+
+    def api_setWebhook(self, params):
+        with self.lock:
+            self.webhook_url = params.get('url') or None
+        return True
+
+    def api_deleteWebhook(self, params):
+        with self.lock:
+            self.webhook_url = None
+        return True
+
+    def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.lock:
+            while True:
+                self.pending = [x for x in self.pending if x['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.pending or remaining <= 0:
+                    return list(self.pending)
+                self.lock.wait(remaining)
+
+    def api_sendMessage(self, params):
+        arrived = time.monotonic()
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id = self.next_message_id + 1
+        chat_id = int(params['chat_id'])
+        if self.on_message is not None:
+            self.on_message(chat_id, params.get('text', ''), arrived)
+        return {'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': bot_user,
+                'text': params.get('text', '')}
+
+    def api_editMessageText(self, params):
+        return self.api_sendMessage(params)
+
+
+class FakeBot(telegram.Bot):
+    """telegram.Bot whose API calls never leave the process.
+    Sent and edited messages are handed to ON_MESSAGE like FakeTelegram does"""
+
+    def __init__(self, on_message=None):
+        super().__init__('123456:benchmark')
+        self.on_message = on_message
+        self.lock = threading.Lock()
+        self.next_message_id = 1
+        self.api_calls = dict()
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        with self.lock:
+            self.api_calls[endpoint] = self.api_calls.get(endpoint, 0) + 1
+        if endpoint == 'getMe':
+            return bot_user
+        if endpoint not in ('sendMessage', 'editMessageText'):
+            return True
+        arrived = time.monotonic()
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id = self.next_message_id + 1
+        chat_id = int(data['chat_id'])
+        if self.on_message is not None:
+            self.on_message(chat_id, data.get('text', ''), arrived)
+        return {'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': bot_user,
+                'text': data.get('text', '')}
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+# Records a transcript for fake_remglk.py --transcript: runs a real RemGlk
+# interpreter, passing input and output through, and writes every update
+# it prints to a JSON lines file. Use it as frotzbot's interpreter, with
+# the real one and its arguments after the transcript file name.
+#
+# Usage: record_transcript.py transcript.jsonl interpreter [args...] storyfile
+
+import json
+import shutil
+import subprocess
+import sys
+import threading
+
+from fake_remglk import read_events
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.exit('usage: record_transcript.py transcript.jsonl interpreter [args...]')
+    transcript = open(sys.argv[1], 'a')
+    terp = subprocess.Popen(sys.argv[2:], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+
+    def pass_input():
+        try:
+            shutil.copyfileobj(sys.stdin.buffer.raw, terp.stdin, 4096)
+        finally:
+            terp.stdin.close()
+
+    threading.Thread(target=pass_input, daemon=True).start()
+    for update in read_events(terp.stdout):
+        line = json.dumps(update)
+        transcript.write(line + '\n')
+        transcript.flush()
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+    sys.exit(terp.wait())
+
+
+if __name__ == '__main__':
+    main()
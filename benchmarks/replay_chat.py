@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Replays transcript of a chat kept by frotzbot ("transcripts" in config).
+# By default prints its turns as JSON lines. With --commands prints what
+# player typed, one command per line, for bench_load.py --commands.
+# With --check runs the commands through a real interpreter and reports
+# turns whose output differs from the recorded one, e.g. after changing
+# the interpreter or rendering.
+#
+# Usage: replay_chat.py [--root DIR] CHAT_ID [--commands]
+#        replay_chat.py [--root DIR] CHAT_ID --check --story FILE
+#            --interpreter PATH [--interpreter-args 'ARGS']
+
+import argparse
+import difflib
+import json
+import os
+import shlex
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import frotzbotterp
+import frotzbottranscript
+
+
+def check(turns, args):
+    """Play inputs of TURNS again, return number of turns that differ"""
+    backend = frotzbotterp.FrotzbotBackend(
+        args.interpreter, args.story,
+        terp_args=shlex.split(args.interpreter_args), timeout=args.timeout)
+    differences = 0
+    try:
+        opening = backend.get()
+        for (number, turn) in enumerate(turns):
+            if turn['input']:
+                (output, _) = backend.send_and_receive_many(turn['input'])
+            elif number == 0:
+                output = opening
+            else:
+                # e.g. output of a timed out turn, nothing to send
+                continue
+            if output != turn['output']:
+                differences = differences + 1
+                print('turn %d, input %r:' % (number, turn['input']))
+                sys.stdout.writelines(difflib.unified_diff(
+                    '\n'.join(turn['output']).splitlines(keepends=True),
+                    '\n'.join(output).splitlines(keepends=True),
+                    'recorded', 'replayed'))
+                print()
+    finally:
+        backend.close()
+    print('%d turns, %d differ' % (len(turns), differences))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('chat_id')
+    parser.add_argument('--root', default='transcripts')
+    parser.add_argument('--commands', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--story')
+    parser.add_argument('--interpreter')
+    parser.add_argument('--interpreter-args', default='')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    store = frotzbottranscript.FrotzbotTranscriptStore(args.root)
+    turns = store.chat(args.chat_id).all()
+
+    if args.check:
+        if not args.story or not args.interpreter:
+            parser.error('--check needs --story and --interpreter')
+        sys.exit(1 if check(turns, args) else 0)
+    for turn in turns:
+        if args.commands:
+            for command in turn['input']:
+                print(command)
+        else:
+            print(json.dumps(turn, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
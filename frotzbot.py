@@ -6,72 +6,138 @@
 # Idea (and some of the code) taken from https://github.com/sneaksnake/z5bot
 
 import telegram.ext
-import json
 import frotzbotchat
+import frotzbotsession
+import frotzbotsched
+import frotzbotpool
+import frotzbotmetrics
+import frotzbotshard
+import frotzbotsend
+import frotzbotstore
+import frotzbotsaves
+import frotzbotlog
+import frotzbothandoff
+import frotzbotconfig
+import frotzbottranscript
+import frotzbotwatch
+import multiprocessing
+import os
 import logging
+import threading
 
 from telegram.ext import Updater,CommandHandler,MessageHandler,Filters
+from telegram.ext import TypeHandler,DispatcherHandlerStop
 
 chat_dict = dict()
-config = dict()
-
-# set up logging
-logging.basicConfig(
-    format='[%(asctime)s-%(name)s-%(levelname)s]\n%(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    level=logging.DEBUG,
-    filename='frotzbot.log')
-logging.getLogger('telegram').setLevel(logging.WARNING)
+# FrotzbotConfig snapshot, replaced as a whole on reload
+config = None
+config_lock = threading.Lock()
+session_manager = frotzbotsession.FrotzbotSessionManager()
+scheduler = None
+prewarm_pool = None
+sender = None
+story_store = None
+save_store = None
+transcript_store = None
+child_watcher = None
+metrics_server = None
+# newest update seen, updates up to handoff_update_id were handled
+# by previous bot process and may come again
+last_update_id = 0
+handoff_update_id = 0
+
+dialog_log = logging.getLogger(frotzbotlog.dialog_logger)
 
 
 def log_dialog(in_message, out_messages):
-    logging.info('@%s[%d] sent: %r' %
-                 (in_message.from_user.username, in_message.from_user.id,
-                  in_message.text))
+    if not dialog_log.isEnabledFor(logging.INFO):
+        return
+    user = in_message.from_user
+    dialog_log.info('@%s[%d] sent: %r', user.username, user.id, in_message.text)
     for out_message in out_messages:
-        logging.info('Answering @%s[%d]: %r' % (
-            in_message.from_user.username, in_message.from_user.id, out_message
-            if out_message is not None else '[None]'))
+        dialog_log.info('Answering @%s[%d]: %r', user.username, user.id,
+                        out_message if out_message is not None else '[None]')
 
 
 def on_error(update, context):
     logger = logging.getLogger(__name__)
-    logger.warn('Update %r caused error %r!' % (update, context.error))
+    logger.warning('Update %r caused error %r!', update, context.error)
     print(context.error)
 
 
 
+def scheduled(handler):
+    """Wrap HANDLER so that it runs on worker pool,
+    in order with other updates from the same chat"""
+    def run(update, context):
+        def job():
+            try:
+                with frotzbotmetrics.handler_seconds.time(handler.__name__):
+                    handler(update, context)
+            except Exception as err:
+                context.dispatcher.dispatch_error(update, err)
+        scheduler.submit(update.message.chat_id, job)
+    return run
+
+
+def scheduled_batch(handler):
+    """Like scheduled, but text messages that come while earlier ones
+    from the same chat wait their turn go to HANDLER together, as a list
+    of updates. With typeahead on, an idle chat waits "coalesce_seconds"
+    for more of them"""
+    def job(updates, context):
+        try:
+            with frotzbotmetrics.handler_seconds.time(handler.__name__):
+                handler(updates, context)
+        except Exception as err:
+            context.dispatcher.dispatch_error(updates[-1], err)
+
+    def run(update, context):
+        typeahead = config.get('typeahead')
+        if typeahead:
+            scheduler.submit_batch(update.message.chat_id, job, update, context,
+                                   delay=typeahead.get('coalesce_seconds', 0))
+        else:
+            scheduler.submit(update.message.chat_id, job, [update], context)
+    return run
+
+
+def note_update(update, context):
+    global last_update_id
+    if update.update_id <= handoff_update_id:
+        raise DispatcherHandlerStop()
+    last_update_id = max(last_update_id, update.update_id)
+
+
+def send_text(bot, chat_id, text):
+    """Send TEXT through outbound queue, in order with replies of
+    CHAT_ID and within flood limits"""
+    sender.send(chat_id, bot.sendMessage, dict(chat_id=chat_id, text=text))
+
+
 def reload_conf(update, context, conf_path):
     bot = context.bot
     try:
-        global config
-        with open('config.json', 'r') as f:
-            config = json.load(f)
-
-        for chat in chat_dict.values():
-            chat.games_dict = config['stories']
-            chat.interpreter_path = config['interpreter']
-            chat.interpreter_args = config['interpreter_args']
-
-        text = '[Done! Changes will apply on next restart]'
-        bot.sendMessage(chat_id=update.message.chat_id, text=text)
-        log_dialog(update.message, [text])
-    except Exception:
-        # traceback.print_exc()
-        text = '[Something went wrong. Your new config is probably invalid or something]'
-        bot.sendMessage(chat_id=update.message.chat_id, text=text)
-        log_dialog(update.message, [text])
-        logging.exception('JSON configuration loading failed')
+        reload_config(conf_path)
+    except (OSError, frotzbotconfig.ConfigError) as err:
+        text = '[Config not reloaded: %s]' % err
+        logging.warning('Config not reloaded: %s', err)
+    else:
+        text = '[Done! New games use the new config]'
+    send_text(bot, update.message.chat_id, text)
+    log_dialog(update.message, [text])
 
 
 def get_chat(bot, chat_id):
     global chat_dict
-    global config
     if (chat_id in chat_dict):
         chat = chat_dict[chat_id]
     else:
-        logging.info('New chat instance: %s' % chat_id)
-        chat = frotzbotchat.FrotzbotChat(bot, chat_id, config)
+        logging.info('New chat instance: %s', chat_id)
+        chat = frotzbotchat.FrotzbotChat(bot, chat_id, current_config, session_manager,
+                                         prewarm_pool, sender, story_store,
+                                         save_store, transcript_store,
+                                         child_watcher)
         chat_dict[chat_id] = chat
 
     return chat
@@ -98,11 +164,13 @@ def space(update, context):
     log_dialog(update.message, response_msgs)
 
 
-def handle_text(update, context):
+def handle_texts(updates, context):
     bot = context.bot
-    chat = get_chat(bot, update.message.chat_id)
-    response_msgs = chat.reply(update)
-    log_dialog(update.message, response_msgs)
+    chat = get_chat(bot, updates[0].message.chat_id)
+    response_msgs = chat.reply_batch(updates)
+    for update in updates[:-1]:
+        log_dialog(update.message, [])
+    log_dialog(updates[-1].message, response_msgs)
 
 
 def handle_file(update, context):
@@ -123,46 +191,252 @@ def list_savefiles(update, context):
     response_msgs = chat.reply(update, chat.cmd_list_savefiles)
     log_dialog(update.message, response_msgs)
 
+def history(update, context):
+    chat = get_chat(context.bot, update.message.chat_id)
+    response_msgs = chat.reply(update, chat.cmd_history)
+    log_dialog(update.message, response_msgs)
+
+
+def export_transcript(update, context):
+    chat = get_chat(context.bot, update.message.chat_id)
+    response_msgs = chat.reply(update, chat.cmd_export)
+    log_dialog(update.message, response_msgs)
+
+
 def unknown_cmd(update, context):
     bot = context.bot
     text = '[I beg your pardon?]'
-    bot.sendMessage(chat_id=update.message.chat_id, text=text)
+    send_text(bot, update.message.chat_id, text)
     log_dialog(update.message, [text])
 
 
 def unsupported(update, context):
     bot = context.bot
     text = '[I don\'t support this command yet. Sorry!]'
-    bot.sendMessage(chat_id=update.message.chat_id, text=text)
+    send_text(bot, update.message.chat_id, text)
     log_dialog(update.message.text, [text])
 
 
-def main(config_path='config.json'):
-    # load config
+def register_gauges():
+    registry = frotzbotmetrics.registry
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_chats', 'Known chats', lambda: len(chat_dict)))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_live_interpreters', 'Running interpreter processes',
+        session_manager.live_count))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_prewarmed_interpreters', 'Spare prewarmed interpreters',
+        prewarm_pool.spare_count))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_watched_interpreters', 'Interpreter processes watched for exit',
+        child_watcher.watched_count))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_queue_depth', 'Updates waiting for a worker',
+        scheduler.queue_depth))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_outbound_queue_depth', 'Messages waiting to be sent',
+        sender.queue_depth))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_story_cache_bytes', 'Disk used by uploaded stories',
+        story_store.disk_usage))
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_queue_wait_seconds_max', 'Longest wait for a worker so far',
+        lambda: scheduler.stats()['wait_time_max']))
+
+    def interpreter_rss():
+        result = dict()
+        for backend in session_manager.live_backends():
+            proc = backend.terp_proc
+            rss = frotzbotmetrics.get_rss(proc.pid) if proc else None
+            if rss is not None:
+                result[(proc.pid, os.path.basename(backend.game_path))] = rss
+        return result
+
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_interpreter_rss_bytes', 'Resident memory of interpreter',
+        interpreter_rss, ('pid', 'story')))
+
+    def session_cpu():
+        result = dict()
+        for (chat_id, chat) in list(chat_dict.items()):
+            backend = chat.interpreter
+            if backend is not None:
+                result[(chat_id, os.path.basename(backend.game_path))] = \
+                    backend.cpu_seconds()
+        return result
+
+    registry.register(frotzbotmetrics.Gauge(
+        'frotzbot_session_cpu_seconds', 'CPU time used by interpreters of a game',
+        session_cpu, ('chat', 'story')))
+
+
+def current_config():
+    """Config snapshot in use right now"""
+    return config
+
+
+def apply_config(new_config):
+    """Put NEW_CONFIG in place. Chats read it when they need it, so
+    sessions started from now on get new stories and interpreters"""
     global config
-    with open(config_path, 'r') as f:
-        config = json.load(f)
-
-    # set up updater
-    global updater
-    updater = Updater(config['api_key'], use_context=True)
-    dispatcher = updater.dispatcher
+    config = new_config
+    session_manager.max_live = config.get('max_live_interpreters', 0)
+    session_manager.idle_timeout = config.get('interpreter_idle_timeout', 0)
+    if prewarm_pool is not None:
+        prewarm_pool.configure(config)
+
+
+def load_config(config_path):
+    apply_config(frotzbotconfig.load(config_path))
+
+
+def reload_config(config_path):
+    """Load CONFIG_PATH again, keeping current config if it is broken"""
+    with config_lock:
+        new_config = frotzbotconfig.load(config_path)
+        apply_config(new_config)
+    logging.info('Reloaded config from %s', config_path)
+
+
+def watch_config(config_path):
+    """Reload config whenever CONFIG_PATH changes, if asked to"""
+    interval = config.get('reload_interval', 0)
+    if not interval:
+        return None
+    return frotzbotconfig.FrotzbotConfigWatcher(
+        config_path, interval, lambda: reload_config(config_path))
+
+
+def stories_in_use():
+    """Story files of current games, which must stay on disk"""
+    return [chat.interpreter.game_path for chat in list(chat_dict.values())
+            if chat.interpreter is not None]
+
+
+def start_services(metrics_port=None):
+    global scheduler
+    scheduler = frotzbotsched.FrotzbotScheduler(config.get('worker_threads', 4))
+    # interpreters over the limit are suspended off the chat handlers
+    session_manager.run = scheduler.submit
+
+    # exits are reported in order with other jobs of the chat
+    global child_watcher
+    child_watcher = frotzbotwatch.FrotzbotChildWatcher(run=scheduler.submit)
+
+    global prewarm_pool
+    prewarm_pool = frotzbotpool.FrotzbotPrewarmPool(config)
+
+    global sender
+    sender = frotzbotsend.FrotzbotSender(
+        global_rate=config.get('send_rate_global', 30),
+        chat_rate=config.get('send_rate_chat', 1),
+        chat_burst=config.get('send_burst_chat', 5))
+
+    global story_store
+    story_store = frotzbotstore.FrotzbotStoryStore(
+        root=config.get('story_cache_dir', 'downloaded_stories'),
+        quota=config.get('story_cache_quota_mb', 0) * 1024 * 1024,
+        in_use=stories_in_use)
+
+    global save_store
+    save_store = frotzbotsaves.FrotzbotSaveStore(
+        max_count=config.get('max_saves_per_chat', 0),
+        max_bytes=config.get('max_save_mb_per_chat', 0) * 1024 * 1024)
+
+    transcripts = config.get('transcripts')
+    if transcripts is not None:
+        global transcript_store
+        transcript_store = frotzbottranscript.FrotzbotTranscriptStore(
+            root=transcripts.get('dir', 'transcripts'),
+            block_turns=transcripts.get('block_turns', 16),
+            segment_bytes=transcripts.get('segment_kb', 1024) * 1024,
+            max_bytes=transcripts.get('max_mb_per_chat', 0) * 1024 * 1024,
+            max_age=transcripts.get('max_days', 0) * 86400)
+
+    if metrics_port:
+        register_gauges()
+        global metrics_server
+        metrics_server = frotzbotmetrics.start_server(
+            metrics_port, config.get('metrics_host', '127.0.0.1'))
+
+
+def export_chats():
+    """Stop handling updates and return state of every chat,
+    with pipes of running interpreters, for new bot process"""
+    updater.stop()
+    # let handlers and replies in flight finish
+    child_watcher.stop()
+    scheduler.shutdown()
+    sender.shutdown()
+    chats = []
+    fds = []
+    for chat in list(chat_dict.values()):
+        (state, chat_fds) = chat.export_state()
+        state['fds'] = [len(fds), len(chat_fds)]
+        fds.extend(chat_fds)
+        chats.append(state)
+    return ({'chats': chats, 'last_update_id': last_update_id}, fds)
+
+
+def handoff_done(handed_over):
+    """Let go of everything new bot process needs, and exit"""
+    if handed_over:
+        for chat in chat_dict.values():
+            if chat.interpreter is not None:
+                chat.interpreter.detach()
+    else:
+        logging.error('Handoff failed, shutting down anyway')
+    if transcript_store is not None:
+        transcript_store.shutdown()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    updater.is_idle = False
+
+
+def adopt_chats(state, fds):
+    global handoff_update_id
+    handoff_update_id = state['last_update_id']
+    for chat_state in state['chats']:
+        (start, count) = chat_state['fds']
+        chat = get_chat(updater.bot, chat_state['chat_id'])
+        chat.restore_state(chat_state, fds[start:start + count])
+    logging.info('Took over %d chats', len(state['chats']))
+
+
+def setup_dispatcher(dispatcher, job_queue, config_path):
+    # suspend idle interpreters periodically
+    if session_manager.idle_timeout:
+        job_queue.run_repeating(
+            lambda context: session_manager.evict_idle(),
+            interval=min(60, session_manager.idle_timeout))
+    # drop transcripts of chats nobody plays anymore
+    if transcript_store is not None and transcript_store.max_age:
+        job_queue.run_repeating(lambda context: transcript_store.expire(),
+                                interval=3600, first=60)
 
     # set up message handlers
-    start_cmd_handler = CommandHandler('start', start)
-    enter_cmd_handler = CommandHandler('enter', enter)
-    space_cmd_handler = CommandHandler('space', space)
-    quit_cmd_handler =CommandHandler('quit', quit_interpreter)
-    listsaves_cmd_handler = CommandHandler('list_saves', list_savefiles)
-    reload_handler = CommandHandler('reload_conf', lambda u,c: reload_conf(u, c, config_path))
-    terp_cmd_handler = MessageHandler(telegram.ext.Filters.text, handle_text)
-    file_handler = MessageHandler(telegram.ext.Filters.document, handle_file)
-
-    unknown_cmd_handler = MessageHandler(telegram.ext.Filters.command, unknown_cmd)
+    start_cmd_handler = CommandHandler('start', scheduled(start))
+    enter_cmd_handler = CommandHandler('enter', scheduled(enter))
+    space_cmd_handler = CommandHandler('space', scheduled(space))
+    quit_cmd_handler =CommandHandler('quit', scheduled(quit_interpreter))
+    listsaves_cmd_handler = CommandHandler('list_saves', scheduled(list_savefiles))
+    history_cmd_handler = CommandHandler('history', scheduled(history))
+    export_cmd_handler = CommandHandler('export', scheduled(export_transcript))
+    def reload_conf_cmd(update, context):
+        reload_conf(update, context, config_path)
+    reload_handler = CommandHandler('reload_conf', scheduled(reload_conf_cmd))
+    terp_cmd_handler = MessageHandler(telegram.ext.Filters.text, scheduled_batch(handle_texts))
+    file_handler = MessageHandler(telegram.ext.Filters.document, scheduled(handle_file))
+
+    unknown_cmd_handler = MessageHandler(telegram.ext.Filters.command, scheduled(unknown_cmd))
 
     # error handlers
     dispatcher.add_error_handler(on_error)
 
+    # runs before everything else
+    dispatcher.add_handler(TypeHandler(telegram.Update, note_update), group=-1)
+
     # command handlers
     dispatcher.add_handler(start_cmd_handler)
     dispatcher.add_handler(enter_cmd_handler)
@@ -170,6 +444,8 @@ def main(config_path='config.json'):
     dispatcher.add_handler(quit_cmd_handler)
     dispatcher.add_handler(reload_handler)
     dispatcher.add_handler(listsaves_cmd_handler)
+    dispatcher.add_handler(history_cmd_handler)
+    dispatcher.add_handler(export_cmd_handler)
 
     # text handlers
     dispatcher.add_handler(terp_cmd_handler)
@@ -180,8 +456,87 @@ def main(config_path='config.json'):
     # always add unknown cmd handler last
     dispatcher.add_handler(unknown_cmd_handler)
 
-    updater.start_polling(clean=True)
+
+def bot_kwargs(config):
+    kwargs = dict()
+    if config.get('api_base_url'):
+        # e.g. local Bot API server, or fake one for benchmarks
+        kwargs['base_url'] = config['api_base_url']
+    return kwargs
+
+
+def make_updater(config):
+    return Updater(config['api_key'], use_context=True, **bot_kwargs(config))
+
+
+def start_updates(updater, config, drop_pending=True):
+    """Start receiving updates, by webhook if configured, by polling otherwise.
+    Updates that came while bot was down are dropped if DROP_PENDING"""
+    webhook = config.get('webhook')
+    if webhook:
+        # listen on plain HTTP behind a reverse proxy doing TLS,
+        # or terminate TLS here if cert and key are given
+        updater.start_webhook(
+            listen=webhook.get('listen', '127.0.0.1'),
+            port=webhook.get('port', 8443),
+            url_path=webhook.get('url_path', ''),
+            cert=webhook.get('cert'),
+            key=webhook.get('key'),
+            webhook_url=webhook.get('public_url'),
+            drop_pending_updates=drop_pending)
+    else:
+        updater.start_polling(drop_pending_updates=drop_pending)
+
+
+def main(config_path='config.json'):
+    # load config
+    load_config(config_path)
+
+    log_queue = None
+    if config.get('shard_workers'):
+        # workers log through this process, so the file has one writer
+        log_queue = multiprocessing.get_context('spawn').Queue()
+    log_listener = frotzbotlog.start_logging(config.get('logging', {}), log_queue)
+
+    # once, before any worker gets to saves
+    frotzbotsaves.FrotzbotSaveStore().migrate()
+
+    if config.get('shard_workers'):
+        # chats are handled by worker processes, this one only routes updates
+        frotzbotshard.run_supervisor(config, config_path, log_queue)
+        log_listener.stop()
+        return
+
+    # take chats and their interpreters over from running bot, if any
+    handoff_path = config.get('handoff_socket')
+    handoff = frotzbothandoff.request_handoff(handoff_path)
+    if handoff is not None:
+        (handoff_state, handoff_fds, handoff_conn) = handoff
+        frotzbothandoff.confirm_handoff(handoff_conn)
+
+    start_services(config.get('metrics_port'))
+
+    # set up updater
+    global updater
+    updater = make_updater(config)
+    if handoff is not None:
+        adopt_chats(handoff_state, handoff_fds)
+    setup_dispatcher(updater.dispatcher, updater.job_queue, config_path)
+    watch_config(config_path)
+
+    # messages sent during handoff are still waiting for us
+    start_updates(updater, config, drop_pending=handoff is None)
+    if handoff_path:
+        frotzbothandoff.FrotzbotHandoffServer(handoff_path, export_chats,
+                                              handoff_done)
     updater.idle()
+    child_watcher.stop()
+    scheduler.shutdown()
+    sender.shutdown()
+    story_store.shutdown()
+    if transcript_store is not None:
+        transcript_store.shutdown()
+    log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -1,41 +1,233 @@
 """This module contains a object representing a chat state for frotzbot"""
 
 import frotzbotterp
+import frotzbotmetrics
+import frotzbotlimits
+import frotzbottranscript
+import concurrent.futures
+import functools
 import traceback
 import telegram.ext
+import logging
 import re
-import itertools
 import os
+import time
 
 from fnmatch import fnmatch
 
-def grouper(iterable, n):
-    """group ITERABLE by N elements"""
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args)
+# telegram message length limit, in UTF-16 code units
+max_message_len = 4096
+# room left in every chunk for closing and reopening tags
+tag_reserve = 256
+
+tag_re = re.compile(r'<(/?)([a-zA-Z]+)[^>]*>')
+token_re = re.compile(r'<[^>]*>|&[#\w]*;|[^<&]+|[<&]')
+
+
+def utf16_len(text):
+    """Length of TEXT the way telegram counts it"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def cut_text(text, max_len):
+    """Longest prefix of TEXT no longer than MAX_LEN, preferably at space"""
+    head = text[:max_len]
+    excess = utf16_len(head) - max_len
+    while excess > 0:
+        # EXCESS is in code units, characters out of BMP take two of them
+        head = head[:len(head) - (excess + 1) // 2]
+        excess = utf16_len(head) - max_len
+    space = head.rfind(' ')
+    if space > 0 and len(head) < len(text):
+        head = head[:space + 1]
+    return head
+
+
+def split_long_line(line, max_len):
+    """Cut LINE into pieces no longer than MAX_LEN,
+    never in the middle of a tag or an entity"""
+    pieces = []
+    current = []
+    current_len = 0
+    for token in token_re.findall(line):
+        token_len = utf16_len(token)
+        while current_len + token_len > max_len:
+            if token[0] in '<&' and len(token) > 1:
+                # tags and entities are indivisible
+                if not current:
+                    break
+                pieces.append(''.join(current))
+                current = []
+                current_len = 0
+                continue
+            head = cut_text(token, max_len - current_len)
+            if not head and not current:
+                # single character wider than MAX_LEN, take it anyway
+                head = token[0]
+            if head:
+                current.append(head)
+                token = token[len(head):]
+                token_len = utf16_len(token)
+            pieces.append(''.join(current))
+            current = []
+            current_len = 0
+        if token:
+            current.append(token)
+            current_len = current_len + token_len
+    if current:
+        pieces.append(''.join(current))
+    return pieces
+
+
+def apply_tags(stack, text):
+    """Return list of (name, opening tag) still open after TEXT"""
+    if '<' not in text:
+        return stack
+    stack = list(stack)
+    for match in tag_re.finditer(text):
+        name = match.group(2).lower()
+        if not match.group(1):
+            stack.append((name, match.group(0)))
+        else:
+            # drop innermost tag with this name and everything inside it
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    del stack[i:]
+                    break
+    return stack
+
+
+def split_message(text, max_len=max_message_len):
+    """Split TEXT into chunks telegram would accept as separate messages.
+
+    Cuts on line boundaries when possible, closes tags left open at the end
+    of a chunk and reopens them in the next one"""
+    chunks = []
+    parts = []
+    length = 0
+    stack = []
+    closing = ''
+    for line in text.splitlines(keepends=True):
+        line_len = utf16_len(line)
+        if line_len > max_len - tag_reserve:
+            pieces = split_long_line(line, max_len - tag_reserve)
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_len = line_len if len(pieces) == 1 else utf16_len(piece)
+            new_stack = apply_tags(stack, piece)
+            new_closing = (closing if new_stack is stack else
+                           ''.join('</%s>' % name for (name, _) in reversed(new_stack)))
+            if parts and length + piece_len + utf16_len(new_closing) > max_len:
+                chunks.append(''.join(parts) + closing)
+                reopening = ''.join(tag for (_, tag) in stack)
+                parts = [reopening]
+                length = utf16_len(reopening)
+            parts.append(piece)
+            length = length + piece_len
+            stack = new_stack
+            closing = new_closing
+    if parts:
+        chunks.append(''.join(parts) + closing)
+    return chunks
+
+
+# commands typed ahead are split at semicolons and line breaks outside
+# double quotes, as in "take lamp; open door; say \"hi; bye\"". Periods
+# stay, abbreviations like "ask Mr. Smith" have them too, and story
+# parsers understand "n. e" on their own
+command_token_re = re.compile(r'"[^"]*(?:"|$)|[^";\n]+|[;\n]')
+
+
+def split_commands(text):
+    """Split TEXT into separate commands for interpreter"""
+    commands = []
+    command = ''
+    for token in command_token_re.findall(text):
+        if token in (';', '\n'):
+            commands.append(command)
+            command = ''
+        else:
+            command = command + token
+    commands.append(command)
+    commands = [strip_command(x) for x in commands]
+    return [x for x in commands if x] or [text]
+
+
+def strip_command(command):
+    """COMMAND without surrounding whitespace and a trailing period
+    outside quotes"""
+    command = command.strip()
+    if command.count('"') % 2 == 0:
+        command = command.rstrip('.').rstrip()
+    return command
+
+
+# turns /history shows without a number, and at most
+default_history_turns = 10
+max_history_turns = 100
+
+still_thinking_text = '[Interpreter is still thinking. Send anything to see its output]'
+
+restore_failed_text = ('[Could not bring back your game, put aside while you were away: %s. '
+                       'It is still saved. Send anything to try again, or /quit to start over]')
+
+
+def not_sent_note(commands):
+    """Tell player COMMANDS never reached the interpreter"""
+    return '[Not sent: %s]' % frotzbotterp.escape_html(' / '.join(commands))
 
 
 def is_empty_string(text):
-    whitespace_re = re.compile('^\s+$')
+    whitespace_re = re.compile('^\s*$')
     return whitespace_re.match(text)
 
 
 class FrotzbotChat():
-    """Object representing a chat state for frotzbot"""
+    """Object representing a chat state for frotzbot.
+
+    CONFIG is a FrotzbotConfig, or a function returning the one in use.
+    Chat looks it up whenever it needs it, so reloaded config applies
+    to new games right away"""
 
-    def __init__(self, bot, chat_id, config):
+    def __init__(self, bot, chat_id, config, session_manager=None,
+                 prewarm_pool=None, sender=None, story_store=None,
+                 save_store=None, transcript_store=None, child_watcher=None):
+        self.log = logging.getLogger('FrotzbotChat')
         self.bot = bot
         self.chat_id = chat_id
-        self.games_dict = config['stories']
-        self.interpreter_path = config['interpreter']
-        self.interpreter_args = config.get('interpreter_args', [])
-        self.window_separator = config.get('window_separator', '\n\n')
-        self.terp_list = config.get('interpreter_list')
+        self.current_config = config if callable(config) else lambda: config
+        # latest status text, and what the status message currently shows.
+        # Status message is only touched from send jobs, which run in order
+        self.status_text = None
+        self.status_sent_text = None
+        self.status_message_id = None
+        self.session_manager = session_manager
+        self.prewarm_pool = prewarm_pool
+        self.sender = sender
+        self.story_store = story_store
+        self.savefiles = save_store.chat(chat_id) if save_store is not None else None
+        self.transcript = (transcript_store.chat(chat_id)
+                           if transcript_store is not None else None)
+        self.child_watcher = child_watcher
         self.interpreter = None
         self.reply_markup = None
 
         self.handle_message = self.cmd_start
 
+    @property
+    def config(self):
+        return self.current_config()
+
+    @property
+    def window_separator(self):
+        return self.config.get('window_separator', '\n\n')
+
+    @property
+    def status_message(self):
+        # show grid windows in one pinned message edited in place
+        return self.config.get('status_message', False)
+
     def cmd_start(self, message):
         text = message.text
         result_text = None
@@ -49,14 +241,14 @@ class FrotzbotChat():
         return result_text
 
     def newgame_dialog(self):
+        # story uploaded before and not started is given up on
+        self.unpin_story()
+        config = self.config
         result_text = '[What game would you like to play?]\n\n'
-        for game in self.games_dict:
+        for game in config.stories:
             result_text = result_text + game['name'] + '\n'
 
-        # entries = list(map(lambda x: [x['name']], self.games_dict))
-        entries = [[x['name']] for x in self.games_dict]
-        self.reply_markup = telegram.ReplyKeyboardMarkup(
-            entries, resize_keyboard=True, one_time_keyboard=True)
+        self.reply_markup = config.games_keyboard
         self.handle_message = self.select_game
         return result_text
 
@@ -74,53 +266,101 @@ class FrotzbotChat():
 
     def select_game_text(self, text):
         result_text = None
-        try:
-            game = next(x for x in self.games_dict if x['name'] == text)
-        except StopIteration:
+        config = self.config
+        game = config.story_index.get(text)
+        if game is None:
             result_text = '[Don\'t know this one. Choose another]'
-            entries = [[x['name']] for x in self.games_dict]
-            self.reply_markup = telegram.ReplyKeyboardMarkup(
-                entries, resize_keyboard=True, one_time_keyboard=True)
+            self.reply_markup = config.games_keyboard
             self.handle_message = self.select_game
         else:
-            terp_path = game.get('interpreter', self.interpreter_path)
-            terp_args = game.get('interpreter_args', self.interpreter_args)
+            terp_path = game.get('interpreter', config['interpreter'])
+            terp_args = game.get('interpreter_args',
+                                 config.get('interpreter_args', ()))
+            timeout = config.get('interpreter_timeout')
+            status_message = config.get('status_message', False)
+            limits = frotzbotlimits.limits_for(config.get('limits', {}), game)
             game_file = game['filename']
+            savefile_prefix = 'savedata' + os.path.sep + str(self.chat_id) + '_'
+
+            prewarmed = None
+            if self.prewarm_pool is not None and not game.get('single_turn'):
+                prewarmed = self.prewarm_pool.take(game)
 
             try:
-                self.interpreter = frotzbotterp.FrotzbotBackend(
-                    terp_path,
-                    game_file,
-                    'savedata' + os.path.sep + str(self.chat_id) + '_',
-                    terp_args)
+                if game.get('single_turn'):
+                    self.interpreter = frotzbotterp.FrotzbotSingleTurnBackend(
+                        terp_path,
+                        game_file,
+                        savefile_prefix,
+                        terp_args,
+                        timeout=timeout,
+                        styles=game.get('styles'),
+                        split_status=status_message,
+                        savefiles=self.savefiles,
+                        limits=limits,
+                        transcript=self.transcript,
+                        autosave_dir=os.path.join(
+                            'savedata', 'autosave', str(self.chat_id),
+                            os.path.basename(game_file)),
+                        single_turn_args=game.get('single_turn_args'))
+                elif prewarmed is None:
+                    self.interpreter = frotzbotterp.FrotzbotBackend(
+                        terp_path,
+                        game_file,
+                        savefile_prefix,
+                        terp_args,
+                        session_manager=self.session_manager,
+                        timeout=timeout,
+                        styles=game.get('styles'),
+                        split_status=status_message,
+                        savefiles=self.savefiles,
+                        limits=limits,
+                        transcript=self.transcript)
+                else:
+                    (self.interpreter, opening) = prewarmed
+                    opening_texts = self.interpreter.attach(savefile_prefix,
+                                                            self.session_manager,
+                                                            timeout,
+                                                            status_message,
+                                                            self.savefiles,
+                                                            self.transcript,
+                                                            opening)
             except OSError:
                 result_text = '[Could not start interpreter]'
                 self.handle_message = self.cmd_start
-                self.reply_markup = telegram.ReplyKeyboardMarkup(
-                    [['/start']],
-                    resize_keyboard=True)
+                self.reply_markup = config.start_keyboard
             else:
-                result_text = self.window_separator.join(self.interpreter.get())
+                try:
+                    if prewarmed is None:
+                        opening_texts = self.interpreter.get()
+                    else:
+                        # printed before this chat got the interpreter
+                        self.interpreter.record_turn([], opening_texts)
+                    result_text = self.window_separator.join(opening_texts)
+                except frotzbotterp.InterpreterTimeout:
+                    result_text = still_thinking_text
                 if is_empty_string(result_text):
                     result_text = '[no output]'
 
-                self.reply_markup = telegram.ReplyKeyboardMarkup(
-                    [['/enter', '/space', '/quit'], ['/start']],
-                    resize_keyboard=True)
+                self.reply_markup = config.game_keyboard
                 self.handle_message = self.send_to_terp
+                self.watch_interpreter()
         return result_text
 
     def select_game_file(self, document):
-        file = self.bot.getFile(document.file_id)
-        filename = 'downloaded_stories' + os.path.sep + str(self.chat_id) + '_' + document.file_name
-        file.download(filename)
-
-        self.handle_message = lambda msg: self.select_terp(filename, msg)
-        entries = [[x['name']] for x in self.terp_list]
-        self.reply_markup = telegram.ReplyKeyboardMarkup(
-            entries, resize_keyboard=True)
+        if self.story_store is not None:
+            # downloads while player picks interpreter
+            filename = self.story_store.fetch(self.bot, document, self.chat_id)
+        else:
+            file = self.bot.getFile(document.file_id)
+            filename = 'downloaded_stories' + os.path.sep + str(self.chat_id) + '_' + document.file_name
+            file.download(filename)
+
+        config = self.config
+        self.handle_message = functools.partial(self.select_terp, filename)
+        self.reply_markup = config.interpreters_keyboard
         result_text = "[Select interpreter]"
-        for terp in self.terp_list:
+        for terp in config.interpreters:
             result_text = result_text + '\n' + terp['name']
 
         return result_text
@@ -136,39 +376,61 @@ class FrotzbotChat():
 
     def select_terp(self, filename, message):
         text = message.text
+        config = self.config
 
-        try:
-            terp = next(x for x in self.terp_list if x['name'] == text)
-        except StopIteration:
+        terp = config.interpreter_index.get(text)
+        if terp is None:
             result_text = '[Don\'t know this one. Choose another]'
-            entries = [[x['name']] for x in self.terp_list]
-            self.reply_markup = telegram.ReplyKeyboardMarkup(
-                entries, resize_keyboard=True, one_time_keyboard=True)
-            self.handle_message = lambda msg: self.select_terp(filename, msg)
+            self.reply_markup = config.interpreters_keyboard
+            self.handle_message = functools.partial(self.select_terp, filename)
         else:
+            if isinstance(filename, concurrent.futures.Future):
+                try:
+                    filename = filename.result()
+                except Exception:
+                    self.log.exception('Story download failed')
+                    self.unpin_story()
+                    self.handle_message = self.cmd_start
+                    self.reply_markup = config.start_keyboard
+                    return '[Could not download story]'
             try:
                 self.interpreter = frotzbotterp.FrotzbotBackend(
                     terp['path'],
                     filename,
                     'savedata' + os.path.sep + str(self.chat_id) + '_',
-                    self.interpreter_args)
+                    config.get('interpreter_args', ()),
+                    session_manager=self.session_manager,
+                    timeout=config.get('interpreter_timeout'),
+                    split_status=config.get('status_message', False),
+                    savefiles=self.savefiles,
+                    limits=frotzbotlimits.limits_for(config.get('limits', {}),
+                                                     terp),
+                    transcript=self.transcript)
             except OSError:
                 result_text = '[Could not start interpreter]'
                 self.handle_message = self.cmd_start
-                self.reply_markup = telegram.ReplyKeyboardMarkup(
-                    [['/start']],
-                    resize_keyboard=True)
+                self.reply_markup = config.start_keyboard
             else:
-                result_text = self.window_separator.join(self.interpreter.get())
+                try:
+                    result_text = self.window_separator.join(self.interpreter.get())
+                except frotzbotterp.InterpreterTimeout:
+                    result_text = still_thinking_text
                 if is_empty_string(result_text):
                     result_text = '[no output]'
 
-                self.reply_markup = telegram.ReplyKeyboardMarkup(
-                    [['/enter', '/space', '/quit'], ['/start']],
-                    resize_keyboard=True)
+                self.reply_markup = config.game_keyboard
                 self.handle_message = self.send_to_terp
+                self.watch_interpreter()
+            # running game keeps its story from now on, failed one lets it go
+            self.unpin_story()
         return result_text
 
+    def unpin_story(self):
+        """Let story store evict story uploaded for this chat
+        once nothing is waiting to start it"""
+        if self.story_store is not None:
+            self.story_store.unpin(self.chat_id)
+
     def send_to_terp(self, message):
         # Yeah, I'm lazy like that
         if (isinstance(message, str)):
@@ -178,6 +440,8 @@ class FrotzbotChat():
 
         if self.interpreter is None:
             text = self.cmd_quit()
+        elif self.interpreter.waiting:
+            text = self.receive_late()
         elif self.interpreter.prompt is None:
             text = '[WARNING: interpreter returned valid response, but no input prompt. Posssibly wrong interpreter was chosen]'
 
@@ -187,37 +451,146 @@ class FrotzbotChat():
                     result_text = self.cmd_quit()
             except (StopIteration):
                 result_text = self.cmd_quit()
+            except frotzbotterp.InterpreterTimeout:
+                result_text = still_thinking_text
 
             text = text + '\n' + result_text
         else:
-            # check for special commands first
-            # deprecated_cmds = ['save', 'restore', 'quit']
-            deprecated_cmds = ['quit']
-            cmd_regex = '|'.join(deprecated_cmds)
-            regex = re.compile('^\s*(' + cmd_regex + ')\s*$',
-                               re.IGNORECASE)
-            match = regex.match(text)
+            text = self.send_commands([text])
+
+        return text
+
+    def send_commands(self, commands, max_commands=0):
+        """Send COMMANDS to interpreter one after another, at most
+        MAX_COMMANDS of them if that is set, and return output of all
+        of them as one text"""
+        # check for special commands first
+        # deprecated_cmds = ['save', 'restore', 'quit']
+        deprecated_cmds = ['quit']
+        cmd_regex = '|'.join(deprecated_cmds)
+        regex = re.compile('^\s*(' + cmd_regex + ')\s*$',
+                           re.IGNORECASE)
+        notes = []
+        # commands typed after quit are not sent either
+        dropped = []
+        for (i, command) in enumerate(commands):
+            match = regex.match(command)
             if match:
-                text = 'Use the %s command instead' % ('/' + match.group(1))
+                notes.append('Use the %s command instead' % ('/' + match.group(1)))
+                dropped = commands[i + 1:]
+                commands = commands[:i]
+                break
+        if not commands:
+            if dropped:
+                notes.insert(0, not_sent_note(dropped))
+            return '\n'.join(notes)
+        unsent = []
+        if max_commands and len(commands) > max_commands:
+            unsent = commands[max_commands:]
+            commands = commands[:max_commands]
+
+        try:
+            (result_texts, not_taken) = self.interpreter.send_and_receive_many(commands)
+        except (IOError, BrokenPipeError):
+            traceback.print_exc()
+            text = '[Error during communication with interpreter]'
+        except frotzbotterp.InterpreterTimeout:
+            text = still_thinking_text
+        except frotzbotterp.RestoreFailed as err:
+            text = restore_failed_text % frotzbotterp.escape_html(str(err))
+        except StopIteration:
+            text = self.interpreter_stopped()
+        else:
+            # response might contain only whitespaces.
+            # since bots can't send 'empty' messages,
+            # assume it means 'press anykey to continue'
+            text = self.window_separator.join(result_texts)
+            if is_empty_string(text):
+                text = '[press /enter to continue]'
+            unsent = not_taken + unsent
+        unsent = unsent + dropped
+        if unsent:
+            notes.insert(0, not_sent_note(unsent))
+        return '\n'.join([text] + notes)
+
+    def typeahead(self):
+        """Typeahead settings, or None if commands typed ahead
+        can't go to interpreter together right now"""
+        typeahead = self.config.get('typeahead')
+        if (not typeahead or self.interpreter is None or
+                self.handle_message != self.send_to_terp or
+                self.interpreter.waiting or
+                not self.interpreter.takes_typeahead()):
+            return None
+        return typeahead
+
+    def send_typeahead(self, messages):
+        """Send commands of text MESSAGES to interpreter in one go"""
+        typeahead = self.typeahead()
+        commands = []
+        for message in messages:
+            if typeahead.get('split_commands'):
+                commands.extend(split_commands(message.text))
             else:
-                try:
-                    result_texts = self.interpreter.send_and_receive(text)
-                except (IOError, BrokenPipeError):
-                    traceback.print_exc()
-                    text = '[Error during communication with interpreter]'
-                else:
-                    # response might contain only whitespaces.
-                    # since bots can't send 'empty' messages,
-                    # assume it means 'press anykey to continue'
-                    text = self.window_separator.join(result_texts)
-                    if is_empty_string(text):
-                        text = '[press /enter to continue]'
+                commands.append(message.text)
+        return self.send_commands(commands, typeahead.get('max_commands', 0))
 
+    def receive_late(self):
+        """Show output of the turn that previously timed out"""
+        try:
+            text = self.window_separator.join(self.interpreter.send_and_receive(None))
+        except frotzbotterp.InterpreterTimeout:
+            return still_thinking_text
+        except frotzbotterp.RestoreFailed as err:
+            return restore_failed_text % frotzbotterp.escape_html(str(err))
+        except StopIteration:
+            return self.interpreter_stopped()
+        if is_empty_string(text):
+            text = '[press /enter to continue]'
         return text
 
+    def interpreter_stopped(self):
+        """End the game whose interpreter exited, telling player why"""
+        reason = self.interpreter.exit_reason()
+        self.interpreter.close()
+        return self.stopped_text(reason)
+
+    def stopped_text(self, reason):
+        """End the game, and return text telling player REASON
+        together with last things interpreter wrote to stderr"""
+        text = '[Interpreter stopped: %s]' % frotzbotterp.escape_html(reason)
+        tail = self.interpreter.stderr_text()
+        if tail:
+            text = text + '\n<pre>%s</pre>' % frotzbotterp.escape_html(tail)
+        return text + '\n' + self.cmd_quit()
+
+    def watch_interpreter(self):
+        """Find out about interpreter dying between turns, if there is
+        a child watcher"""
+        if self.child_watcher is not None and self.interpreter is not None:
+            self.interpreter.watch_exit(self.child_watcher, self.chat_id,
+                                        self.interpreter_exited)
+
+    def interpreter_exited(self, backend, reason):
+        """Called once interpreter BACKEND was running exited on its own
+        and was closed. Runs in order with replies of this chat"""
+        if backend is not self.interpreter:
+            # game was over already
+            return
+        self.log.info('Interpreter of chat %s exited: %s', self.chat_id, reason)
+        text = self.stopped_text(reason)
+        for msg in split_message(text):
+            self.send_message(chat_id=self.chat_id,
+                              text=msg,
+                              timeout=5.0,
+                              parse_mode='HTML',
+                              reply_markup=self.reply_markup)
+
     def cmd_enter(self, message=None):
         if self.interpreter is None:
             text = self.cmd_quit()
+        elif self.interpreter.waiting:
+            text = self.receive_late()
         elif self.interpreter.prompt is None:
             text = '[WARNING: interpreter returned valid response, but no input prompt. Posssibly wrong interpreter was chosen]\n' + self.cmd_quit()
         elif self.interpreter.prompt['type'] == 'char':
@@ -229,6 +602,8 @@ class FrotzbotChat():
     def cmd_space(self, message=None):
         if self.interpreter is None:
             text = self.cmd_quit()
+        elif self.interpreter.waiting:
+            text = self.receive_late()
         elif self.interpreter.prompt is None:
             text = '[WARNING: interpreter returned valid response, but no input prompt. Posssibly wrong interpreter was chosen]\n' + self.cmd_quit()
         else:
@@ -237,32 +612,169 @@ class FrotzbotChat():
 
     def cmd_quit(self, message=None):
         self.interpreter = None
+        # player gave up on story uploaded and not started yet, if any
+        self.unpin_story()
         self.handle_message = self.cmd_start
         self.reply_markup = telegram.ReplyKeyboardRemove()
         return '[No active games. /start a new session?]'
 
     def cmd_list_savefiles(self, message=None):
+        if self.savefiles is not None:
+            lines = []
+            for (name, entry) in self.savefiles.list():
+                saved = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time']))
+                if entry['story']:
+                    lines.append('%s (%s, %s)' % (name, entry['story'], saved))
+                else:
+                    lines.append('%s (%s)' % (name, saved))
+            return frotzbotterp.escape_html('\n'.join(lines))
+
         # list savefiles starting with chat_id, substracting it in the process
         files = [f.split('_',1)[1] for f in os.listdir('savedata') if fnmatch(f, str(self.chat_id) + '_*')]
+        files = [f for f in files if f != frotzbotterp.autosave_name]
         return '\n'.join(files)
 
+    def cmd_history(self, message=None):
+        """Show last turns, as many as player asked for: /history 20"""
+        if self.transcript is None:
+            return '[History is not kept]'
+        count = default_history_turns
+        if message is not None:
+            args = message.text.split()[1:]
+            if args and args[0].isdigit():
+                count = min(int(args[0]), max_history_turns)
+        parts = []
+        for turn in self.transcript.last(count):
+            texts = ['<b>&gt; %s</b>' % frotzbotterp.escape_html(x)
+                     for x in turn['input']]
+            parts.append(self.window_separator.join(texts + turn['output']))
+        if not parts:
+            return '[Nothing played yet]'
+        return self.window_separator.join(parts)
+
+    def cmd_export(self, message=None):
+        """Send whole transcript of this chat as a text file"""
+        if self.transcript is None:
+            return '[History is not kept]'
+        lines = []
+        for turn in self.transcript.all():
+            stamp = time.strftime('%Y-%m-%d %H:%M', time.localtime(turn['time']))
+            lines.append('[%s %s]' % (stamp, turn['story'] or ''))
+            lines.extend('> ' + x for x in turn['input'])
+            lines.extend(frotzbottranscript.html_to_text(x) for x in turn['output'])
+            lines.append('')
+        if not lines:
+            return '[Nothing played yet]'
+        kwargs = {'chat_id': self.chat_id,
+                  'document': '\n'.join(lines).encode('utf-8'),
+                  'filename': 'transcript-%s.txt' % self.chat_id,
+                  'timeout': 60.0}
+        if self.sender is not None:
+            self.sender.send(self.chat_id, self.bot.sendDocument, kwargs)
+        else:
+            self.bot.sendDocument(**kwargs)
+        return None
+
+    def export_state(self):
+        """Return (state, fds) to recreate this chat in another
+        bot process with restore_state()"""
+        handler = self.handle_message
+        if isinstance(handler, functools.partial):
+            args = list(handler.args)
+            if isinstance(args[0], concurrent.futures.Future):
+                # story download has to finish here
+                try:
+                    args[0] = args[0].result()
+                except Exception:
+                    handler = self.cmd_start
+                    args = []
+            handler_state = [handler.func.__name__] + args
+        else:
+            handler_state = [handler.__name__]
+        state = {
+            'chat_id': self.chat_id,
+            'handler': handler_state,
+            'reply_markup': (self.reply_markup.to_dict()
+                             if self.reply_markup is not None else None),
+            'status_text': self.status_text,
+            'status_sent_text': self.status_sent_text,
+            'status_message_id': self.status_message_id,
+            'interpreter': None,
+        }
+        fds = []
+        if self.interpreter is not None:
+            (state['interpreter'], fds) = self.interpreter.export_state()
+            state['single_turn'] = isinstance(
+                self.interpreter, frotzbotterp.FrotzbotSingleTurnBackend)
+        return (state, fds)
+
+    def restore_state(self, state, fds):
+        """Take over chat from export_state() of previous bot process"""
+        (name, *args) = state['handler']
+        handler = getattr(self, name)
+        self.handle_message = functools.partial(handler, *args) if args else handler
+        if name == 'select_terp' and self.story_store is not None:
+            # story is still waiting for its game to start
+            self.story_store.pin(self.chat_id, args[0])
+        markup = state['reply_markup']
+        if markup is None:
+            self.reply_markup = None
+        elif 'keyboard' in markup:
+            self.reply_markup = telegram.ReplyKeyboardMarkup.de_json(markup, self.bot)
+        else:
+            self.reply_markup = telegram.ReplyKeyboardRemove()
+        self.status_text = state['status_text']
+        self.status_sent_text = state['status_sent_text']
+        self.status_message_id = state['status_message_id']
+        if state['interpreter'] is not None:
+            if state.get('single_turn'):
+                self.interpreter = frotzbotterp.FrotzbotSingleTurnBackend.adopt(
+                    state['interpreter'], fds, None, self.savefiles,
+                    self.transcript)
+            else:
+                self.interpreter = frotzbotterp.FrotzbotBackend.adopt(
+                    state['interpreter'], fds, self.session_manager, self.savefiles,
+                    self.transcript)
+            self.watch_interpreter()
+
+    def reply_batch(self, updates):
+        """Reply to text UPDATES that came in quick succession. Commands
+        for running game go to interpreter together and get one reply"""
+        with frotzbotmetrics.reply_seconds.time():
+            updates = list(updates)
+            sent = []
+            # e.g. story name and first command
+            while updates and self.typeahead() is None:
+                sent.extend(self.reply_untimed(updates.pop(0)))
+            if updates:
+                messages = [update.message for update in updates]
+                sent.extend(self.reply_untimed(
+                    updates[-1], lambda message: self.send_typeahead(messages)))
+            return sent
+
     def reply(self, update, handler=None, text=None):
+        with frotzbotmetrics.reply_seconds.time():
+            return self.reply_untimed(update, handler, text)
+
+    def reply_untimed(self, update, handler=None, text=None):
         if handler is None:
             handler = self.handle_message
 
         # print(update.message.text)
         reply_text = handler(update.message)
 
+        if self.status_message and self.interpreter is not None:
+            status_text = self.interpreter.take_status()
+            if status_text is not None:
+                self.update_status(status_text)
+
         if reply_text:
-            # divide our message by chunks of 4096 chars
+            # divide our message by chunks telegram would accept
             # and send them, except empty string chunks
-            max_len = 4096
-            msgs = map(lambda x: ''.join(filter(lambda y: y is not None, x)),
-                       grouper(reply_text, max_len))
-            msg_strings = [x for x in msgs
+            msg_strings = [x for x in split_message(reply_text)
                            if not is_empty_string(x)]
             for msg in msg_strings:
-                self.bot.sendMessage(
+                self.send_message(
                     chat_id=self.chat_id,
                     text=msg,
                     timeout=5.0,
@@ -271,3 +783,62 @@ class FrotzbotChat():
             return msg_strings
         else:
             return []
+
+    def send_message(self, **kwargs):
+        """Send message through outbound queue if there is one,
+        right away otherwise"""
+        if self.sender is not None:
+            self.sender.send(self.chat_id, self.timed_send_message, kwargs)
+        else:
+            self.timed_send_message(**kwargs)
+
+    def update_status(self, text):
+        """Show TEXT in status message, once previous messages are sent"""
+        self.status_text = text
+        if self.sender is not None:
+            self.sender.send(self.chat_id, self.deliver_status, dict())
+        else:
+            self.deliver_status()
+
+    def deliver_status(self):
+        """Edit status message to show latest status text, or send
+        and pin a new one. Edits queued behind a newer one do nothing"""
+        text = self.status_text
+        if text is None or is_empty_string(text) or text == self.status_sent_text:
+            return
+        text = split_message(text)[0]
+        if self.status_message_id is not None:
+            try:
+                with frotzbotmetrics.send_message_seconds.time():
+                    self.bot.editMessageText(chat_id=self.chat_id,
+                                             message_id=self.status_message_id,
+                                             text=text,
+                                             parse_mode='HTML',
+                                             timeout=5.0)
+            except telegram.error.BadRequest as err:
+                if 'not modified' not in str(err):
+                    # e.g. player deleted it, post a new one
+                    self.log.warning('Could not edit status message: %s', err)
+                    self.status_message_id = None
+            if self.status_message_id is not None:
+                self.status_sent_text = self.status_text
+                return
+
+        message = self.timed_send_message(chat_id=self.chat_id,
+                                          text=text,
+                                          timeout=5.0,
+                                          parse_mode='HTML',
+                                          disable_notification=True)
+        self.status_message_id = message.message_id
+        self.status_sent_text = self.status_text
+        try:
+            self.bot.pinChatMessage(chat_id=self.chat_id,
+                                    message_id=message.message_id,
+                                    disable_notification=True)
+        except telegram.error.TelegramError as err:
+            # no rights to pin in this group, message is still edited
+            self.log.info('Could not pin status message: %s', err)
+
+    def timed_send_message(self, **kwargs):
+        with frotzbotmetrics.send_message_seconds.time():
+            return self.bot.sendMessage(**kwargs)
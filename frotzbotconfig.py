@@ -0,0 +1,184 @@
+"""This module contains configuration snapshots. A snapshot is checked
+once when loaded and never changes afterwards, so reloading config only
+means putting a new snapshot in place of the old one"""
+
+import json
+import logging
+import os
+import threading
+import types
+
+import telegram
+
+# keyboard shown while a game is running
+game_keyboard_rows = [['/enter', '/space', '/quit'], ['/start']]
+
+
+class ConfigError(ValueError):
+    """Config file is not something bot can run with"""
+
+
+def freeze(value):
+    """Read-only copy of VALUE loaded from JSON"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: freeze(v) for (k, v) in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(x) for x in value)
+    return value
+
+
+def thaw(value):
+    """Plain dicts and lists from frozen VALUE, e.g. to dump it as JSON"""
+    if isinstance(value, types.MappingProxyType):
+        return {k: thaw(v) for (k, v) in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(x) for x in value]
+    return value
+
+
+def check_entries(entries, what, required):
+    """Check list of ENTRIES of WHAT, each having REQUIRED keys and
+    a unique name. Returns name -> entry"""
+    if not isinstance(entries, list):
+        raise ConfigError('"%s" should be a list' % what)
+    index = dict()
+    for (i, entry) in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ConfigError('%s #%d is not an object' % (what, i + 1))
+        for key in required:
+            if not isinstance(entry.get(key), str):
+                raise ConfigError('%s #%d needs "%s" string'
+                                  % (what, i + 1, key))
+        if entry['name'] in index:
+            raise ConfigError('%s "%s" is listed twice' % (what, entry['name']))
+        for key in ('interpreter_args', 'single_turn_args'):
+            if key in entry and not isinstance(entry[key], list):
+                raise ConfigError('"%s" of %s "%s" should be a list'
+                                  % (key, what, entry['name']))
+        index[entry['name']] = entry
+    return index
+
+
+def check(data):
+    """Raise ConfigError if DATA is missing something or has wrong types"""
+    if not isinstance(data, dict):
+        raise ConfigError('config should be a JSON object')
+    for key in ('api_key', 'interpreter'):
+        if not isinstance(data.get(key), str):
+            raise ConfigError('"%s" string is missing' % key)
+    if not isinstance(data.get('interpreter_args', []), list):
+        raise ConfigError('"interpreter_args" should be a list')
+    if not isinstance(data.get('limits', {}), dict):
+        raise ConfigError('"limits" should be an object')
+    for key in ('interpreter_timeout', 'worker_threads', 'prewarm_limit',
+                'max_live_interpreters', 'interpreter_idle_timeout',
+                'reload_interval'):
+        value = data.get(key)
+        if value is not None and (not isinstance(value, (int, float)) or
+                                  isinstance(value, bool) or value < 0):
+            raise ConfigError('"%s" should be a non-negative number' % key)
+    check_entries(data.get('stories'), 'stories', ('name', 'filename'))
+    if 'interpreter_list' in data:
+        check_entries(data['interpreter_list'], 'interpreter_list',
+                      ('name', 'path'))
+
+
+class FrotzbotConfig():
+    """Checked, read-only snapshot of config DATA, with story and
+    interpreter indexes and reply keyboards built in advance.
+
+    Reads like the dict it was made of: config['key'], config.get('key')"""
+
+    def __init__(self, data, path=None):
+        check(data)
+        data = freeze(data)
+        attributes = {
+            'data': data,
+            'path': path,
+            'stories': data['stories'],
+            # name -> entry
+            'story_index': {x['name']: x for x in data['stories']},
+            'interpreters': data.get('interpreter_list', ()),
+            'interpreter_index': {x['name']: x
+                                  for x in data.get('interpreter_list', ())},
+            'games_keyboard': telegram.ReplyKeyboardMarkup(
+                [[x['name']] for x in data['stories']],
+                resize_keyboard=True, one_time_keyboard=True),
+            'interpreters_keyboard': telegram.ReplyKeyboardMarkup(
+                [[x['name']] for x in data.get('interpreter_list', ())],
+                resize_keyboard=True, one_time_keyboard=True),
+            'game_keyboard': telegram.ReplyKeyboardMarkup(
+                game_keyboard_rows, resize_keyboard=True),
+            'start_keyboard': telegram.ReplyKeyboardMarkup(
+                [['/start']], resize_keyboard=True),
+        }
+        for (name, value) in attributes.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('config snapshot is read-only')
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def updated(self, **changes):
+        """New snapshot with CHANGES on top of this one"""
+        data = thaw(self.data)
+        data.update(changes)
+        return FrotzbotConfig(data, self.path)
+
+
+def load(path):
+    """Read and check config file PATH, return FrotzbotConfig"""
+    with open(path, 'r') as f:
+        try:
+            data = json.load(f)
+        except ValueError as err:
+            raise ConfigError('not valid JSON: %s' % err)
+    return FrotzbotConfig(data, path)
+
+
+class FrotzbotConfigWatcher():
+    """Checks every INTERVAL seconds whether file PATH changed,
+    and calls ON_CHANGE() when it did"""
+
+    def __init__(self, path, interval, on_change):
+        self.log = logging.getLogger('FrotzbotConfigWatcher')
+        self.path = path
+        self.interval = interval
+        self.on_change = on_change
+        self.stopped = threading.Event()
+        self.last_stat = self.file_stat()
+        self.thread = threading.Thread(target=self.watch, name='config-watch',
+                                       daemon=True)
+        self.thread.start()
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            stat = self.file_stat()
+            if stat is None or stat == self.last_stat:
+                continue
+            self.last_stat = stat
+            self.log.info('%s changed, reloading', self.path)
+            try:
+                self.on_change()
+            except (OSError, ConfigError) as err:
+                self.log.warning('Config not reloaded: %s', err)
+            except Exception:
+                self.log.exception('Reloading %s failed', self.path)
+
+    def stop(self):
+        self.stopped.set()
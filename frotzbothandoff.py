@@ -0,0 +1,169 @@
+"""This module contains session handoff between bot processes. Running
+bot listens on a unix socket; a new one started with the same config
+connects to it, and gets state of every chat together with pipes of
+running interpreters, so nobody loses their game on restart"""
+
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+# fds per message, SCM_RIGHTS takes up to 253
+fds_per_message = 240
+chunk_size = 32768
+handoff_timeout = 60
+
+
+class AdoptedProcess():
+    """Interpreter started by previous bot process, standing in for its
+    subprocess.Popen. It is not our child, so exit status stays unknown"""
+
+    def __init__(self, pid, stdin_fd, stdout_fd, stderr_fd):
+        self.pid = pid
+        self.stdin = os.fdopen(stdin_fd, 'wb', buffering=0)
+        self.stdout = os.fdopen(stdout_fd, 'rb', buffering=0)
+        self.stderr = os.fdopen(stderr_fd, 'rb', buffering=0)
+        self.returncode = None
+        # pidfd keeps referring to this process even if pid gets reused
+        try:
+            self.pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            self.pidfd = None
+
+    def alive(self, timeout=0):
+        """Whether process is still running after TIMEOUT seconds,
+        None meaning until it exits"""
+        if self.pidfd is not None:
+            # poll, as select can't take fds over 1024
+            poller = select.poll()
+            poller.register(self.pidfd, select.POLLIN)
+            return not poller.poll(None if timeout is None else timeout * 1000)
+        deadline = float('inf') if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                return False
+            if time.monotonic() >= deadline:
+                return True
+            time.sleep(0.05)
+
+    def poll(self):
+        return None
+
+    def wait(self, timeout=None):
+        if self.alive(timeout):
+            raise subprocess.TimeoutExpired('adopted interpreter', timeout)
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+        return self.returncode
+
+    def kill(self):
+        try:
+            if self.pidfd is not None:
+                signal.pidfd_send_signal(self.pidfd, signal.SIGKILL)
+            else:
+                os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def send_message(sock, data, fds=()):
+    if fds:
+        socket.send_fds(sock, [data], list(fds))
+    else:
+        sock.sendall(data)
+
+
+def send_state(sock, state, fds):
+    """Send STATE (JSON serializable) and FDS over SOCK"""
+    data = json.dumps(state).encode('utf-8')
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    send_message(sock, struct.pack('!II', len(chunks), len(fds)))
+    for chunk in chunks:
+        send_message(sock, chunk)
+    for i in range(0, len(fds), fds_per_message):
+        send_message(sock, b'f', fds[i:i + fds_per_message])
+
+
+def receive_state(sock):
+    """Receive (state, fds) sent with send_state"""
+    (chunk_count, fd_count) = struct.unpack('!II', sock.recv(8))
+    data = b''.join(sock.recv(chunk_size) for _ in range(chunk_count))
+    fds = []
+    while len(fds) < fd_count:
+        (_, received, _, _) = socket.recv_fds(sock, 1, fds_per_message)
+        if not received:
+            raise IOError('handoff connection closed early')
+        fds.extend(received)
+    return (json.loads(data.decode('utf-8')), fds)
+
+
+class FrotzbotHandoffServer():
+    """Waits on unix socket PATH for a new bot process. Then calls
+    EXPORT(), which stops this bot and returns (state, fds), sends them
+    over and calls DONE(handed_over) once new process confirmed or failed"""
+
+    def __init__(self, path, export, done):
+        self.log = logging.getLogger('FrotzbotHandoffServer')
+        self.path = path
+        self.export = export
+        self.done = done
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self.serve, name='frotzbot-handoff',
+                                       daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        (conn, _) = self.sock.accept()
+        self.log.info('New bot process asked for handoff')
+        handed_over = False
+        with conn:
+            try:
+                (state, fds) = self.export()
+                conn.settimeout(handoff_timeout)
+                send_state(conn, state, fds)
+                handed_over = conn.recv(16) == b'ok'
+            except Exception:
+                self.log.exception('Handoff failed')
+            if handed_over:
+                self.log.info('Handed %d chats over', len(state['chats']))
+            # new process waits for connection to close
+            # before it takes ports and sockets over
+            self.done(handed_over)
+        self.sock.close()
+
+
+def request_handoff(path):
+    """Ask bot listening on PATH for its chats. Returns (state, fds, conn),
+    or None if nobody is there. Confirm with confirm_handoff(conn)"""
+    if not path or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
+        return None
+    sock.settimeout(handoff_timeout)
+    (state, fds) = receive_state(sock)
+    return (state, fds, sock)
+
+
+def confirm_handoff(sock):
+    """Tell previous bot process it may exit, and wait until it does"""
+    with sock:
+        sock.sendall(b'ok')
+        # old process closes connection once it let go of everything
+        sock.recv(16)
@@ -0,0 +1,167 @@
+"""This module contains resource limits for interpreter processes, so that
+a runaway story can't starve other sessions"""
+
+import logging
+import os
+import resource
+import shutil
+import signal
+
+clock_ticks = os.sysconf('SC_CLK_TCK')
+
+
+def get_cpu_seconds(pid):
+    """User and system CPU time used by process PID, None if it is gone"""
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # command name may contain spaces, count fields after it
+    fields = stat[stat.rindex(b')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / clock_ticks
+
+
+def limits_for(defaults, *entries):
+    """ResourceLimits from DEFAULTS dict, overridden by "limits"
+    of story or interpreter config ENTRIES, later ones winning"""
+    merged = dict(defaults)
+    for entry in entries:
+        if entry:
+            merged.update(entry.get('limits', {}))
+    return ResourceLimits(merged)
+
+
+class ResourceLimits():
+    """Limits for interpreter processes, from CONFIG dict:
+
+    memory_mb - address space limit,
+    cpu_seconds_per_turn - CPU time one turn may take,
+    open_files - open file descriptors limit,
+    nice - scheduling priority, ionice - "idle" or "best-effort:<0-7>",
+    cgroup - cgroup v2 directory to create a group per interpreter in,
+    with cgroup_memory_max and cgroup_cpu_max written to that group"""
+
+    def __init__(self, config=None):
+        self.log = logging.getLogger('ResourceLimits')
+        config = config or dict()
+        self.config = config
+        self.memory = config.get('memory_mb', 0) * 1024 * 1024
+        self.cpu_per_turn = config.get('cpu_seconds_per_turn', 0)
+        self.open_files = config.get('open_files', 0)
+        self.nice = config.get('nice', 0)
+        self.ionice = config.get('ionice')
+        self.cgroup = config.get('cgroup')
+        self.cgroup_memory_max = config.get('cgroup_memory_max')
+        self.cgroup_cpu_max = config.get('cgroup_cpu_max')
+
+    def wrap_command(self, command):
+        """Return COMMAND prefixed with ionice, if asked for"""
+        if not self.ionice:
+            return command
+        ionice = shutil.which('ionice')
+        if ionice is None:
+            self.log.warning('ionice not found, interpreter runs without it')
+            return command
+        if self.ionice == 'idle':
+            return [ionice, '-c', '3'] + command
+        level = self.ionice.partition(':')[2] or '4'
+        return [ionice, '-c', '2', '-n', level] + command
+
+    def apply(self, pid):
+        """Limit freshly started process PID. Limits are set from outside,
+        as preexec_fn is not safe in threaded programs. Returns cgroup
+        directory made for PID, or None"""
+        try:
+            if self.memory:
+                resource.prlimit(pid, resource.RLIMIT_AS,
+                                 (self.memory, self.memory))
+            if self.open_files:
+                resource.prlimit(pid, resource.RLIMIT_NOFILE,
+                                 (self.open_files, self.open_files))
+            if self.nice:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        except ProcessLookupError:
+            # died already, caller finds out soon enough
+            return None
+        if not self.cgroup:
+            return None
+        group = os.path.join(self.cgroup, 'frotzbot-%d' % pid)
+        try:
+            os.mkdir(group)
+            if self.cgroup_memory_max:
+                with open(os.path.join(group, 'memory.max'), 'w') as f:
+                    f.write(str(self.cgroup_memory_max))
+            if self.cgroup_cpu_max:
+                with open(os.path.join(group, 'cpu.max'), 'w') as f:
+                    f.write(str(self.cgroup_cpu_max))
+            with open(os.path.join(group, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError:
+            self.log.exception('Could not put interpreter %d into cgroup', pid)
+            try:
+                os.rmdir(group)
+            except OSError:
+                pass
+            return None
+        return group
+
+    def start_turn(self, pid):
+        """Let process PID use cpu_seconds_per_turn more seconds of CPU,
+        it gets SIGXCPU after that"""
+        if not self.cpu_per_turn:
+            return
+        used = get_cpu_seconds(pid)
+        if used is None:
+            return
+        try:
+            (_, hard) = resource.prlimit(pid, resource.RLIMIT_CPU)
+            soft = int(used + self.cpu_per_turn) + 1
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.prlimit(pid, resource.RLIMIT_CPU, (soft, hard))
+        except (ProcessLookupError, ValueError):
+            pass
+
+    def oom_killed(self, group):
+        """True if kernel killed something in cgroup GROUP for memory"""
+        try:
+            with open(os.path.join(group, 'memory.events'), 'r') as f:
+                for line in f:
+                    (name, _, value) = line.partition(' ')
+                    if name == 'oom_kill' and int(value) > 0:
+                        return True
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def exit_reason(self, returncode, group=None):
+        """Return (violated limit or None, text for the player)
+        explaining interpreter exit with RETURNCODE"""
+        if returncode == -signal.SIGXCPU:
+            return ('cpu', 'it used up its CPU time for one turn (%s s)'
+                    % self.cpu_per_turn)
+        if group is not None and self.oom_killed(group):
+            return ('memory', 'it ran out of memory')
+        if self.memory and returncode in (-signal.SIGABRT, -signal.SIGSEGV):
+            # failed allocation usually ends like this
+            return ('memory', 'it probably ran out of memory (limit is %d MB)'
+                    % (self.memory // (1024 * 1024)))
+        if returncode is not None and returncode < 0:
+            try:
+                name = signal.Signals(-returncode).name
+            except ValueError:
+                name = 'signal %d' % -returncode
+            return (None, 'it was killed by %s' % name)
+        return (None, 'it exited with status %s' % returncode)
+
+    def remove_group(self, group):
+        if group is None:
+            return
+        try:
+            os.rmdir(group)
+        except OSError:
+            self.log.warning('Could not remove cgroup %s', group)
+
+
+no_limits = ResourceLimits()
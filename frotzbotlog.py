@@ -0,0 +1,142 @@
+"""This module contains logging setup. Handlers only put records into
+a queue, a background thread formats and writes them to a rotating file"""
+
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+text_format = '[%(asctime)s-%(name)s-%(levelname)s]\n%(message)s'
+date_format = '%Y-%m-%d %H:%M:%S'
+
+# loggers for interpreter traffic and chat dialog, levels set separately
+interpreter_logger = 'interpreter'
+dialog_logger = 'dialog'
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    Stock QueueHandler formats message on the calling thread, so that
+    the record could be pickled. Here record never leaves the process"""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingFileHandler(logging.FileHandler):
+    """Writes to FILENAME, moving it aside once it grows past MAX_BYTES
+    or gets older than INTERVAL seconds (0 disables either).
+    Keeps BACKUP_COUNT old files named FILENAME.<time>"""
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=5):
+        super().__init__(filename, encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        try:
+            self.opened = os.stat(self.baseFilename).st_mtime
+        except FileNotFoundError:
+            self.opened = time.time()
+
+    def emit(self, record):
+        try:
+            if self.should_rollover():
+                self.rollover()
+        except Exception:
+            self.handleError(record)
+        super().emit(record)
+
+    def should_rollover(self):
+        if self.interval and time.time() - self.opened >= self.interval:
+            return True
+        if self.max_bytes and self.stream is not None:
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def rollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        name = '%s.%s' % (self.baseFilename, time.strftime('%Y%m%d-%H%M%S'))
+        suffix = 1
+        while os.path.exists(name):
+            name = '%s.%s.%d' % (self.baseFilename,
+                                 time.strftime('%Y%m%d-%H%M%S'), suffix)
+            suffix = suffix + 1
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, name)
+        if self.backup_count:
+            old = sorted(glob.glob(glob.escape(self.baseFilename) + '.*'),
+                         key=os.path.getmtime)
+            for path in old[:-self.backup_count]:
+                os.remove(path)
+        self.opened = time.time()
+        self.stream = self._open()
+
+
+def set_levels(log_config):
+    logging.getLogger().setLevel(log_config.get('level', 'INFO'))
+    logging.getLogger(interpreter_logger).setLevel(
+        log_config.get('interpreter_level', 'WARNING'))
+    logging.getLogger(dialog_logger).setLevel(
+        log_config.get('dialog_level', 'INFO'))
+    logging.getLogger('telegram').setLevel(logging.WARNING)
+
+
+def start_logging(log_config, log_queue=None):
+    """Send all logging through LOG_QUEUE (a new one if not given)
+    to a file described by LOG_CONFIG. Returns listener to stop at exit"""
+    if log_config.get('format') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(text_format, date_format)
+    file_handler = RotatingFileHandler(
+        log_config.get('file', 'frotzbot.log'),
+        max_bytes=log_config.get('max_bytes', 0),
+        interval=log_config.get('rotate_interval', 0),
+        backup_count=log_config.get('backup_count', 5))
+    file_handler.setFormatter(formatter)
+
+    if log_queue is None:
+        log_queue = queue.SimpleQueue()
+        handler = LazyQueueHandler(log_queue)
+    else:
+        handler = logging.handlers.QueueHandler(log_queue)
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    set_levels(log_config)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
+
+
+def attach_logging(log_config, log_queue):
+    """Send logging of a worker process to LOG_QUEUE of the process
+    that writes the file. Records get formatted here, as they are
+    pickled on their way"""
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    set_levels(log_config)
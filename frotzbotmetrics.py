@@ -0,0 +1,233 @@
+"""This module contains minimal Prometheus-style instrumentation:
+counters, latency histograms, gauges and an HTTP endpoint exposing them
+in Prometheus text format"""
+
+import http.server
+import logging
+import threading
+import time
+
+default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0, float('inf'))
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for (name, value) in pairs)
+
+
+class Counter():
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s counter' % self.name]
+        with self.lock:
+            for (labels, value) in self.values.items():
+                lines.append('%s%s %s' % (
+                    self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Timer():
+    """Context manager observing time spent inside it"""
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram():
+    def __init__(self, name, help_text, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [bucket counts..., sum, count]
+        self.values = dict()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = [0] * (len(self.buckets) + 2)
+                self.values[labels] = data
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] = data[i] + 1
+                    break
+            data[-2] = data[-2] + value
+            data[-1] = data[-1] + 1
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            items = [(labels, list(data)) for (labels, data) in self.values.items()]
+        for (labels, data) in items:
+            cumulative = 0
+            for (i, bound) in enumerate(self.buckets):
+                cumulative = cumulative + data[i]
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labelnames, labels, [('le', le)]),
+                    cumulative))
+            label_text = format_labels(self.labelnames, labels)
+            lines.append('%s_sum%s %f' % (self.name, label_text, data[-2]))
+            lines.append('%s_count%s %d' % (self.name, label_text, data[-1]))
+        return lines
+
+
+class Gauge():
+    """Gauge whose value is computed on scrape by FUNCTION.
+    FUNCTION returns a number, or a dict of label value tuples -> number"""
+
+    def __init__(self, name, help_text, function, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.labelnames = labelnames
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s gauge' % self.name]
+        try:
+            value = self.function()
+        except Exception:
+            logging.getLogger('frotzbotmetrics').exception(
+                'Failed to compute %s', self.name)
+            return lines
+        if not isinstance(value, dict):
+            value = {(): value}
+        for (labels, number) in value.items():
+            lines.append('%s%s %s' % (
+                self.name, format_labels(self.labelnames, labels), number))
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics = [x for x in self.metrics if x.name != name]
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.register(Histogram(
+    'frotzbot_handler_seconds',
+    'Time spent handling telegram update, by handler',
+    ('handler',)))
+reply_seconds = registry.register(Histogram(
+    'frotzbot_reply_seconds',
+    'Time spent in FrotzbotChat.reply, including sending'))
+turn_seconds = registry.register(Histogram(
+    'frotzbot_interpreter_turn_seconds',
+    'Interpreter round trip, from sending input to rendered output, by story',
+    ('story',)))
+decode_seconds = registry.register(Histogram(
+    'frotzbot_json_decode_seconds',
+    'Time spent decoding interpreter output'))
+render_seconds = registry.register(Histogram(
+    'frotzbot_render_seconds',
+    'Time spent rendering windows into HTML'))
+send_message_seconds = registry.register(Histogram(
+    'frotzbot_send_message_seconds',
+    'Time spent in telegram sendMessage calls'))
+interpreter_timeouts = registry.register(Counter(
+    'frotzbot_interpreter_timeouts_total',
+    'Turns that timed out waiting for interpreter, by story',
+    ('story',)))
+interpreter_exits = registry.register(Counter(
+    'frotzbot_interpreter_exits_total',
+    'Interpreters that exited on their own in the middle of a game',
+    ('story',)))
+prewarm_failures = registry.register(Counter(
+    'frotzbot_prewarm_failures_total',
+    'Interpreters started in advance that failed to print their opening, by story',
+    ('story',)))
+limit_violations = registry.register(Counter(
+    'frotzbot_interpreter_limit_violations_total',
+    'Interpreters stopped for exceeding resource limits',
+    ('story', 'limit')))
+
+
+def get_rss(pid):
+    """Resident set size of process PID in bytes, None if unknown"""
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('frotzbotmetrics').debug(format, *args)
+
+
+def start_server(port, host='127.0.0.1'):
+    """Serve metrics on http://HOST:PORT/metrics in background thread"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,141 @@
+"""This module contains a pool of pre-started interpreters, so that
+new games don't have to wait for the story file to load"""
+
+import collections
+import logging
+import os
+import queue
+import threading
+
+import frotzbotterp
+import frotzbotlimits
+import frotzbotmetrics
+
+# seconds a spare interpreter gets to print its opening,
+# unless interpreter_timeout is set
+default_opening_timeout = 30
+
+
+class FrotzbotPrewarmPool():
+    """Keeps interpreters that already loaded their story and printed
+    its opening text, ready to be handed out to new sessions.
+
+    Stories opt in with "prewarm": <number of spare interpreters> in their
+    config entry. PREWARM_LIMIT caps spare interpreters across all stories"""
+
+    def __init__(self, config):
+        self.log = logging.getLogger('FrotzbotPrewarmPool')
+        self.lock = threading.Lock()
+        self.stories = dict()
+        # story name -> deque of (backend, opening window texts)
+        self.pool = dict()
+        self.limit = 0
+        # interpreter, its args and limits spare interpreters were made with
+        self.defaults = None
+        # seconds to wait for opening of a spare interpreter
+        self.timeout = default_opening_timeout
+
+        self.refill_queue = queue.Queue()
+        self.refiller = threading.Thread(target=self.refill_loop,
+                                         name='prewarm-refill',
+                                         daemon=True)
+        self.refiller.start()
+        self.configure(config)
+
+    def configure(self, config):
+        """Use stories of CONFIG snapshot from now on. Spare interpreters
+        of stories whose config changed are thrown away"""
+        defaults = (config['interpreter'], config.get('interpreter_args', []),
+                    config.get('limits', {}))
+        stories = {game['name']: game for game in config['stories']
+                   if game.get('prewarm', 0) > 0 and
+                   not game.get('single_turn')}
+        stale = []
+        with self.lock:
+            for (name, spare) in self.pool.items():
+                if defaults != self.defaults or stories.get(name) != self.stories.get(name):
+                    stale.extend(spare)
+                    spare.clear()
+            self.defaults = defaults
+            (self.interpreter_path, self.interpreter_args, self.limits) = defaults
+            self.limit = config.get('prewarm_limit', 0)
+            self.timeout = config.get('interpreter_timeout') or default_opening_timeout
+            self.stories = stories
+            for name in self.stories:
+                self.pool.setdefault(name, collections.deque())
+        for (backend, _) in stale:
+            backend.close()
+        for name in self.stories:
+            self.refill_queue.put(name)
+
+    def take(self, game):
+        """Return (backend, opening from get_opening()) for GAME,
+        or None if there is no spare interpreter for it"""
+        name = game['name']
+        with self.lock:
+            spare = self.pool.get(name)
+            taken = spare.popleft() if spare else None
+        if name in self.stories:
+            self.refill_queue.put(name)
+        return taken
+
+    def spare_count(self):
+        with self.lock:
+            return sum(len(spare) for spare in self.pool.values())
+
+    def refill_loop(self):
+        while True:
+            name = self.refill_queue.get()
+            try:
+                self.refill(name)
+            except Exception:
+                self.log.exception('Failed to prewarm %s', name)
+
+    def refill(self, name):
+        while True:
+            with self.lock:
+                game = self.stories.get(name)
+                if game is None:
+                    return
+                spare = self.pool[name]
+                total = sum(len(x) for x in self.pool.values())
+                if (len(spare) >= game['prewarm'] or
+                        (self.limit and total >= self.limit)):
+                    return
+                terp_path = game.get('interpreter', self.interpreter_path)
+                terp_args = game.get('interpreter_args', self.interpreter_args)
+                limits = frotzbotlimits.limits_for(self.limits, game)
+                timeout = self.timeout
+
+            self.log.debug('Prewarming interpreter for %s', name)
+            story = os.path.basename(game['filename'])
+            try:
+                backend = frotzbotterp.FrotzbotBackend(
+                    terp_path,
+                    game['filename'],
+                    terp_args=terp_args,
+                    timeout=timeout,
+                    styles=game.get('styles'),
+                    limits=limits)
+            except OSError:
+                frotzbotmetrics.prewarm_failures.inc(story)
+                raise
+            try:
+                opening = backend.get_opening()
+            except (frotzbotterp.InterpreterTimeout, StopIteration,
+                    IOError, ValueError):
+                # a hung interpreter must not hold up refills of every
+                # other story, next take() tries again
+                self.log.warning('Interpreter for %s failed to print its '
+                                 'opening', name, exc_info=1)
+                frotzbotmetrics.prewarm_failures.inc(story)
+                backend.close()
+                return
+            with self.lock:
+                current = self.stories.get(name) is game
+                if current:
+                    self.pool[name].append((backend, opening))
+            if not current:
+                # config was reloaded meanwhile
+                backend.close()
+                return
@@ -0,0 +1,167 @@
+"""This module contains savefile store, which keeps saves of every chat
+in its own directory together with an index of them"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import frotzbotterp
+
+# save index in every chat directory
+index_name = 'index.json'
+
+# savedata/<chat_id>_<name>, as saves were kept before
+legacy_name_re = re.compile(r'^(-?\d+)_(.+)$')
+
+
+def safe_name(name):
+    """Turn whatever player typed into a file name, clear of the
+    index and its temporary file sharing the directory"""
+    name = name.strip().replace('/', '_').replace('\\', '_').lstrip('.')
+    if name == index_name or name.endswith('.tmp'):
+        name = name + '_'
+    return name or 'save'
+
+
+class ChatSaves():
+    """Saves of one chat, living in DIRECTORY"""
+
+    def __init__(self, directory, max_count=0, max_bytes=0):
+        self.log = logging.getLogger('ChatSaves')
+        self.directory = directory
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, index_name)
+        self.lock = threading.Lock()
+        # save name -> {'story', 'time' (unix time), 'size'}
+        self.index = dict()
+        try:
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.log.exception('Broken save index in %s, rebuilding', directory)
+            self.rebuild()
+
+    def rebuild(self):
+        """Recreate index from files on disk, stories are lost"""
+        self.index = dict()
+        for name in os.listdir(self.directory):
+            if name != index_name and not name.endswith('.tmp'):
+                stat = os.stat(os.path.join(self.directory, name))
+                self.index[name] = {'story': None, 'time': stat.st_mtime,
+                                    'size': stat.st_size}
+
+    def save_index(self):
+        """Write index to disk. Called with lock held"""
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def path(self, name):
+        """Path interpreter should save NAME to or restore it from"""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, safe_name(name))
+
+    def record(self, name, story, save_time=None):
+        """Note that save NAME of STORY was written,
+        and drop oldest saves beyond quota"""
+        name = safe_name(name)
+        try:
+            size = os.stat(os.path.join(self.directory, name)).st_size
+        except FileNotFoundError:
+            # interpreter failed to save or player cancelled
+            return
+        with self.lock:
+            self.index[name] = {'story': story,
+                                'time': save_time or time.time(),
+                                'size': size}
+            self.enforce_quota(keep=name)
+            self.save_index()
+
+    def enforce_quota(self, keep=None):
+        """Remove oldest saves over quota. Called with lock held"""
+        if not self.max_count and not self.max_bytes:
+            return
+        # interpreter's own autosave is not player's business
+        saves = sorted((entry['time'], name) for (name, entry) in self.index.items()
+                       if name != frotzbotterp.autosave_name)
+        count = len(saves)
+        total = sum(self.index[name]['size'] for (_, name) in saves)
+        for (_, name) in saves:
+            if name == keep:
+                continue
+            if ((not self.max_count or count <= self.max_count) and
+                    (not self.max_bytes or total <= self.max_bytes)):
+                break
+            self.log.info('Removing save %s over quota', name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total = total - self.index.pop(name)['size']
+            count = count - 1
+
+    def list(self):
+        """Return list of (name, index entry), newest first"""
+        with self.lock:
+            saves = [(name, dict(entry)) for (name, entry) in self.index.items()
+                     if name != frotzbotterp.autosave_name]
+        saves.sort(key=lambda x: x[1]['time'], reverse=True)
+        return saves
+
+
+class FrotzbotSaveStore():
+    """Keeps saves under ROOT/chats/<shard>/<chat id>/, shard being first
+    byte of chat id hash, so no directory grows too large.
+
+    Every chat keeps at most MAX_COUNT saves of at most MAX_BYTES total
+    (0 means no limit), oldest saves are removed first"""
+
+    def __init__(self, root='savedata', max_count=0, max_bytes=0):
+        self.log = logging.getLogger('FrotzbotSaveStore')
+        self.root = root
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.chats = dict()
+
+    def chat_directory(self, chat_id):
+        shard = hashlib.md5(str(chat_id).encode('utf-8')).hexdigest()[:2]
+        return os.path.join(self.root, 'chats', shard, str(chat_id))
+
+    def chat(self, chat_id):
+        """Return ChatSaves of CHAT_ID"""
+        with self.lock:
+            saves = self.chats.get(chat_id)
+            if saves is None:
+                saves = ChatSaves(self.chat_directory(chat_id),
+                                  self.max_count, self.max_bytes)
+                self.chats[chat_id] = saves
+            return saves
+
+    def migrate(self):
+        """Move saves from flat ROOT/<chat id>_<name> layout
+        into per chat directories"""
+        moved = 0
+        os.makedirs(self.root, exist_ok=True)
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                match = legacy_name_re.match(entry.name)
+                if match is None or not entry.is_file():
+                    continue
+                (chat_id, name) = match.groups()
+                saves = self.chat(int(chat_id))
+                mtime = entry.stat().st_mtime
+                os.replace(entry.path, saves.path(name))
+                saves.record(name, None, mtime)
+                moved = moved + 1
+        if moved:
+            self.log.info('Moved %d saves into per chat directories', moved)
@@ -0,0 +1,136 @@
+"""This module contains a scheduler, which runs handlers on a pool of
+worker threads while keeping messages from one chat in order"""
+
+import collections
+import concurrent.futures
+import heapq
+import logging
+import threading
+import time
+
+
+class FrotzbotScheduler():
+    """Runs jobs on a thread pool of WORKERS threads.
+
+    Jobs submitted with the same key run one at a time, in order of
+    submission. Jobs with different keys run in parallel"""
+
+    def __init__(self, workers=4):
+        self.log = logging.getLogger('FrotzbotScheduler')
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='frotzbot-worker')
+        self.lock = threading.Lock()
+        # key -> deque of (submit time, function, args, batch) waiting
+        # to run. Key is present while its jobs are queued or running
+        self.queues = dict()
+        # heap of (start time, key) for queues started with a delay
+        self.delayed = []
+        self.delayed_ready = threading.Condition(self.lock)
+        self.delay_thread = None
+
+        # metrics
+        self.jobs_done = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.items_batched = 0
+
+    def submit(self, key, function, *args):
+        job = (time.monotonic(), function, args, False)
+        with self.lock:
+            if key in self.queues:
+                # some worker is already busy with this key,
+                # it will pick the job up when done
+                self.queues[key].append(job)
+                return
+            self.queues[key] = collections.deque([job])
+        self.pool.submit(self.run_queue, key)
+
+    def submit_batch(self, key, function, item, *args, delay=0):
+        """Run FUNCTION(items, *ARGS) for KEY. ITEM joins items of
+        FUNCTION job still waiting in queue of KEY, if that is the last job
+        there. If KEY is idle, the job starts after DELAY seconds, so that
+        items coming meanwhile join it"""
+        with self.lock:
+            jobs = self.queues.get(key)
+            if jobs:
+                (_, last_function, last_args, batch) = jobs[-1]
+                if batch and last_function is function:
+                    last_args[0].append(item)
+                    self.items_batched = self.items_batched + 1
+                    return
+            job = (time.monotonic(), function, ([item],) + args, True)
+            if jobs is not None:
+                jobs.append(job)
+                return
+            self.queues[key] = collections.deque([job])
+            if delay:
+                self.start_later(key, delay)
+                return
+        self.pool.submit(self.run_queue, key)
+
+    def start_later(self, key, delay):
+        """Run queue of KEY after DELAY seconds. Called with lock held"""
+        heapq.heappush(self.delayed, (time.monotonic() + delay, key))
+        if self.delay_thread is None:
+            self.delay_thread = threading.Thread(target=self.delay_loop,
+                                                 name='frotzbot-delay',
+                                                 daemon=True)
+            self.delay_thread.start()
+        self.delayed_ready.notify()
+
+    def delay_loop(self):
+        with self.lock:
+            while True:
+                if not self.delayed:
+                    self.delayed_ready.wait()
+                    continue
+                wait = self.delayed[0][0] - time.monotonic()
+                if wait > 0:
+                    self.delayed_ready.wait(wait)
+                    continue
+                (_, key) = heapq.heappop(self.delayed)
+                self.pool.submit(self.run_queue, key)
+
+    def run_queue(self, key):
+        while True:
+            with self.lock:
+                jobs = self.queues[key]
+                if not jobs:
+                    del self.queues[key]
+                    return
+                (submitted, function, args, _) = jobs.popleft()
+                wait_time = time.monotonic() - submitted
+                self.jobs_done = self.jobs_done + 1
+                self.wait_time_total = self.wait_time_total + wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            try:
+                function(*args)
+            except Exception:
+                self.log.exception('Job for %s failed', key)
+
+    def queue_depth(self):
+        """Number of jobs waiting to run, not counting running ones"""
+        with self.lock:
+            return sum(len(jobs) for jobs in self.queues.values())
+
+    def stats(self):
+        depth = self.queue_depth()
+        with self.lock:
+            return {
+                'active_chats': len(self.queues),
+                'queue_depth': depth,
+                'jobs_done': self.jobs_done,
+                'wait_time_avg': (self.wait_time_total / self.jobs_done
+                                  if self.jobs_done else 0.0),
+                'wait_time_max': self.wait_time_max,
+                'items_batched': self.items_batched,
+            }
+
+    def shutdown(self):
+        with self.lock:
+            # don't keep delayed queues waiting
+            for (_, key) in self.delayed:
+                self.pool.submit(self.run_queue, key)
+            self.delayed = []
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,160 @@
+"""This module contains outbound message queue, which sends messages
+in order for every chat while keeping within telegram flood limits"""
+
+import collections
+import concurrent.futures
+import heapq
+import logging
+import threading
+import time
+
+import telegram.error
+
+
+class TokenBucket():
+    """Allows RATE events per second on average, with bursts up to CAPACITY"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens = self.tokens - 1
+
+
+class ChatQueue():
+    __slots__ = ('jobs', 'bucket', 'busy', 'not_before', 'failures')
+
+    def __init__(self, bucket):
+        self.jobs = collections.deque()
+        self.bucket = bucket
+        # a job is being sent right now, next one has to wait
+        self.busy = False
+        # time before which nothing is sent to this chat (RetryAfter)
+        self.not_before = 0.0
+        self.failures = 0
+
+
+class FrotzbotSender():
+    """Sends messages on background threads.
+
+    Messages to one chat go out one at a time and in order. Sending keeps
+    within GLOBAL_RATE messages per second overall and CHAT_RATE per chat,
+    waits as long as telegram asks on RetryAfter and retries network errors
+    up to MAX_RETRIES times"""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=5,
+                 workers=4, max_retries=5):
+        self.log = logging.getLogger('FrotzbotSender')
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.lock = threading.Condition()
+        self.chats = dict()
+        # heap of (time, chat id) for chats with jobs ready to be sent
+        self.ready = []
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='frotzbot-sender')
+        self.running = True
+        self.thread = threading.Thread(target=self.loop,
+                                       name='frotzbot-send-scheduler',
+                                       daemon=True)
+        self.thread.start()
+
+    def send(self, chat_id, function, kwargs):
+        """Queue FUNCTION(**KWARGS), e.g. bot.sendMessage, for CHAT_ID"""
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+                self.chats[chat_id] = chat
+            chat.jobs.append((function, kwargs))
+            if len(chat.jobs) == 1 and not chat.busy:
+                self.schedule(chat_id, chat)
+
+    def schedule(self, chat_id, chat):
+        heapq.heappush(self.ready, (chat.not_before, chat_id))
+        self.lock.notify_all()
+
+    def queue_depth(self):
+        with self.lock:
+            return sum(len(chat.jobs) for chat in self.chats.values())
+
+    def loop(self):
+        with self.lock:
+            while self.running:
+                if not self.ready:
+                    self.lock.wait()
+                    continue
+                now = time.monotonic()
+                (when, chat_id) = self.ready[0]
+                chat = self.chats[chat_id]
+                delay = max(when - now,
+                            chat.bucket.delay(now),
+                            self.global_bucket.delay(now))
+                if delay > 0:
+                    heapq.heapreplace(self.ready, (now + delay, chat_id))
+                    self.lock.wait(delay)
+                    continue
+                heapq.heappop(self.ready)
+                chat.bucket.take()
+                self.global_bucket.take()
+                chat.busy = True
+                job = chat.jobs[0]
+                self.pool.submit(self.deliver, chat_id, chat, job)
+
+    def deliver(self, chat_id, chat, job):
+        (function, kwargs) = job
+        retry_after = None
+        try:
+            function(**kwargs)
+        except telegram.error.BadRequest:
+            # resending won't help
+            self.log.exception('Telegram rejected message to %s', chat_id)
+        except telegram.error.RetryAfter as err:
+            self.log.warning('Flood limit hit for %s, retrying in %s s',
+                             chat_id, err.retry_after)
+            retry_after = float(err.retry_after)
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as err:
+            if chat.failures < self.max_retries:
+                retry_after = 2 ** chat.failures
+                self.log.warning('Sending to %s failed (%s), retrying in %s s',
+                                 chat_id, err, retry_after)
+            else:
+                self.log.error('Giving up sending to %s: %s', chat_id, err)
+        except Exception:
+            self.log.exception('Sending to %s failed', chat_id)
+
+        with self.lock:
+            chat.busy = False
+            if retry_after is not None:
+                chat.failures = chat.failures + 1
+                chat.not_before = time.monotonic() + retry_after
+            else:
+                chat.failures = 0
+                chat.jobs.popleft()
+            # idle chat stays, so its bucket remembers recent sends
+            if chat.jobs:
+                self.schedule(chat_id, chat)
+
+    def shutdown(self):
+        """Wait until queued messages are sent"""
+        with self.lock:
+            while any(chat.jobs for chat in self.chats.values()):
+                self.lock.wait(0.1)
+            self.running = False
+            self.lock.notify_all()
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,140 @@
+"""This module contains session manager, which keeps number of
+running interpreters in check by suspending least recently used ones"""
+
+import collections
+import logging
+import threading
+import time
+import weakref
+
+
+class FrotzbotSessionManager():
+    """Tracks live interpreters and suspends cold ones.
+
+    MAX_LIVE is a maximum number of running interpreters (0 means no limit),
+    IDLE_TIMEOUT is a number of seconds after which idle interpreter gets
+    suspended (0 means never).
+
+    Suspending waits for interpreter to save, so it goes through
+    RUN(key, function), e.g. scheduler.submit, instead of holding up
+    the chat whose interpreter pushed number of live ones over the limit,
+    or the job queue checking for idle ones"""
+
+    # key suspending jobs run with
+    run_key = 'session-manager'
+
+    def __init__(self, max_live=0, idle_timeout=0, run=None):
+        self.log = logging.getLogger('FrotzbotSessionManager')
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self.run = run
+        self.lock = threading.RLock()
+        # set while enforce_limit and suspend_idle jobs wait to run
+        self.enforce_pending = False
+        self.evict_pending = False
+        # id(backend) -> (weakref to backend, last activity time),
+        # least recently used first
+        self.sessions = collections.OrderedDict()
+
+    def add(self, backend):
+        key = id(backend)
+        ref = weakref.ref(backend, lambda r: self.forget(key))
+        with self.lock:
+            self.sessions[key] = (ref, time.monotonic())
+        self.request_enforce()
+
+    def forget(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def touch(self, backend):
+        key = id(backend)
+        with self.lock:
+            if key in self.sessions:
+                ref = self.sessions[key][0]
+                self.sessions[key] = (ref, time.monotonic())
+                self.sessions.move_to_end(key)
+        self.request_enforce()
+
+    def live_backends(self):
+        with self.lock:
+            backends = [ref() for (ref, _) in self.sessions.values()]
+        return [b for b in backends if b is not None and not b.suspended]
+
+    def live_count(self):
+        return len(self.live_backends())
+
+    def request_enforce(self):
+        """Have enforce_limit() run through RUN, unless it is about to"""
+        if not self.max_live:
+            return
+        if self.run is None:
+            self.enforce_limit()
+            return
+        with self.lock:
+            if self.enforce_pending:
+                return
+            self.enforce_pending = True
+        try:
+            self.run(self.run_key, self.enforce_limit)
+        except RuntimeError:
+            # shutting down
+            with self.lock:
+                self.enforce_pending = False
+
+    def enforce_limit(self):
+        """Suspend least recently used interpreters until there are
+        no more than max_live of them"""
+        with self.lock:
+            self.enforce_pending = False
+            candidates = [ref() for (ref, _) in self.sessions.values()]
+        if not self.max_live:
+            return
+        candidates = [b for b in candidates if b is not None and not b.suspended]
+        excess = len(candidates) - self.max_live
+        for backend in candidates:
+            if excess <= 0:
+                break
+            if self.try_suspend(backend):
+                excess = excess - 1
+
+    def evict_idle(self):
+        """Have suspend_idle() run through RUN, unless it is about to"""
+        if not self.idle_timeout:
+            return
+        if self.run is None:
+            self.suspend_idle()
+            return
+        with self.lock:
+            if self.evict_pending:
+                return
+            self.evict_pending = True
+        try:
+            self.run(self.run_key, self.suspend_idle)
+        except RuntimeError:
+            # shutting down
+            with self.lock:
+                self.evict_pending = False
+
+    def suspend_idle(self):
+        """Suspend interpreters idle for more than idle_timeout seconds"""
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            self.evict_pending = False
+            candidates = [ref() for (ref, last_used) in self.sessions.values()
+                          if last_used < deadline]
+        for backend in candidates:
+            if backend is not None and not backend.suspended:
+                self.try_suspend(backend)
+
+    def try_suspend(self, backend):
+        # interpreter busy with a turn is hot by definition, skip it
+        if not backend.lock.acquire(blocking=False):
+            return False
+        try:
+            return backend.suspend()
+        except Exception:
+            self.log.exception('Failed to suspend interpreter')
+            return False
+        finally:
+            backend.lock.release()
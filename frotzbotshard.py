@@ -0,0 +1,144 @@
+"""This module contains supervisor mode, which spreads chats across
+several worker processes. Supervisor polls telegram and routes every
+update to the worker owning its chat; workers run usual handlers with
+their own chats and interpreters"""
+
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import telegram
+from telegram.ext import Dispatcher, JobQueue, TypeHandler
+
+
+def hash_key(text):
+    """Hash that stays the same across processes, unlike hash()"""
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """Consistent hash ring mapping keys to NODES"""
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((hash_key('%s-%d' % (node, i)), node)
+                           for node in nodes for i in range(replicas))
+        self.hashes = [x[0] for x in self.ring]
+
+    def get(self, key):
+        index = bisect.bisect(self.hashes, hash_key(str(key)))
+        return self.ring[index % len(self.ring)][1]
+
+
+def worker_main(index, config_path, updates, log_queue):
+    """Entry point of worker process INDEX, handling updates from
+    UPDATES queue until it gets None. Logging goes to LOG_QUEUE"""
+    import frotzbot
+    import frotzbotlog
+
+    frotzbot.load_config(config_path)
+    config = frotzbot.config
+    frotzbotlog.attach_logging(config.get('logging', {}), log_queue)
+    # story store index is not shared between processes
+    frotzbot.apply_config(config.updated(story_cache_dir=os.path.join(
+        config.get('story_cache_dir', 'downloaded_stories'), 'shard-%d' % index)))
+    config = frotzbot.config
+    metrics_port = config.get('metrics_port')
+    frotzbot.start_services(metrics_port + 1 + index if metrics_port else None)
+
+    bot = telegram.Bot(config['api_key'], **frotzbot.bot_kwargs(config))
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1,
+                            job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    frotzbot.setup_dispatcher(dispatcher, job_queue, config_path)
+    # every worker watches config file itself
+    frotzbot.watch_config(config_path)
+    job_queue.start()
+    logging.info('Shard worker %d started', index)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        update = telegram.Update.de_json(json.loads(data), bot)
+        dispatcher.process_update(update)
+
+    job_queue.stop()
+    frotzbot.child_watcher.stop()
+    frotzbot.scheduler.shutdown()
+    frotzbot.sender.shutdown()
+    frotzbot.story_store.shutdown()
+    if frotzbot.transcript_store is not None:
+        frotzbot.transcript_store.shutdown()
+
+
+class FrotzbotSupervisor():
+    """Starts WORKER_COUNT worker processes, routes updates to them by
+    chat id and restarts workers that died"""
+
+    def __init__(self, config, config_path, log_queue):
+        self.log = logging.getLogger('FrotzbotSupervisor')
+        self.config = config
+        self.config_path = config_path
+        self.log_queue = log_queue
+        self.worker_count = config['shard_workers']
+        # fork doesn't mix well with threads, start workers from scratch
+        self.context = multiprocessing.get_context('spawn')
+        self.ring = HashRing(range(self.worker_count))
+        # queues outlive workers, so updates sent to a crashed worker
+        # are picked up by its replacement
+        self.queues = [self.context.Queue() for _ in range(self.worker_count)]
+        self.workers = [None] * self.worker_count
+
+    def start_worker(self, index):
+        worker = self.context.Process(
+            target=worker_main,
+            args=(index, self.config_path, self.queues[index],
+                  self.log_queue),
+            name='frotzbot-shard-%d' % index,
+            daemon=True)
+        worker.start()
+        self.workers[index] = worker
+        self.log.info('Started shard worker %d, pid %d', index, worker.pid)
+
+    def check_workers(self, context=None):
+        for (index, worker) in enumerate(self.workers):
+            if not worker.is_alive():
+                self.log.error('Shard worker %d died with exit code %r, '
+                               'restarting', index, worker.exitcode)
+                self.start_worker(index)
+
+    def route(self, update, context):
+        chat = update.effective_chat
+        key = chat.id if chat is not None else 0
+        self.queues[self.ring.get(key)].put(update.to_json())
+
+    def run(self):
+        for index in range(self.worker_count):
+            self.start_worker(index)
+
+        import frotzbot
+
+        updater = frotzbot.make_updater(self.config)
+        updater.dispatcher.add_handler(TypeHandler(telegram.Update, self.route))
+        updater.job_queue.run_repeating(self.check_workers, interval=1.0)
+
+        frotzbot.start_updates(updater, self.config)
+        updater.idle()
+
+        for updates in self.queues:
+            updates.put(None)
+        deadline = time.monotonic() + 10
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                worker.terminate()
+
+
+def run_supervisor(config, config_path, log_queue):
+    FrotzbotSupervisor(config, config_path, log_queue).run()
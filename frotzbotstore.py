@@ -0,0 +1,193 @@
+"""This module contains store for story files uploaded by players.
+Files are kept once per content, chats get hardlinks to them"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+
+chunk_size = 65536
+# seconds a story download may stall before it is given up
+download_timeout = 60
+
+
+class FrotzbotStoryStore():
+    """Content-addressed story file store under ROOT.
+
+    Every distinct file is stored once as objects/<sha256>, and telegram's
+    file_unique_id remembers which object an upload is, so a story uploaded
+    again is not downloaded again. Chats get hardlinks named the old way,
+    <chat id>_<file name>. Downloads run on DOWNLOAD_WORKERS threads.
+    Least recently used files are removed when they take more than QUOTA
+    bytes (0 means no limit), except those IN_USE() returns paths for
+    and those pinned for chats that are yet to start playing them"""
+
+    def __init__(self, root='downloaded_stories', quota=0,
+                 download_workers=2, in_use=None):
+        self.log = logging.getLogger('FrotzbotStoryStore')
+        self.root = root
+        self.quota = quota
+        self.in_use = in_use
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # sha256 -> {'size', 'used' (unix time), 'links' (paths)}
+        self.objects = dict()
+        # telegram file_unique_id -> sha256
+        self.unique_ids = dict()
+        # chat id -> link path fetched for it, kept until its game starts
+        self.pinned = dict()
+        self.load_index()
+        self.downloader = concurrent.futures.ThreadPoolExecutor(
+            max_workers=download_workers, thread_name_prefix='story-download')
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            self.log.exception('Story index is broken, starting empty')
+            return
+        # forget whatever went missing behind our back
+        self.objects = {sha: entry for (sha, entry) in index['objects'].items()
+                        if os.path.exists(self.object_path(sha))}
+        self.unique_ids = {uid: sha for (uid, sha) in index['unique_ids'].items()
+                           if sha in self.objects}
+
+    def save_index(self):
+        """Write index to disk. Called with lock held"""
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'objects': self.objects,
+                       'unique_ids': self.unique_ids}, f)
+        os.replace(temp_path, self.index_path)
+
+    def object_path(self, sha):
+        return os.path.join(self.objects_dir, sha)
+
+    def fetch(self, bot, document, chat_id):
+        """Start getting DOCUMENT for CHAT_ID. Returns future
+        of path to the story file for this chat, which stays pinned
+        until unpin()"""
+        link_path = os.path.join(self.root,
+                                 '%s_%s' % (chat_id, os.path.basename(document.file_name)))
+        with self.lock:
+            self.pinned[chat_id] = link_path
+            sha = self.unique_ids.get(document.file_unique_id)
+            if sha is not None:
+                self.link(sha, link_path)
+                self.save_index()
+                future = concurrent.futures.Future()
+                future.set_result(link_path)
+                return future
+        return self.downloader.submit(self.download, bot, document, link_path)
+
+    def download(self, bot, document, link_path):
+        """Stream DOCUMENT into the store, hashing it on the way"""
+        file = bot.getFile(document.file_id)
+        digest = hashlib.sha256()
+        size = 0
+        if file.file_path.startswith(('http://', 'https://')):
+            source = urllib.request.urlopen(file.file_path,
+                                            timeout=download_timeout)
+        else:
+            # local Bot API server hands out paths on its disk
+            source = open(file.file_path, 'rb')
+        (fd, temp_path) = tempfile.mkstemp(dir=self.root, prefix='.download-')
+        try:
+            with source, os.fdopen(fd, 'wb') as out:
+                chunk = source.read(chunk_size)
+                while chunk:
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size = size + len(chunk)
+                    chunk = source.read(chunk_size)
+
+            sha = digest.hexdigest()
+            with self.lock:
+                if sha in self.objects:
+                    # same story uploaded under another file_unique_id
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, self.object_path(sha))
+                    self.objects[sha] = {'size': size, 'used': time.time(),
+                                         'links': []}
+                    self.log.info('Stored story %s, %d bytes', sha, size)
+                self.unique_ids[document.file_unique_id] = sha
+                self.link(sha, link_path)
+                self.evict(keep=sha)
+                self.save_index()
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return link_path
+
+    def link(self, sha, link_path):
+        """Point LINK_PATH to object SHA. Called with lock held"""
+        entry = self.objects[sha]
+        entry['used'] = time.time()
+        temp_path = link_path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        os.link(self.object_path(sha), temp_path)
+        os.replace(temp_path, link_path)
+        if link_path not in entry['links']:
+            entry['links'].append(link_path)
+        # same chat and file name could have pointed to another story
+        for (other_sha, other) in self.objects.items():
+            if other_sha != sha and link_path in other['links']:
+                other['links'].remove(link_path)
+
+    def pin(self, chat_id, link_path):
+        """Keep LINK_PATH from eviction until CHAT_ID starts its game"""
+        with self.lock:
+            self.pinned[chat_id] = link_path
+
+    def unpin(self, chat_id):
+        """Chat CHAT_ID started its game, or gave up on it. Once running,
+        game is kept by IN_USE()"""
+        with self.lock:
+            self.pinned.pop(chat_id, None)
+
+    def disk_usage(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.objects.values())
+
+    def evict(self, keep=None):
+        """Remove least recently used objects until they fit in quota.
+        Called with lock held"""
+        if not self.quota:
+            return
+        total = sum(entry['size'] for entry in self.objects.values())
+        if total <= self.quota:
+            return
+        in_use = set(self.in_use()) if self.in_use is not None else set()
+        in_use.update(self.pinned.values())
+        for sha in sorted(self.objects, key=lambda x: self.objects[x]['used']):
+            if total <= self.quota:
+                break
+            entry = self.objects[sha]
+            if sha == keep or in_use.intersection(entry['links']):
+                continue
+            self.log.info('Evicting story %s, %d bytes', sha, entry['size'])
+            for path in entry['links'] + [self.object_path(sha)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            del self.objects[sha]
+            self.unique_ids = {uid: x for (uid, x) in self.unique_ids.items()
+                               if x != sha}
+            total = total - entry['size']
+
+    def shutdown(self):
+        self.downloader.shutdown(wait=True)
@@ -1,7 +1,20 @@
+import base64
 import json
+import re
+import select
+import selectors
 import subprocess
-import splitstream
+import codecs
+import collections
 import logging
+import threading
+import queue
+import os
+import time
+
+import frotzbotmetrics
+import frotzbotlimits
+import frotzbothandoff
 
 frotzbot_remglk_styles = {
     'emphasized': 'i',
@@ -12,25 +25,622 @@ frotzbot_remglk_styles = {
     'note': 'i'
 }
 
+# name of the savefile used to suspend idle interpreters
+autosave_name = '__autosave__'
+# seconds interpreter gets for every step of suspending or resuming,
+# or interpreter_timeout if that is longer. Cutting a save short would
+# leave the game in its file name dialog
+save_restore_timeout = 30
+# key presses sent to get past title screens of a resumed game
+# on the way to its command prompt
+resume_key_presses = 3
+
+# number of last stderr lines kept for diagnostics, and bytes kept of each
+stderr_tail_lines = 20
+stderr_line_limit = 1024
+
+# what is left of JSON output cut in the middle of a token
+json_partial_token_re = re.compile(r'[\w.+\-\\]*')
+
+# interpreter input and output, its level is set apart from the rest
+traffic_log = logging.getLogger('interpreter')
+
+# seconds single turn interpreter gets to save and exit after output
+single_turn_exit_timeout = 10
+
+# arguments making RemGlk interpreter run a single turn, saving its state
+# into {autodir} on exit and restoring it on start (glulxe syntax)
+default_single_turn_args = ['-singleturn', '-autosave', '-autorestore',
+                            '-autodir', '{autodir}']
+
 default_init_string = '{ \"type\": \"init\", \"gen\": 0, \"metrics\": { \"width\":60, \"height\":100 }, \"support\": [ \"hyperlinks\", \"graphics\" ] }'
 
 
+class InterpreterTimeout(Exception):
+    """Raised when interpreter did not respond in time.
+    Its output will be picked up by the next turn"""
+    pass
+
+
+class RestoreFailed(Exception):
+    """Raised when suspended game could not be restored.
+    Its save is kept, and the next turn tries again"""
+    pass
+
+
+class JsonStreamReader():
+    """Iterator over JSON objects coming from file descriptor FD.
+
+    Reads output in chunks of up to CHUNK_SIZE bytes and decodes every
+    object with raw_decode. Whatever is left after the last complete
+    object is kept until the rest of it arrives. Malformed object
+    raises ValueError.
+
+    UNREAD is output read from FD before, by another reader. Once STOP_FD
+    becomes readable, iteration stops without reading FD any further"""
+
+    def __init__(self, fd, chunk_size=65536, unread=b'', stop_fd=None):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.stop_fd = stop_fd
+        self.stopped = False
+        if stop_fd is not None:
+            # poll, as select can't take fds over 1024
+            self.poller = select.poll()
+            self.poller.register(fd, select.POLLIN)
+            self.poller.register(stop_fd, select.POLLIN)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = self.text_decoder.decode(unread)
+        self.pos = 0
+        # set when buffer was last found to hold an incomplete object
+        self.incomplete_seen = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        obj = self.decode()
+        while obj is None:
+            if self.stop_fd is not None:
+                # poll releases the GIL while waiting for interpreter
+                events = self.poller.poll()
+                if any(fd == self.stop_fd for (fd, _) in events):
+                    self.stopped = True
+                    raise StopIteration()
+            # os.read releases the GIL while waiting for interpreter
+            chunk = os.read(self.fd, self.chunk_size)
+            if not chunk:
+                obj = self.decode()
+                if obj is None:
+                    raise StopIteration()
+                return obj
+            text = self.text_decoder.decode(chunk)
+            self.buffer = self.buffer[self.pos:] + text
+            self.pos = 0
+            # only closing bracket can complete an object. Newline that
+            # follows an object found incomplete gets another try too
+            if ('}' in text or ']' in text or
+                    (self.incomplete_seen and not text.strip())):
+                obj = self.decode()
+        return obj
+
+    def unread(self):
+        """Output read from FD but not returned yet, as bytes"""
+        (pending, _) = self.text_decoder.getstate()
+        return self.buffer[self.pos:].encode('utf-8') + pending
+
+    def decode(self):
+        """Next complete object in buffer, None if there is none yet"""
+        buffer = self.buffer
+        pos = self.pos
+        length = len(buffer)
+        # skip whitespace and anything that can't start an object
+        while pos < length and buffer[pos] not in '{[':
+            pos = pos + 1
+        self.pos = pos
+        if pos == length:
+            return None
+        start = time.perf_counter()
+        try:
+            (obj, end) = self.decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as err:
+            if not self.incomplete(err):
+                raise
+            # wait for more output
+            self.incomplete_seen = True
+            return None
+        frotzbotmetrics.decode_seconds.observe(time.perf_counter() - start)
+        self.pos = end
+        self.incomplete_seen = False
+        return obj
+
+    def incomplete(self, err):
+        """Whether decoding error ERR only means output was cut short"""
+        if err.pos >= len(self.buffer) or err.msg.startswith('Unterminated string'):
+            return True
+        # cut in the middle of a number, a literal or an escape
+        return json_partial_token_re.fullmatch(self.buffer, err.pos) is not None
+
+
+def escape_html(text):
+    # chained str.replace beats str.translate with multi-char table
+    # by about 4x on typical story text
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class StyleRenderer():
+    """Turns RemGlk styled runs into telegram HTML.
+
+    STYLES extends frotzbot_remglk_styles, mapping RemGlk style names to
+    HTML tags (or None to leave style unformatted)"""
+    __slots__ = ('tags',)
+
+    def __init__(self, styles=None):
+        styles = dict(frotzbot_remglk_styles, **(styles or {}))
+        self.tags = {name: ('<%s>' % tag, '</%s>' % tag)
+                     for (name, tag) in styles.items() if tag}
+
+    def render(self, contents):
+        """Render list of runs. Adjacent unstyled runs are escaped together"""
+        tags = self.tags
+        if len(contents) == 1:
+            # status lines are mostly one run
+            content = contents[0]
+            text = escape_html(content.get('text', ''))
+            tag = tags.get(content.get('style'))
+            return text if tag is None else tag[0] + text + tag[1]
+        parts = []
+        plain = None
+        for content in contents:
+            text = content.get('text', '')
+            tag = tags.get(content.get('style'))
+            if tag is None:
+                plain = text if plain is None else plain + text
+            else:
+                if plain is not None:
+                    parts.append(escape_html(plain))
+                    plain = None
+                parts.append(tag[0] + escape_html(text) + tag[1])
+        if plain is not None:
+            if not parts:
+                return escape_html(plain)
+            parts.append(escape_html(plain))
+        return ''.join(parts)
+
+    def render_lines(self, lines, skip_input=None):
+        """Render buffer window LINES into one text, separated by newlines,
+        leaving out 'input' styled runs equal to SKIP_INPUT. Unstyled runs
+        are escaped together across lines. Returns (text, last line
+        printed), both None if there was nothing to print"""
+        tags = self.tags
+        parts = []
+        plain = []
+        last = None
+        for line in lines:
+            if 'content' not in line and line:
+                # e.g. bare 'append' marker, nothing to print
+                continue
+            if last is not None:
+                plain.append('\n')
+            last = line
+            for content in line.get('content', ()):
+                text = content.get('text', '')
+                style = content.get('style')
+                if skip_input is not None and style == 'input' and text == skip_input:
+                    continue
+                tag = tags.get(style)
+                if tag is None:
+                    plain.append(text)
+                else:
+                    if plain:
+                        parts.append(escape_html(''.join(plain)))
+                        plain = []
+                    parts.append(tag[0] + escape_html(text) + tag[1])
+        if last is None:
+            return (None, None)
+        if plain:
+            parts.append(escape_html(''.join(plain)))
+        return (''.join(parts), last)
+
+
+default_renderer = StyleRenderer()
+
+
+def get_styled_text(content):
+    return default_renderer.render([content])
+
+
+class GridWindow():
+    """Text grid window (status bar and such).
+    Keeps every line rendered, partial updates replace lines in place"""
+    __slots__ = ('id', 'type', 'lines', 'raw_lines', 'renderer', 'dirty')
+
+    def __init__(self, window_id, height=0, renderer=default_renderer):
+        self.id = window_id
+        self.type = 'grid'
+        self.lines = [''] * height
+        # line contents as received, to skip rendering unchanged lines
+        self.raw_lines = [None] * height
+        self.renderer = renderer
+        self.dirty = False
+
+    def resize(self, height):
+        if height > len(self.lines):
+            self.lines.extend([''] * (height - len(self.lines)))
+            self.raw_lines.extend([None] * (height - len(self.raw_lines)))
+        elif height < len(self.lines):
+            del self.lines[height:]
+            del self.raw_lines[height:]
+            self.dirty = True
+
+    def apply(self, content_update, filter_input_echo_str=None):
+        if 'lines' not in content_update:
+            return
+        lines = self.lines
+        raw_lines = self.raw_lines
+        for line in content_update['lines']:
+            if line is None or 'content' not in line:
+                continue
+            index = line['line']
+            if index >= len(lines):
+                self.resize(index + 1)
+            content = line['content']
+            if raw_lines[index] == content:
+                # status bars rarely change
+                continue
+            raw_lines[index] = content
+            text = self.renderer.render(content)
+            if lines[index] != text:
+                lines[index] = text
+                self.dirty = True
+
+    def export(self):
+        return {'id': self.id, 'type': self.type, 'lines': self.lines,
+                'raw_lines': self.raw_lines, 'dirty': self.dirty}
+
+    def render(self):
+        self.dirty = False
+        text = '\n'.join(self.lines).rstrip('\n')
+        return text + '\n' if text else ''
+
+
+class BufferWindow():
+    """Text buffer window (main story text).
+    Collects paragraphs printed since last render"""
+    __slots__ = ('id', 'type', 'pending', 'last_line', 'renderer', 'dirty')
+
+    def __init__(self, window_id, window_type='buffer', renderer=default_renderer):
+        self.id = window_id
+        self.type = window_type
+        self.pending = []
+        # runs of the last line printed, to tell command prompt
+        # from questions asked by the game
+        self.last_line = []
+        self.renderer = renderer
+        self.dirty = False
+
+    def apply(self, content_update, filter_input_echo_str=None):
+        if content_update.get('clear'):
+            self.pending = []
+            self.dirty = True
+        if 'text' not in content_update:
+            if 'clear' not in content_update:
+                self.pending.append(
+                    'WARNING: UNKNOWN UPDATE TYPE ' + str(content_update))
+                self.dirty = True
+            return
+
+        (text, last) = self.renderer.render_lines(content_update['text'],
+                                                  filter_input_echo_str)
+        if last is None:
+            return
+        self.pending.append(text)
+        contents = last.get('content', [])
+        # runs only, their text is looked at when it matters
+        self.last_line = (self.last_line + contents if last.get('append')
+                          else contents)
+        self.dirty = True
+
+    def export(self):
+        return {'id': self.id, 'type': self.type, 'pending': self.pending,
+                'last_line': self.last_line, 'dirty': self.dirty}
+
+    def render(self):
+        self.dirty = False
+        if not self.pending:
+            return ''
+        text = '\n'.join(self.pending) + '\n'
+        self.pending = []
+        return text
+
+
+def restore_window(data, renderer=default_renderer):
+    """Window from its export()"""
+    if data['type'] == 'grid':
+        window = GridWindow(data['id'], 0, renderer)
+        window.lines = data['lines']
+        window.raw_lines = data['raw_lines']
+    else:
+        window = BufferWindow(data['id'], data['type'], renderer)
+        window.pending = data['pending']
+        window.last_line = data.get('last_line', [])
+    window.dirty = data['dirty']
+    return window
+
+
+def make_window(window_json, renderer=default_renderer):
+    if window_json.get('type') == 'grid':
+        return GridWindow(window_json['id'], window_json.get('gridheight', 0),
+                          renderer)
+    else:
+        return BufferWindow(window_json['id'], window_json.get('type'),
+                            renderer)
+
+
+def read_output(json_iter, output):
+    """Move interpreter output from JSON_ITER to OUTPUT queue.
+    Runs in its own thread, and must not hold a reference to backend,
+    otherwise backend would never get garbage collected"""
+    try:
+        for out_json in json_iter:
+            output.put(out_json)
+    except IOError:
+        # pipe was closed under our feet
+        logging.getLogger('FrotzbotBackend').debug(
+            'Interpreter output reader stopped', exc_info=1)
+    except ValueError:
+        # interpreter spat garbage
+        logging.getLogger('FrotzbotBackend').warning(
+            'Interpreter output is not valid JSON', exc_info=1)
+    if not json_iter.stopped:
+        # None marks end of output
+        output.put(None)
+
+
+class StderrTail():
+    """Last lines one interpreter wrote to stderr, in LINES deque"""
+    __slots__ = ('lines', 'partial', 'skipping')
+
+    def __init__(self, lines):
+        self.lines = lines
+        # start of line not finished yet, and whether the rest of a line
+        # cut at stderr_line_limit is being dropped
+        self.partial = b''
+        self.skipping = False
+
+    def add_line(self, line):
+        text = line.decode('utf-8', 'replace')
+        self.lines.append(text)
+        traffic_log.debug('INTERPRETER STDERR: %s', text)
+
+    def feed(self, chunk):
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if not self.skipping:
+                self.add_line(line[:stderr_line_limit])
+            self.skipping = False
+        # runaway line shouldn't eat memory
+        if len(self.partial) > stderr_line_limit:
+            if not self.skipping:
+                self.add_line(self.partial[:stderr_line_limit])
+            self.skipping = True
+            self.partial = b''
+
+    def finish(self):
+        if self.partial and not self.skipping:
+            self.add_line(self.partial)
+        self.partial = b''
+
+
+class StderrReader():
+    """Reads stderr of every interpreter on one background thread, so
+    none of them blocks on full pipe and each keeps its last lines,
+    without a thread per interpreter"""
+
+    def __init__(self):
+        self.log = logging.getLogger('StderrReader')
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        # fd -> StderrTail
+        self.tails = dict()
+        # wakes selector up when there is a new fd to wait on
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.read_loop,
+                                       name='terp-stderr', daemon=True)
+        self.thread.start()
+
+    def add(self, fd, lines):
+        """Read stderr pipe FD from now on, keeping last lines in LINES"""
+        os.set_blocking(fd, False)
+        with self.lock:
+            self.tails[fd] = StderrTail(lines)
+            self.selector.register(fd, selectors.EVENT_READ)
+        try:
+            os.write(self.wakeup_write, b'w')
+        except BlockingIOError:
+            # wakeup is pending anyway
+            pass
+
+    def remove(self, fd, drain=False):
+        """Stop reading FD, having read whatever is left in it if DRAIN"""
+        with self.lock:
+            if fd not in self.tails:
+                # it ended already
+                return
+            if drain:
+                self.read_locked(fd)
+            self.forget_locked(fd)
+
+    def read_loop(self):
+        while True:
+            for (key, _) in self.selector.select():
+                if key.fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+                with self.lock:
+                    if key.fd in self.tails and not self.read_locked(key.fd):
+                        self.forget_locked(key.fd)
+
+    def read_locked(self, fd):
+        """Read what FD has to give. Returns False once it ended.
+        Called with lock held"""
+        tail = self.tails[fd]
+        try:
+            while True:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    return False
+                tail.feed(chunk)
+        except BlockingIOError:
+            return True
+        except OSError:
+            self.log.debug('Interpreter stderr reader stopped', exc_info=1)
+            return False
+
+    def forget_locked(self, fd):
+        self.tails.pop(fd).finish()
+        self.selector.unregister(fd)
+
+
+# shared by every backend, started with the first one
+stderr_reader = None
+stderr_reader_lock = threading.Lock()
+
+
+def get_stderr_reader():
+    global stderr_reader
+    with stderr_reader_lock:
+        if stderr_reader is None:
+            stderr_reader = StderrReader()
+        return stderr_reader
+
+
 class FrotzbotBackend():
+    # attributes handed to new bot process as they are
+    handoff_fields = ('terp_path', 'game_path', 'savefile_prefix', 'terp_args',
+                      'terp_init_string', 'timeout', 'styles', 'split_status',
+                      'status_text', 'pending_save', 'waiting', 'last_input',
+                      'suspended', 'suspendable', 'saved_status', 'prompt',
+                      'special_input', 'gen', 'cpu_used', 'cgroup')
+
     def __init__(self,
                  arg_frotz_path,
                  arg_game_path,
                  savefile_prefix='',
                  terp_args=None,
-                 terp_init_string=default_init_string):
+                 terp_init_string=default_init_string,
+                 session_manager=None,
+                 timeout=None,
+                 styles=None,
+                 split_status=False,
+                 savefiles=None,
+                 limits=None,
+                 transcript=None):
         self.log = logging.getLogger('FrotzbotBackend')
-        self.log.setLevel(logging.DEBUG)
 
         self.terp_path = arg_frotz_path
         self.game_path = arg_game_path
         self.savefile_prefix = savefile_prefix
+        # ChatSaves where fileref prompts point to, SAVEFILE_PREFIX is
+        # used when there is none
+        self.savefiles = savefiles
+        # save name the interpreter is writing right now
+        self.pending_save = None
+        # ChatTranscript every turn is recorded to, if any
+        self.transcript = transcript
+        self.terp_args = list(terp_args) if terp_args is not None else []
+        self.terp_init_string = terp_init_string
+        self.session_manager = session_manager
+        self.limits = limits if limits is not None else frotzbotlimits.no_limits
+        # cgroup of running interpreter, if limits put it into one
+        self.cgroup = None
+        # CPU seconds used by interpreter processes that already exited
+        self.cpu_used = 0.0
+        # plain dict, config snapshot's one can't be dumped for handoff
+        self.styles = dict(styles) if styles else None
+        self.renderer = StyleRenderer(styles) if styles else default_renderer
+        # seconds to wait for interpreter output, None to wait forever
+        self.timeout = timeout
+        # keep grid windows out of get() output, see take_status()
+        self.split_status = split_status
+        # grid windows text not yet picked up by take_status()
+        self.status_text = None
+        # set when last turn timed out and its output is yet to be read
+        self.waiting = False
+        self.last_input = None
+        # guards interpreter pipes against concurrent turns and eviction
+        self.lock = threading.RLock()
+        # set when interpreter was stopped by session manager
+        # and its state lives in autosave file
+        self.suspended = False
+        # set when interpreter refused to save, so it never gets evicted
+        self.suspendable = True
+        # status windows text when suspended, to tell restored game
+        # from a new one
+        self.saved_status = None
+        # FrotzbotChildWatcher told about every interpreter started,
+        # see watch_exit()
+        self.child_watcher = None
+        self.terp_proc = None
+
+        self.spawn()
+
+        # interpreter state is defined as
+        # windows indexed by id, in layout order
+        self.windows = dict()
+        # window list of the last layout update, RemGlk repeats it
+        # whenever it rearranges windows
+        self.layout = None
+        # current prompt, and whether it came as specialinput
+        self.prompt = None
+        self.special_input = False
+        # and current state number
+        self.gen = 0
+
+        if self.session_manager is not None:
+            self.session_manager.add(self)
+
+    def get_opening(self):
+        """Like get(), for interpreter started in advance, before it is
+        known whether status goes apart. Returns list of (window type or
+        None, text), for attach()"""
+        errors = self.receive()
+        with frotzbotmetrics.render_seconds.time():
+            opening = [(None, text) for text in errors]
+            opening.extend((window.type, window.render())
+                           for window in self.windows.values() if window.dirty)
+        if self.special_input:
+            opening.append((None, 'ENTER SAVE FILE NAME'))
+        return opening
+
+    def attach(self, savefile_prefix, session_manager=None, timeout=None,
+               split_status=False, savefiles=None, transcript=None,
+               opening=()):
+        """Hand over interpreter started in advance to a chat.
+        Returns texts of OPENING from get_opening() to show in chat"""
+        self.savefile_prefix = savefile_prefix
+        self.savefiles = savefiles
+        self.transcript = transcript
+        self.timeout = timeout
+        self.split_status = split_status
+        if split_status:
+            self.status_text = self.render_status()
+        self.session_manager = session_manager
+        if self.session_manager is not None:
+            self.session_manager.add(self)
+        # with SPLIT_STATUS grid windows show in status message instead
+        return [text for (window_type, text) in opening
+                if not (split_status and window_type == 'grid')]
+
+    def spawn(self, send_init=True):
         try:
             self.terp_proc = subprocess.Popen(
-                [self.terp_path] + terp_args + [self.game_path],
+                self.limits.wrap_command(
+                    [self.terp_path] + self.terp_args + [self.game_path]),
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
@@ -44,26 +654,58 @@ class FrotzbotBackend():
             self.terp_proc = None
             raise err
         else:
-            self.log.debug("INTERPRETER IN: %s", terp_init_string)
-            self.send_raw(terp_init_string)
-            # get iterator over json output stream
-            self.json_iter = map(lambda x: json.loads(x.decode('utf-8')),
-                                 splitstream.splitfile(self.terp_proc.stdout,
-                                                       format="json",
-                                                       bufsize=1))
-
-            # interpreter state is defined as
-            # an array of windows
-            self.windows = []
-            # current prompt
-            self.prompt = None
-            # and current state number
-            self.gen = 0
+            self.cgroup = self.limits.apply(self.terp_proc.pid)
+            self.watch_process()
+            if send_init:
+                traffic_log.debug('INTERPRETER IN: %s', self.terp_init_string)
+                self.send_raw(self.terp_init_string)
+            self.start_readers()
+
+    def start_readers(self, pending_output=(), unread=b''):
+        """Read interpreter output and stderr on background threads.
+        PENDING_OUTPUT goes first, ahead of whatever interpreter prints,
+        and UNREAD is its output read by previous bot process but not
+        decoded yet"""
+        # readers stop once this becomes readable, see stop_readers()
+        (self.stop_read, self.stop_write) = os.pipe()
+        # get iterator over json output stream
+        self.json_iter = JsonStreamReader(self.terp_proc.stdout.fileno(),
+                                          unread=unread,
+                                          stop_fd=self.stop_read)
+        # read it in background, so waiting for output can time out
+        self.output = queue.Queue()
+        for out_json in pending_output:
+            self.output.put(out_json)
+        self.reader = threading.Thread(
+            target=read_output,
+            args=(self.json_iter, self.output),
+            name='terp-reader-%d' % self.terp_proc.pid,
+            daemon=True)
+        self.reader.start()
+        # nobody reads stderr otherwise, and chatty interpreter
+        # would block once pipe buffer fills up
+        self.stderr_tail = collections.deque(maxlen=stderr_tail_lines)
+        get_stderr_reader().add(self.terp_proc.stderr.fileno(), self.stderr_tail)
+
+    def stop_readers(self, timeout=None, drain_stderr=False):
+        """Make readers stop reading interpreter pipes, and wait for
+        output reader for up to TIMEOUT seconds. With DRAIN_STDERR,
+        whatever is left in stderr pipe goes to stderr tail first"""
+        if self.stop_write is None:
+            # stopped already
+            return
+        os.write(self.stop_write, b'x')
+        get_stderr_reader().remove(self.terp_proc.stderr.fileno(), drain_stderr)
+        self.reader.join(timeout)
+        os.close(self.stop_read)
+        os.close(self.stop_write)
+        self.stop_write = None
 
     def process_update(self, json_update, filter_input_echo_str=None):
         # first, refresh windows and input info
         # TODO what TODO with multiple inputs? Is that even possible?
-        self.windows = json_update.get('windows', self.windows)
+        if 'windows' in json_update:
+            self.update_windows(json_update['windows'])
         self.gen = json_update.get('gen', self.gen)
 
         if 'input' in json_update:
@@ -71,77 +713,135 @@ class FrotzbotBackend():
         elif 'specialinput' in json_update:
             self.prompt = json_update['specialinput']
 
-        # then, form update update_dict, where key is window id and value
-        # is new text
-        update_dict = dict()
+        # then, apply content updates to their windows
         for content_update in json_update.get('content', []):
-            text = ''
-            if 'lines' in content_update:
-                lines = [x for x in content_update['lines']
-                         if x is not None and 'content' in x]
-                for line in lines:
-                    line_contents = line['content']
-                    for line_content in line_contents:
-                            text = text + self.get_styled_text(line_content)
-                    text = text + '\n'
-            elif 'text' in content_update:
-                lines = [x for x in content_update['text']
-                         if (len(x) == 0) or 'content' in x]
-                for line in lines:
-                    if 'content' in line:
-                        line_contents = line['content']
-
-                        # try to filter input echo
-                        if filter_input_echo_str:
-                            line_contents = [x for x in line_contents
-                                             if x.get('style', '') != 'input' or x['text'] != filter_input_echo_str]
-
-                        for line_content in line_contents:
-                            text = text + self.get_styled_text(line_content)
-                    text = text + '\n'
-            elif 'clear' in content_update:
+            window = self.windows.get(content_update['id'])
+            if window is None:
+                self.log.warning('Content update for unknown window %r',
+                                 content_update['id'])
                 continue
-            else:
-                text = 'WARNING: UNKNOWN UPDATE TYPE ' + str(content_update)
-
-            update_dict[content_update['id']] = text
-
-        # now that we have filled update_dict, refresh window contents
-        for window in self.windows:
-            window['content_text'] = update_dict.get(
-                window['id'],
-                window.get('content_text', ''))
-
-    def get_styled_text(self, content):
-        text = content['text']
-        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        if 'style' in content and content['style'] in frotzbot_remglk_styles:
-            style = frotzbot_remglk_styles[content['style']]
-            text = '<%s>' % style + text + '</%s>' % style
+            window.apply(content_update, filter_input_echo_str)
+
+    def update_windows(self, window_list):
+        """Replace window layout with WINDOW_LIST, keeping state of windows
+        that are still there"""
+        if window_list == self.layout:
+            return
+        windows = dict()
+        for window_json in window_list:
+            window_id = window_json['id']
+            window = self.windows.get(window_id)
+            if window is None or window.type != window_json.get('type'):
+                window = make_window(window_json, self.renderer)
+            elif isinstance(window, GridWindow):
+                window.resize(window_json.get('gridheight', 0))
+            windows[window_id] = window
+        self.windows = windows
+        self.layout = window_list
+
+    def render_changes(self):
+        """Return list of texts of windows changed since last call.
+        With SPLIT_STATUS grid windows are left out, and their text
+        is kept for take_status() if any of them changed"""
+        # observed by hand, a Timer costs about as much as rendering
+        # a typical turn
+        start = time.perf_counter()
+        if not self.split_status:
+            text_list = [window.render() for window in self.windows.values()
+                         if window.dirty]
+        else:
+            text_list = []
+            status_dirty = False
+            for window in self.windows.values():
+                if window.type == 'grid':
+                    status_dirty = status_dirty or window.dirty
+                elif window.dirty:
+                    text_list.append(window.render())
+            if status_dirty:
+                self.status_text = self.render_status()
+        frotzbotmetrics.render_seconds.observe(time.perf_counter() - start)
+        return text_list
+
+    def render_status(self):
+        """Return text of all grid windows"""
+        return ''.join(window.render() for window in self.windows.values()
+                       if window.type == 'grid')
+
+    def take_status(self):
+        """Return grid windows text if it changed since last call,
+        None otherwise"""
+        text = self.status_text
+        self.status_text = None
         return text
 
-    def get_raw(self):
-        return self.json_iter.__next__()
+    def get_raw(self, timeout=None):
+        try:
+            out_json = self.output.get(timeout=timeout)
+        except queue.Empty:
+            raise InterpreterTimeout()
+        if out_json is None:
+            # keep end marker for whoever asks next
+            self.output.put(None)
+            raise StopIteration()
+        return out_json
 
     def send_raw(self, text):
         self.terp_proc.stdin.write(text.encode('utf-8'))
         self.terp_proc.stdin.flush()
 
     def get(self, previous_input=None):
-        out_json = self.get_raw()
+        text_list = self.render_received(self.receive(previous_input))
+        self.record_turn([] if previous_input is None else [previous_input],
+                         text_list)
+        return text_list
 
-        self.log.debug("INTERPRETER OUT: %s", str(out_json))
+    def record_turn(self, inputs, text_list):
+        if self.transcript is not None:
+            self.transcript.append(inputs, text_list,
+                                   os.path.basename(self.game_path))
 
-        # check for errors
-        if out_json['type'] == 'error':
+    def receive(self, previous_input=None):
+        """Wait for interpreter update and apply it to windows, without
+        rendering them. Returns error messages that came before it"""
+        errors = []
+        while True:
+            try:
+                out_json = self.get_raw(self.timeout)
+            except InterpreterTimeout:
+                self.waiting = True
+                self.last_input = previous_input
+                raise
+            self.waiting = False
+
+            traffic_log.debug('INTERPRETER OUT: %s', out_json)
+
+            # check for errors
+            if out_json['type'] != 'error':
+                break
             error_msg = out_json.get(
                 'message', 'ERROR MESSAGE NOT SET. THIS INTERPRETER STINKS.')
-            return ['INTERPRETER ERROR: ' + error_msg] + self.get(previous_input)
+            error_text = 'INTERPRETER ERROR: ' + escape_html(error_msg)
+            tail = self.stderr_text()
+            if tail:
+                error_text = error_text + '\n<pre>%s</pre>' % escape_html(tail)
+            errors.append(error_text)
 
         self.process_update(out_json, previous_input)
-        text_list = [window.get('content_text', '') for window in self.windows]
+        self.special_input = 'specialinput' in out_json
+
+        if self.pending_save is not None:
+            # interpreter is done writing it by now
+            if self.savefiles is not None:
+                self.savefiles.record(self.pending_save,
+                                      os.path.basename(self.game_path))
+            self.pending_save = None
+        return errors
 
-        if 'specialinput' in out_json:
+    def render_received(self, errors):
+        """Texts of ERRORS and windows changed by updates received so far"""
+        text_list = errors + self.render_changes()
+
+        if self.special_input:
             # if out_json contains specialinput - we need to
             # show 'file choosing dialog' - simply add text prompting user
             # to enter save name
@@ -164,22 +864,454 @@ class FrotzbotBackend():
             # responding to save/restore dialog
             cmd_json['type'] = 'specialresponse'
             cmd_json['response'] = 'fileref_prompt'
-            cmd_json['value'] = self.savefile_prefix + text
+            if self.savefiles is not None:
+                cmd_json['value'] = self.savefiles.path(text)
+                if self.prompt.get('filemode', 'write') != 'read':
+                    self.pending_save = text
+            else:
+                cmd_json['value'] = self.savefile_prefix + text
 
         cmd_text = json.dumps(cmd_json)
 
-        self.log.debug("INTERPRETER IN: %s", cmd_text)
+        traffic_log.debug('INTERPRETER IN: %s', cmd_text)
 
         self.send_raw(cmd_text)
 
     def send_and_receive(self, text):
-        self.send(text)
-        return self.get(text)
+        return self.send_and_receive_many([text])[0]
 
-    def __del__(self):
+    def takes_typeahead(self):
+        """True if interpreter waits for a line, so next typed command
+        can go to it"""
+        return (self.prompt is not None and self.prompt['type'] == 'line' and
+                not self.special_input)
+
+    def start_turn(self):
+        self.limits.start_turn(self.terp_proc.pid)
+
+    def send_and_receive_many(self, commands):
+        """Send COMMANDS one by one, each as soon as interpreter asks for
+        next line, and render windows once after the last one.
+
+        Returns (window texts, commands left unsent as interpreter asked
+        for something else than a line). Commands can't be written ahead,
+        as each carries gen of the update it answers"""
+        with self.lock:
+            if self.suspended:
+                self.resume()
+            if self.session_manager is not None:
+                self.session_manager.touch(self)
+
+            if self.waiting:
+                # previous turn timed out. COMMANDS were typed without seeing
+                # its output, so show the output instead of sending them
+                return (self.get(self.last_input), [])
+
+            story = os.path.basename(self.game_path)
+            errors = []
+            sent = 0
+            for command in commands:
+                if sent and not self.takes_typeahead():
+                    break
+                self.start_turn()
+                with frotzbotmetrics.turn_seconds.time(story):
+                    self.send(command)
+                    try:
+                        errors.extend(self.receive(command))
+                    except InterpreterTimeout:
+                        frotzbotmetrics.interpreter_timeouts.inc(story)
+                        raise
+                sent = sent + 1
+            text_list = self.render_received(errors)
+            self.record_turn(commands[:sent], text_list)
+            return (text_list, list(commands[sent:]))
+
+    def save_path(self, save_name):
+        """Path of SAVE_NAME the interpreter is told in fileref prompts"""
+        if self.savefiles is not None:
+            return self.savefiles.path(save_name)
+        return self.savefile_prefix + save_name
+
+    def at_command_prompt(self):
+        """True if interpreter waits for a line after printing the usual
+        '>' prompt, not for an answer to some question of the game"""
+        if (self.prompt is None or self.special_input or
+                self.prompt['type'] != 'line'):
+            return False
+        window = self.windows.get(self.prompt.get('id'))
+        if not isinstance(window, BufferWindow):
+            return False
+        text = ''.join(x.get('text', '') for x in window.last_line)
+        return text.rstrip().endswith('>')
+
+    def dialog_update(self, timeout):
+        """Apply next update of save or restore dialog. Returns error
+        message if interpreter sent one instead, None otherwise"""
+        out_json = self.get_raw(timeout)
+        traffic_log.debug('INTERPRETER OUT: %s', out_json)
+        if out_json['type'] == 'error':
+            return out_json.get('message', 'unknown error')
+        self.process_update(out_json)
+        self.special_input = 'specialinput' in out_json
+        return None
+
+    def send_line(self, text):
+        """Type TEXT into line prompt, bypassing fileref dialog handling"""
+        cmd_text = json.dumps({'type': 'line', 'gen': self.gen,
+                               'window': self.prompt['id'], 'value': text})
+        traffic_log.debug('INTERPRETER IN: %s', cmd_text)
+        self.send_raw(cmd_text)
+
+    def suspend(self, save_name=autosave_name):
+        """Save game into SAVE_NAME and stop interpreter process.
+
+        Save is driven through regular fileref_prompt dialog, so it works
+        only while interpreter waits at its command prompt. Returns True
+        if interpreter is not running anymore."""
+        with self.lock:
+            if self.suspended or self.terp_proc is None:
+                return True
+            if (not self.suspendable or self.waiting or
+                    not self.at_command_prompt()):
+                return False
+
+            prompt = self.prompt
+            timeout = max(self.timeout or 0, save_restore_timeout)
+            path = self.save_path(save_name)
+            try:
+                # file left by previous suspend must not pass for a new one
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            try:
+                self.send_line('save')
+                error = self.dialog_update(timeout)
+                if error is None and (not self.special_input or
+                                      self.prompt['type'] != 'fileref_prompt'):
+                    error = 'asked %r instead of save file name' % (self.prompt,)
+                if error is None:
+                    self.send(save_name)
+                    error = self.dialog_update(timeout)
+                if error is None and not os.path.exists(path):
+                    error = 'no save file written'
+                if error is not None:
+                    # game has no save command, or it asked something else.
+                    # Either way, keep it running from now on
+                    self.log.warning('Interpreter refused to save (%s), '
+                                     'won\'t suspend it again', error)
+                    self.suspendable = False
+                    return False
+            except InterpreterTimeout:
+                self.log.warning('Interpreter did not save in time, '
+                                 'won\'t suspend it again')
+                self.suspendable = False
+                # whatever it prints later goes to the next turn
+                self.waiting = True
+                self.last_input = None
+                return False
+            except (IOError, StopIteration, ValueError):
+                self.log.exception('Failed to save interpreter state')
+                self.suspendable = False
+                return False
+            finally:
+                # player is not interested in what saving printed
+                self.render_changes()
+                self.pending_save = None
+
+            self.log.info('Suspending interpreter for %s', self.game_path)
+            self.saved_status = self.render_status()
+            self.close()
+            self.prompt = prompt
+            self.special_input = False
+            self.suspended = True
+            return True
+
+    def resume(self, save_name=autosave_name):
+        """Start interpreter again and restore game from SAVE_NAME.
+        Raises RestoreFailed, leaving game suspended, if that did not work"""
+        with self.lock:
+            if not self.suspended:
+                return
+            self.log.info('Resuming interpreter for %s', self.game_path)
+            prompt = self.prompt
+            timeout = max(self.timeout or 0, save_restore_timeout)
+
+            self.spawn()
+            try:
+                error = self.dialog_update(timeout)
+                presses = 0
+                while (error is None and self.prompt is not None and
+                       self.prompt['type'] == 'char' and
+                       presses < resume_key_presses):
+                    # title screen waiting for a key
+                    self.send(' ')
+                    error = self.dialog_update(timeout)
+                    presses = presses + 1
+                opening_status = self.render_status()
+                if error is None and not self.at_command_prompt():
+                    error = 'game did not reach its command prompt'
+                if error is None:
+                    self.send_line('restore')
+                    error = self.dialog_update(timeout)
+                if error is None and (not self.special_input or
+                                      self.prompt['type'] != 'fileref_prompt'):
+                    error = 'game did not ask for save file name'
+                if error is None:
+                    self.send(save_name)
+                    error = self.dialog_update(timeout)
+                if error is None and not self.at_command_prompt():
+                    error = 'game did not get back to its command prompt'
+                status = self.render_status()
+                if (error is None and self.saved_status and
+                        status == opening_status != self.saved_status):
+                    # status line still shows new game
+                    error = 'game did not take the save'
+            except InterpreterTimeout:
+                error = 'interpreter did not restore in time'
+            except (IOError, StopIteration, ValueError) as err:
+                self.log.debug('Restore failed', exc_info=1)
+                error = self.exit_reason() if isinstance(err, StopIteration) else str(err)
+            finally:
+                # whatever was printed during restore is not interesting,
+                # player has already seen this screen before suspending
+                self.render_changes()
+                self.pending_save = None
+
+            if error is not None:
+                # save is still there, next turn tries again
+                self.log.warning('Failed to restore interpreter: %s', error)
+                self.close()
+                self.prompt = prompt
+                self.special_input = False
+                raise RestoreFailed(error)
+            self.suspended = False
+            self.saved_status = None
+
+    def cpu_seconds(self):
+        """CPU time used by interpreters of this session so far"""
+        proc = self.terp_proc
+        used = frotzbotlimits.get_cpu_seconds(proc.pid) if proc else None
+        return self.cpu_used + (used or 0.0)
+
+    def watch_exit(self, child_watcher, key, on_exit):
+        """Have CHILD_WATCHER notice when interpreter exits on its own,
+        from now on. ON_EXIT(backend, reason) then runs through it with
+        KEY, once interpreter is closed"""
+        with self.lock:
+            self.child_watcher = child_watcher
+            self.exit_key = key
+            self.on_exit = on_exit
+            self.watch_process()
+
+    def watch_process(self):
+        if self.child_watcher is not None and self.terp_proc is not None:
+            self.child_watcher.watch(self.terp_proc, self.process_exited,
+                                     self.exit_key)
+
+    def unwatch_process(self):
+        if self.child_watcher is not None and self.terp_proc is not None:
+            self.child_watcher.unwatch(self.terp_proc)
+
+    def process_exited(self, proc):
+        """Called by child watcher once PROC exited"""
+        with self.lock:
+            if proc is not self.terp_proc:
+                # stopped on purpose: suspended, closed or handed over
+                return
+            reason = self.exit_reason()
+            self.close()
+            frotzbotmetrics.interpreter_exits.inc(os.path.basename(self.game_path))
+        self.on_exit(self, reason)
+
+    def stderr_text(self):
+        """Last lines interpreter wrote to stderr"""
+        return '\n'.join(self.stderr_tail)
+
+    def exit_reason(self):
+        """Explain to the player why interpreter output ended"""
+        proc = self.terp_proc
+        if proc is None:
+            return 'interpreter is not running'
+        try:
+            returncode = proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            return 'interpreter closed its output'
+        (violation, reason) = self.limits.exit_reason(returncode, self.cgroup)
+        if violation is not None:
+            frotzbotmetrics.limit_violations.inc(
+                os.path.basename(self.game_path), violation)
+        self.log.warning('Interpreter for %s stopped: %s',
+                         self.game_path, reason)
+        return reason
+
+    def export_state(self):
+        """Return (state, fds) for adopt() in another bot process.
+        Interpreter keeps running, see detach()"""
+        with self.lock:
+            state = {name: getattr(self, name) for name in self.handoff_fields}
+            state['limits'] = self.limits.config
+            state['windows'] = [window.export() for window in self.windows.values()]
+            if self.terp_proc is None:
+                return (state, [])
+            # readers of this process must not take output meant for
+            # the next one
+            self.stop_readers()
+            # output read from pipe already, None marks its end
+            output = []
+            while True:
+                try:
+                    output.append(self.output.get_nowait())
+                except queue.Empty:
+                    break
+            state['output'] = output
+            state['unread'] = base64.b64encode(self.json_iter.unread()).decode('ascii')
+            state['pid'] = self.terp_proc.pid
+            return (state, [self.terp_proc.stdin.fileno(),
+                            self.terp_proc.stdout.fileno(),
+                            self.terp_proc.stderr.fileno()])
+
+    @classmethod
+    def adopt(cls, state, fds, session_manager=None, savefiles=None,
+              transcript=None):
+        """Recreate backend from export_state() of previous bot process,
+        taking over its running interpreter through FDS"""
+        backend = cls.__new__(cls)
+        backend.log = logging.getLogger('FrotzbotBackend')
+        backend.lock = threading.RLock()
+        # previous process may be older and not know newer fields
+        backend.special_input = False
+        backend.saved_status = None
+        for name in cls.handoff_fields:
+            if name in state:
+                setattr(backend, name, state[name])
+        backend.limits = frotzbotlimits.ResourceLimits(state['limits'])
+        backend.renderer = (StyleRenderer(backend.styles) if backend.styles
+                            else default_renderer)
+        backend.windows = {x['id']: restore_window(x, backend.renderer)
+                           for x in state['windows']}
+        backend.layout = None
+        backend.session_manager = session_manager
+        backend.savefiles = savefiles
+        backend.transcript = transcript
+        backend.stderr_tail = collections.deque(maxlen=stderr_tail_lines)
+        backend.child_watcher = None
+        backend.terp_proc = None
+        if 'pid' in state:
+            backend.terp_proc = frotzbothandoff.AdoptedProcess(state['pid'], *fds)
+            backend.start_readers(state['output'],
+                                  base64.b64decode(state.get('unread', '')))
+        if session_manager is not None:
+            session_manager.add(backend)
+        return backend
+
+    def detach(self):
+        """Forget interpreter handed over to another bot process,
+        without stopping it"""
+        with self.lock:
+            self.unwatch_process()
+            self.terp_proc = None
+
+    def close(self):
         if self.terp_proc is not None:
             logging.info('KILLING INTERPRETER')
+            # exit on purpose is nothing to report
+            self.unwatch_process()
+            self.terp_proc.kill()
+            try:
+                # killed process keeps its CPU times until it is waited for
+                self.cpu_used = self.cpu_used + (
+                    frotzbotlimits.get_cpu_seconds(self.terp_proc.pid) or 0.0)
+            except Exception:
+                # e.g. on exit, when builtins are gone already. Accounting
+                # must not keep the process from being released
+                self.log.debug('Could not account CPU time', exc_info=1)
+            self.terp_proc.wait()
+            self.limits.remove_group(self.cgroup)
+            self.cgroup = None
+            # let readers go before their pipes do, keeping
+            # last words of the interpreter
+            self.stop_readers(1.0, drain_stderr=True)
             self.terp_proc.stdout.close()
             self.terp_proc.stdin.close()
             self.terp_proc.stderr.close()
-            self.terp_proc.kill()
+            self.terp_proc = None
+
+    def __del__(self):
+        self.close()
+
+
+class FrotzbotSingleTurnBackend(FrotzbotBackend):
+    """Backend that starts interpreter for every turn.
+
+    Interpreter restores its state from autosave in AUTOSAVE_DIR, handles
+    one input, saves and exits, so idle games cost no memory. Window state
+    and gen are kept here between turns, as with regular backend"""
+    handoff_fields = FrotzbotBackend.handoff_fields + ('autosave_dir',)
+
+    def __init__(self,
+                 arg_frotz_path,
+                 arg_game_path,
+                 savefile_prefix='',
+                 terp_args=None,
+                 terp_init_string=default_init_string,
+                 timeout=None,
+                 styles=None,
+                 split_status=False,
+                 savefiles=None,
+                 limits=None,
+                 transcript=None,
+                 autosave_dir='',
+                 single_turn_args=None):
+        self.autosave_dir = autosave_dir
+        os.makedirs(autosave_dir, exist_ok=True)
+        # new game, don't let interpreter restore the old one
+        for name in os.listdir(autosave_dir):
+            os.remove(os.path.join(autosave_dir, name))
+        if single_turn_args is None:
+            single_turn_args = default_single_turn_args
+        terp_args = list(terp_args or []) + [x.format(autodir=autosave_dir)
+                                             for x in single_turn_args]
+        super().__init__(arg_frotz_path,
+                         arg_game_path,
+                         savefile_prefix,
+                         terp_args,
+                         terp_init_string,
+                         timeout=timeout,
+                         styles=styles,
+                         split_status=split_status,
+                         savefiles=savefiles,
+                         limits=limits,
+                         transcript=transcript)
+
+    def receive(self, previous_input=None):
+        try:
+            return super().receive(previous_input)
+        finally:
+            if not self.waiting:
+                self.finish_turn()
+
+    def start_turn(self):
+        if self.terp_proc is None:
+            # state comes from autosave, interpreter needs no init
+            self.spawn(send_init=False)
+        super().start_turn()
+
+    def finish_turn(self):
+        """Let interpreter write its autosave and exit on its own"""
+        if self.terp_proc is None:
+            return
+        try:
+            self.terp_proc.wait(timeout=single_turn_exit_timeout)
+        except subprocess.TimeoutExpired:
+            self.log.warning('Single turn interpreter did not exit, killing it')
+        self.close()
+
+    def watch_process(self):
+        # interpreter exits after every turn by design, and dying
+        # in the middle of one shows as end of its output
+        pass
+
+    def suspend(self, save_name=autosave_name):
+        # nothing is running between turns anyway
+        return True
+
@@ -0,0 +1,266 @@
+"""This module contains transcript store, which keeps every turn played
+in a chat: what player typed and what interpreter printed in reply.
+
+Turns of a chat go to its own directory, in segment files made of
+zlib compressed blocks of several turns each. Index file has a fixed
+size entry per turn pointing at its block, so last turns are found
+without reading anything else"""
+
+import hashlib
+import html
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+# turn time, segment number, block offset and length, turn within block
+index_entry = struct.Struct('<dIQIH')
+segment_re = re.compile(r'^seg-(\d+)\.z$')
+tag_re = re.compile(r'<[^>]*>')
+
+
+def html_to_text(text):
+    """Plain text of interpreter output, which is telegram HTML"""
+    return html.unescape(tag_re.sub('', text))
+
+
+def segment_name(number):
+    return 'seg-%06d.z' % number
+
+
+class ChatTranscript():
+    """Transcript of one chat, living in DIRECTORY.
+
+    Turns are kept in memory until BLOCK_TURNS of them make a block.
+    New segment is started once current one grows past SEGMENT_BYTES.
+    Oldest segments are removed when all of them take more than
+    MAX_BYTES, or when they are older than MAX_AGE seconds (0 means
+    no limit)"""
+
+    def __init__(self, directory, block_turns=16, segment_bytes=1024 * 1024,
+                 max_bytes=0, max_age=0):
+        self.log = logging.getLogger('ChatTranscript')
+        self.directory = directory
+        self.block_turns = block_turns
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(directory, 'index.bin')
+        self.lock = threading.Lock()
+        # turns not written yet, as (time, encoded record)
+        self.pending = []
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+
+    def segments(self):
+        """Numbers of segment files on disk, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(m.group(1)) for m in map(segment_re.match, names) if m)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, segment_name(number))
+
+    def append(self, inputs, texts, story=None):
+        """Record a turn: INPUTS player sent and window TEXTS shown back"""
+        now = time.time()
+        record = json.dumps({'time': now, 'story': story, 'input': list(inputs),
+                             'output': list(texts)}, ensure_ascii=False)
+        with self.lock:
+            self.pending.append((now, record.encode('utf-8')))
+            if len(self.pending) >= self.block_turns:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        """Write pending turns as one block. Called with lock held"""
+        if not self.pending:
+            return
+        block = zlib.compress(b'\n'.join(x[1] for x in self.pending))
+        offset = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.segment_path(self.segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes:
+                self.segment = self.segment + 1
+                path = self.segment_path(self.segment)
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(block)
+            entries = b''.join(
+                index_entry.pack(turn_time, self.segment, offset, len(block), item)
+                for (item, (turn_time, _)) in enumerate(self.pending))
+            with open(self.index_path, 'ab') as f:
+                f.write(entries)
+        except OSError:
+            # playing matters more than keeping record of it
+            self.log.exception('Could not write transcript to %s', self.directory)
+        self.pending = []
+        if offset == 0:
+            # new segment started, good time to drop old ones
+            self.enforce_retention_locked()
+
+    def read_index(self, count=None):
+        """Return list of last COUNT index entries, all if COUNT is None.
+        Index is read through mmap, only the entries asked for.
+        Called with lock held"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                total = os.fstat(f.fileno()).st_size // index_entry.size
+                if not total:
+                    return []
+                first = 0 if count is None else max(0, total - count)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                    return [index_entry.unpack_from(index, i * index_entry.size)
+                            for i in range(first, total)]
+        except FileNotFoundError:
+            return []
+
+    def count(self):
+        """Number of turns kept"""
+        with self.lock:
+            try:
+                size = os.path.getsize(self.index_path)
+            except FileNotFoundError:
+                size = 0
+            return size // index_entry.size + len(self.pending)
+
+    def last(self, count):
+        """Return list of last COUNT turns, as dicts with 'time', 'story',
+        'input' and 'output', oldest first"""
+        with self.lock:
+            pending = [x[1] for x in self.pending]
+            if count <= len(pending):
+                return [json.loads(x) for x in pending[len(pending) - count:]]
+            entries = self.read_index(count - len(pending))
+            return self.read_turns(entries) + [json.loads(x) for x in pending]
+
+    def read_turns(self, entries):
+        """Turns pointed at by index ENTRIES, each block read once"""
+        turns = []
+        (block_key, block) = (None, [])
+        for (_, segment, offset, length, item) in entries:
+            key = (segment, offset)
+            if key != block_key:
+                block_key = key
+                try:
+                    with open(self.segment_path(segment), 'rb') as f:
+                        f.seek(offset)
+                        block = zlib.decompress(f.read(length)).split(b'\n')
+                except (OSError, zlib.error):
+                    self.log.warning('Transcript block %s missing in %s',
+                                     key, self.directory)
+                    block = []
+            if item < len(block):
+                turns.append(json.loads(block[item]))
+        return turns
+
+    def all(self):
+        """Every turn kept, oldest first"""
+        with self.lock:
+            self.flush_locked()
+            return self.read_turns(self.read_index())
+
+    def enforce_retention(self):
+        with self.lock:
+            self.enforce_retention_locked()
+
+    def enforce_retention_locked(self):
+        """Remove oldest segments over limits, and their index entries.
+        Called with lock held"""
+        if not self.max_bytes and not self.max_age:
+            return
+        segments = self.segments()
+        sizes = dict()
+        for number in segments:
+            try:
+                stat = os.stat(self.segment_path(number))
+            except FileNotFoundError:
+                continue
+            sizes[number] = (stat.st_size, stat.st_mtime)
+        total = sum(size for (size, _) in sizes.values())
+        now = time.time()
+        removed = set()
+        for number in segments[:-1]:
+            (size, mtime) = sizes.get(number, (0, now))
+            too_big = self.max_bytes and total > self.max_bytes
+            too_old = self.max_age and now - mtime > self.max_age
+            if not too_big and not too_old:
+                break
+            os.remove(self.segment_path(number))
+            total = total - size
+            removed.add(number)
+        if not removed:
+            return
+        self.log.info('Removed %d old transcript segments in %s',
+                      len(removed), self.directory)
+        entries = [x for x in self.read_index() if x[1] not in removed]
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(index_entry.pack(*x) for x in entries))
+        os.replace(temp_path, self.index_path)
+
+
+class FrotzbotTranscriptStore():
+    """Keeps transcripts under ROOT/chats/<shard>/<chat id>/, sharded
+    the same way as saves. Other arguments are those of ChatTranscript"""
+
+    def __init__(self, root='transcripts', block_turns=16,
+                 segment_bytes=1024 * 1024, max_bytes=0, max_age=0):
+        self.log = logging.getLogger('FrotzbotTranscriptStore')
+        self.root = root
+        self.block_turns = block_turns
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.chats = dict()
+
+    def chat_directory(self, chat_id):
+        shard = hashlib.md5(str(chat_id).encode('utf-8')).hexdigest()[:2]
+        return os.path.join(self.root, 'chats', shard, str(chat_id))
+
+    def chat(self, chat_id):
+        """Return ChatTranscript of CHAT_ID"""
+        with self.lock:
+            transcript = self.chats.get(chat_id)
+            if transcript is None:
+                transcript = ChatTranscript(self.chat_directory(chat_id),
+                                            self.block_turns,
+                                            self.segment_bytes,
+                                            self.max_bytes,
+                                            self.max_age)
+                self.chats[chat_id] = transcript
+            return transcript
+
+    def expire(self):
+        """Drop old segments of every chat on disk, including chats
+        nobody played since start"""
+        if not self.max_age:
+            return
+        chats_dir = os.path.join(self.root, 'chats')
+        if not os.path.isdir(chats_dir):
+            return
+        for shard in os.listdir(chats_dir):
+            for chat_id in os.listdir(os.path.join(chats_dir, shard)):
+                try:
+                    self.chat(int(chat_id)).enforce_retention()
+                except (ValueError, OSError):
+                    self.log.exception('Could not expire transcript of %s', chat_id)
+
+    def shutdown(self):
+        """Write turns still kept in memory"""
+        with self.lock:
+            transcripts = list(self.chats.values())
+        for transcript in transcripts:
+            transcript.flush()
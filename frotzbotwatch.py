@@ -0,0 +1,133 @@
+"""This module contains child watcher, which notices interpreter processes
+exiting as soon as they do, reaps them and tells whoever started them"""
+
+import logging
+import os
+import selectors
+import threading
+import weakref
+
+
+class FrotzbotChildWatcher():
+    """Waits for watched processes to exit on one background thread.
+
+    Every process gets a pidfd, which becomes readable when it exits, so
+    a single selector covers all of them. Where pidfd is not available
+    processes are polled every POLL_INTERVAL seconds instead.
+
+    Callbacks go through RUN(key, callback, proc), e.g. scheduler.submit,
+    so that they run in order with other jobs of the same chat"""
+
+    def __init__(self, run=None, poll_interval=5):
+        self.log = logging.getLogger('FrotzbotChildWatcher')
+        self.run = run if run is not None else lambda key, f, *args: f(*args)
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        # processes watched with pidfd: proc -> pidfd
+        self.pidfds = dict()
+        # processes watched without pidfd: proc -> (callback ref, key)
+        self.polled = dict()
+        # set once exits should not be reported anymore
+        self.stopped = False
+        # wakes selector up when there is a new pidfd to wait on
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.watch_loop,
+                                       name='frotzbot-child-watcher',
+                                       daemon=True)
+        self.thread.start()
+
+    def watch(self, proc, callback, key=None):
+        """Call CALLBACK(proc) through RUN once PROC exits. Only a weak
+        reference to CALLBACK is kept, so watching a backend does not
+        keep it alive"""
+        try:
+            ref = weakref.WeakMethod(callback)
+        except TypeError:
+            ref = weakref.ref(callback)
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except ProcessLookupError:
+            # gone already
+            self.exited(proc, ref, key)
+            return
+        except (AttributeError, OSError):
+            with self.lock:
+                self.polled[proc] = (ref, key)
+            return
+        with self.lock:
+            self.pidfds[proc] = pidfd
+            self.selector.register(pidfd, selectors.EVENT_READ, (proc, ref, key))
+        self.wakeup()
+
+    def unwatch(self, proc):
+        """Stop watching PROC, e.g. because it is about to be killed
+        on purpose"""
+        with self.lock:
+            self.polled.pop(proc, None)
+            pidfd = self.pidfds.pop(proc, None)
+            if pidfd is not None:
+                self.selector.unregister(pidfd)
+                os.close(pidfd)
+
+    def stop(self):
+        """Stop reporting exits, e.g. before RUN stops taking jobs.
+        Processes still get reaped"""
+        self.stopped = True
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, b'w')
+        except BlockingIOError:
+            # wakeup is pending anyway
+            pass
+
+    def watched_count(self):
+        with self.lock:
+            return len(self.pidfds) + len(self.polled)
+
+    def watch_loop(self):
+        while True:
+            with self.lock:
+                timeout = self.poll_interval if self.polled else None
+            for (selector_key, _) in self.selector.select(timeout):
+                if selector_key.fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+                proc = selector_key.data[0]
+                with self.lock:
+                    if self.pidfds.get(proc) != selector_key.fd:
+                        # unwatched meanwhile
+                        continue
+                    del self.pidfds[proc]
+                    self.selector.unregister(selector_key.fd)
+                    os.close(selector_key.fd)
+                self.exited(*selector_key.data)
+            self.poll()
+
+    def poll(self):
+        with self.lock:
+            polled = list(self.polled.items())
+        for (proc, (ref, key)) in polled:
+            if proc.poll() is not None:
+                with self.lock:
+                    if self.polled.pop(proc, None) is None:
+                        # unwatched meanwhile
+                        continue
+                self.exited(proc, ref, key)
+
+    def exited(self, proc, ref, key):
+        # reap it right away, so no zombie stays around until somebody
+        # gets to the callback. Does nothing for adopted processes
+        proc.poll()
+        callback = ref()
+        if callback is None or self.stopped:
+            # backend is gone, it was the one to kill the process,
+            # or nobody is there to tell anymore
+            return
+        try:
+            self.run(key, callback, proc)
+        except Exception:
+            self.log.exception('Could not report exit of process %d', proc.pid)
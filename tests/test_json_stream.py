@@ -0,0 +1,84 @@
+"""Tests for reading JSON objects from interpreter output"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from frotzbotterp import JsonStreamReader
+
+
+class JsonStreamReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        # every write is read back as a separate chunk
+        (self.writer, self.reader) = socket.socketpair(socket.AF_UNIX,
+                                                       socket.SOCK_SEQPACKET)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    def feed(self, chunks, **kwargs):
+        for chunk in chunks:
+            self.writer.send(chunk)
+        return JsonStreamReader(self.reader.fileno(), **kwargs)
+
+    def next_object(self, stream, timeout=5):
+        """Next object of STREAM, failing instead of hanging"""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(next(stream)),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertTrue(result, 'reader blocked with complete object buffered')
+        return result[0]
+
+    def test_split_object(self):
+        obj = {'text': 'quote \\" brace } é \U0001F600', 'runs': [1, -2.5, None]}
+        data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        stream = self.feed([data[i:i + 3] for i in range(0, len(data), 3)])
+        self.assertEqual(self.next_object(stream), obj)
+
+    def test_coalesced_objects(self):
+        objs = [{'gen': n, 'windows': []} for n in range(5)]
+        stream = self.feed([''.join(json.dumps(x) + '\n' for x in objs).encode()])
+        self.assertEqual([self.next_object(stream) for _ in objs], objs)
+
+    def test_whitespace_tail(self):
+        # closing bracket comes while more output is ready, followed
+        # by a chunk with newline only
+        obj = {'windows': {}, 'text': 'a' * 70000}
+        data = json.dumps(obj).encode()
+        stream = self.feed([data[:60000], data[60000:], b'\n'])
+        self.assertEqual(self.next_object(stream), obj)
+
+    def test_object_after_incomplete_one(self):
+        stream = self.feed([b'{"a": [1, {"b"', b': 2}]', b'}\n{"c"', b': 3}'])
+        self.assertEqual(self.next_object(stream), {'a': [1, {'b': 2}]})
+        self.assertEqual(self.next_object(stream), {'c': 3})
+
+    def test_malformed_object_raises(self):
+        stream = self.feed([b'{"a":1}{"b": nope}{"c":3}'])
+        self.assertEqual(self.next_object(stream), {'a': 1})
+        with self.assertRaises(ValueError):
+            next(stream)
+
+    def test_unread_output_goes_first(self):
+        stream = self.feed([b'\xa9"}\n'], unread='{"b": "'.encode() + b'\xc3')
+        self.assertEqual(self.next_object(stream), {'b': '\xe9'})
+
+    def test_end_of_output(self):
+        stream = self.feed([b'{"a": 1}'])
+        self.writer.close()
+        self.assertEqual(self.next_object(stream), {'a': 1})
+        with self.assertRaises(StopIteration):
+            next(stream)
+
+
+if __name__ == '__main__':
+    unittest.main()
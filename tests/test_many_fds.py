@@ -0,0 +1,68 @@
+"""Tests for interpreters running while the bot holds over 1024 fds,
+which select() can't handle"""
+
+import os
+import resource
+import subprocess
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import frotzbothandoff
+import frotzbotterp
+
+fake_remglk = os.path.join(here, '..', 'benchmarks', 'fake_remglk.py')
+wanted_fds = 1100
+
+
+class ManyFdsTest(unittest.TestCase):
+
+    def setUp(self):
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < wanted_fds + 100:
+            self.skipTest('open files limit is too low')
+        self.old_limit = (soft, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted_fds + 100, hard))
+        self.fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(wanted_fds)]
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.old_limit)
+
+    def test_backend_plays(self):
+        backend = frotzbotterp.FrotzbotBackend(
+            sys.executable, 'bench.story',
+            terp_args=[fake_remglk, '--paragraphs', '0'], timeout=10)
+        try:
+            self.assertGreater(backend.terp_proc.stdout.fileno(), 1024)
+            self.assertIn('Welcome to the benchmark.\n', backend.get())
+            self.assertIn('&gt; look\n', backend.send_and_receive('look'))
+        finally:
+            backend.close()
+
+    def test_adopted_process_wait(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        adopted = frotzbothandoff.AdoptedProcess(
+            proc.pid, os.dup(proc.stdin.fileno()), os.dup(proc.stdout.fileno()),
+            os.dup(proc.stderr.fileno()))
+        try:
+            with self.assertRaises(subprocess.TimeoutExpired):
+                adopted.wait(timeout=0.1)
+            adopted.kill()
+            proc.wait()
+            adopted.wait(timeout=5)
+        finally:
+            proc.kill()
+            proc.wait()
+            for f in (proc.stdin, proc.stdout, proc.stderr,
+                      adopted.stdin, adopted.stdout, adopted.stderr):
+                f.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
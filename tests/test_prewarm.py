@@ -0,0 +1,51 @@
+"""Tests for the pool of interpreters started in advance"""
+
+import os
+import sys
+import time
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import frotzbotmetrics
+import frotzbotpool
+
+fake_remglk = os.path.join(here, '..', 'benchmarks', 'fake_remglk.py')
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class PrewarmPoolTest(unittest.TestCase):
+
+    def test_hung_story_does_not_block_refills(self):
+        slow = {'name': 'Slow', 'filename': 'slow.story', 'prewarm': 1,
+                'interpreter_args': [fake_remglk, '--delay', '30']}
+        fast = {'name': 'Fast', 'filename': 'fast.story', 'prewarm': 1}
+        failures = frotzbotmetrics.prewarm_failures
+        config = {'interpreter': sys.executable,
+                  'interpreter_args': [fake_remglk, '--paragraphs', '0'],
+                  'interpreter_timeout': 0.5,
+                  'stories': [slow, fast]}
+        pool = frotzbotpool.FrotzbotPrewarmPool(config)
+        try:
+            self.assertTrue(wait_for(lambda: failures.values.get(('slow.story',))))
+            self.assertTrue(wait_for(lambda: pool.spare_count() == 1))
+            self.assertIsNone(pool.take(slow))
+            (backend, opening) = pool.take(fast)
+            self.assertIn('Welcome to the benchmark.\n',
+                          [text for (_, text) in opening])
+            backend.close()
+        finally:
+            pool.configure(dict(config, stories=[]))
+
+
+if __name__ == '__main__':
+    unittest.main()
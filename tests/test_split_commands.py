@@ -0,0 +1,64 @@
+"""Tests for splitting typed ahead messages into interpreter commands"""
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import frotzbotchat
+import frotzbotterp
+from frotzbotchat import split_commands
+
+fake_remglk = os.path.join(here, '..', 'benchmarks', 'fake_remglk.py')
+
+
+class SplitCommandsTest(unittest.TestCase):
+
+    def test_semicolons_and_lines(self):
+        self.assertEqual(split_commands('take lamp; open door\nlook'),
+                         ['take lamp', 'open door', 'look'])
+
+    def test_periods_stay(self):
+        self.assertEqual(split_commands('ask Mr. Smith about key'),
+                         ['ask Mr. Smith about key'])
+        self.assertEqual(split_commands('n. e; look.'), ['n. e', 'look'])
+
+    def test_quotes(self):
+        self.assertEqual(split_commands('say "hello. world"'),
+                         ['say "hello. world"'])
+        self.assertEqual(split_commands('say "a; b."; wait'),
+                         ['say "a; b."', 'wait'])
+        self.assertEqual(split_commands('say "a; b'), ['say "a; b'])
+
+    def test_nothing_to_split(self):
+        self.assertEqual(split_commands(';;'), [';;'])
+
+
+class SendCommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = frotzbotchat.FrotzbotChat(None, 1, {})
+        self.chat.interpreter = frotzbotterp.FrotzbotBackend(
+            sys.executable, 'bench.story',
+            terp_args=[fake_remglk, '--paragraphs', '0'], timeout=10)
+        self.chat.interpreter.get()
+
+    def tearDown(self):
+        self.chat.interpreter.close()
+
+    def test_commands_after_quit_are_reported(self):
+        text = self.chat.send_commands(['look', 'quit', 'wait', 'jump'])
+        self.assertIn('&gt; look', text)
+        self.assertNotIn('&gt; wait', text)
+        self.assertIn('[Not sent: wait / jump]', text)
+        self.assertIn('Use the /quit command instead', text)
+
+    def test_quit_first(self):
+        text = self.chat.send_commands(['quit', 'wait'])
+        self.assertEqual(text, '[Not sent: wait]\nUse the /quit command instead')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""Tests for splitting long replies into telegram sized messages"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import frotzbotchat
+from frotzbotchat import max_message_len, split_message, utf16_len
+
+
+class SplitMessageTest(unittest.TestCase):
+
+    def check_chunks(self, text):
+        chunks = split_message(text)
+        for chunk in chunks:
+            self.assertTrue(chunk)
+            self.assertLessEqual(utf16_len(chunk), max_message_len)
+        self.assertEqual(''.join(chunks), text)
+        return chunks
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(split_message('hello\nworld\n'), ['hello\nworld\n'])
+
+    def test_emoji_line(self):
+        text = '\U0001F600' * 5000
+        chunks = self.check_chunks(text)
+        self.assertEqual(len(chunks), 3)
+
+    def test_cjk_and_emoji_line(self):
+        self.check_chunks('中\U0001F600文 ' * 3000)
+
+    def test_tags_are_closed_and_reopened(self):
+        chunks = split_message('<b>' + 'word ' * 2000 + '</b>')
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.startswith('<b>'))
+            self.assertTrue(chunk.endswith('</b>'))
+            self.assertLessEqual(utf16_len(chunk), max_message_len)
+
+    def test_wide_character_over_limit_still_moves_on(self):
+        self.assertEqual(frotzbotchat.split_long_line('\U0001F600' * 3, 1),
+                         ['\U0001F600'] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
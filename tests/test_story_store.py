@@ -0,0 +1,71 @@
+"""Tests for the store of story files uploaded by players"""
+
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import frotzbotstore
+
+Document = collections.namedtuple('Document', 'file_id file_unique_id file_name')
+File = collections.namedtuple('File', 'file_path')
+
+
+class LocalBot():
+    """Bot whose files live on local disk, like with local Bot API server"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def getFile(self, file_id):
+        return File(os.path.join(self.directory, file_id))
+
+
+class StoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uploads = os.path.join(self.directory, 'uploads')
+        os.makedirs(self.uploads)
+        self.bot = LocalBot(self.uploads)
+        self.in_use = []
+        self.store = frotzbotstore.FrotzbotStoryStore(
+            root=os.path.join(self.directory, 'stories'), quota=1500,
+            in_use=lambda: self.in_use)
+
+    def tearDown(self):
+        self.store.shutdown()
+        shutil.rmtree(self.directory)
+
+    def upload(self, chat_id, name, size):
+        with open(os.path.join(self.uploads, name), 'wb') as f:
+            f.write(name.encode('ascii') * (size // len(name)))
+        return self.store.fetch(self.bot, Document(name, name, name + '.z5'),
+                                chat_id).result()
+
+    def test_pinned_story_is_kept(self):
+        first = self.upload(1, 'first', 1000)
+        # chat 1 is still picking interpreter
+        self.upload(2, 'second', 1000)
+        self.assertTrue(os.path.exists(first))
+
+    def test_unpinned_story_is_evicted(self):
+        first = self.upload(1, 'first', 1000)
+        self.store.unpin(1)
+        self.upload(2, 'second', 1000)
+        self.assertFalse(os.path.exists(first))
+
+    def test_started_story_is_kept(self):
+        first = self.upload(1, 'first', 1000)
+        self.in_use.append(first)
+        self.store.unpin(1)
+        self.upload(2, 'second', 1000)
+        self.assertTrue(os.path.exists(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
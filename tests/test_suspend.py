@@ -0,0 +1,98 @@
+"""Tests for suspending interpreters into autosave and bringing them back"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import frotzbotterp
+
+fake_remglk = os.path.join(here, '..', 'benchmarks', 'fake_remglk.py')
+
+
+class SuspendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backends = []
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.directory)
+
+    def start(self, *args):
+        backend = frotzbotterp.FrotzbotBackend(
+            sys.executable, 'bench.story',
+            savefile_prefix=os.path.join(self.directory, 'chat_'),
+            terp_args=[fake_remglk, '--paragraphs', '0'] + list(args),
+            timeout=10)
+        self.backends.append(backend)
+        backend.get()
+        return backend
+
+    def autosave(self):
+        return os.path.join(self.directory, 'chat_' + frotzbotterp.autosave_name)
+
+    def test_resume_restores_game(self):
+        backend = self.start('--saves')
+        backend.send_and_receive('look')
+        backend.send_and_receive('look')
+        self.assertTrue(backend.suspend())
+        self.assertTrue(backend.suspended)
+        self.assertIsNone(backend.terp_proc)
+        text = ''.join(backend.send_and_receive('wait'))
+        self.assertFalse(backend.suspended)
+        self.assertIn('&gt; wait\n', text)
+        self.assertIn('Moves: 3', backend.render_status())
+
+    def test_resume_past_title_screen(self):
+        backend = self.start('--saves', '--title-key')
+        backend.send_and_receive(' ')
+        backend.send_and_receive('look')
+        self.assertTrue(backend.suspend())
+        backend.send_and_receive('wait')
+        self.assertIn('Moves: 2', backend.render_status())
+
+    def test_no_save_outside_command_prompt(self):
+        # without '>' printed, the line prompt may be a question of the game
+        backend = self.start()
+        backend.send_and_receive('look')
+        self.assertFalse(backend.suspend())
+        self.assertFalse(backend.suspended)
+        self.assertFalse(os.path.exists(self.autosave()))
+        backend.send_and_receive('wait')
+        self.assertIn('Moves: 2', backend.render_status())
+
+    def test_lost_save_stays_suspended(self):
+        backend = self.start('--saves')
+        backend.send_and_receive('look')
+        self.assertTrue(backend.suspend())
+        os.rename(self.autosave(), self.autosave() + '.kept')
+        with self.assertRaises(frotzbotterp.RestoreFailed):
+            backend.send_and_receive('wait')
+        self.assertTrue(backend.suspended)
+        self.assertIsNone(backend.terp_proc)
+        os.rename(self.autosave() + '.kept', self.autosave())
+        backend.send_and_receive('wait')
+        self.assertFalse(backend.suspended)
+        self.assertIn('Moves: 2', backend.render_status())
+
+    def test_opening_without_prompt_stays_suspended(self):
+        backend = self.start('--saves')
+        self.assertTrue(backend.suspend())
+        # restart opens on something else than the command prompt,
+        # typing restore there could answer a question of the game
+        backend.terp_args = [fake_remglk, '--paragraphs', '0']
+        with self.assertRaises(frotzbotterp.RestoreFailed):
+            backend.send_and_receive('wait')
+        self.assertTrue(backend.suspended)
+        self.assertEqual(backend.prompt['type'], 'line')
+
+
+if __name__ == '__main__':
+    unittest.main()